@@ -30,7 +30,9 @@ const API_BASE_URL = getApiBaseUrl()
 interface Document { id: number; filename: string; original_filename: string; file_size: number; upload_time: string; }
 interface UploadingFile { file: File; progress: number; status: 'uploading' | 'success' | 'error'; error?: string; retryCount?: number; }
 interface QueryResult { answer: string; sources?: Array<{ filename: string; content: string; similarity?: number; }>; query: string; timestamp: string; }
-interface ConversationMessage { id: string; type: 'user' | 'assistant'; content: string; query?: string; sources?: Array<{ filename: string; content: string; similarity?: number; }>; timestamp: string; }
+interface QueryUsage { prompt_tokens?: number; completion_tokens?: number; total_tokens?: number; }
+interface QueryTiming { retrieval_ms: number; first_token_ms: number | null; generation_ms: number; total_ms: number; }
+interface ConversationMessage { id: string; type: 'user' | 'assistant'; content: string; query?: string; sources?: Array<{ filename: string; content: string; similarity?: number; }>; usage?: QueryUsage; timing?: QueryTiming; cached?: boolean; timestamp: string; }
 
 // --- 主儀表板元件 ---
 export const KnowledgeBaseDashboard: React.FC = () => {
@@ -178,6 +180,15 @@ const ChatPanel = ({ conversation, handleQuery, query, setQuery, isLoading, conv
                   </div>
                 </div>
               )}
+              {message.type === 'assistant' && message.timing && (
+                <p className="mt-2 text-xs text-muted-foreground">
+                  檢索 {Math.round(message.timing.retrieval_ms)}ms
+                  {message.timing.first_token_ms !== null && ` · 首字 ${Math.round(message.timing.first_token_ms)}ms`}
+                  {` · 共 ${(message.timing.total_ms / 1000).toFixed(1)}s`}
+                  {message.usage?.total_tokens !== undefined && ` · ${message.usage.total_tokens} tokens`}
+                  {message.cached && ' · 緩存回答'}
+                </p>
+              )}
             </div>
             {message.type === 'user' && <div className="w-8 h-8 rounded-full bg-secondary text-secondary-foreground flex items-center justify-center shrink-0">U</div>}
           </div>
@@ -616,26 +627,68 @@ const useDashboardState = () => {
       const assistantMessage: ConversationMessage = { id: assistantMessageId, type: 'assistant', content: '', query: currentQuery, sources: [], timestamp: new Date().toISOString() };
       setConversation(prev => [...prev, assistantMessage]);
 
+      const updateAssistantMessage = (patch: Partial<ConversationMessage>) => {
+        setConversation(prev =>
+          prev.map(msg => msg.id === assistantMessageId ? { ...msg, ...patch } : msg)
+        );
+      };
+
+      // 後端以 SSE 事件返回：sources 先於回答到達，token 為回答增量文本
+      const handleEvent = (event: string, data: any) => {
+        switch (event) {
+          case 'sources':
+            updateAssistantMessage({ sources: data });
+            break;
+          case 'token':
+            assistantResponseContent += data.text;
+            updateAssistantMessage({ content: assistantResponseContent });
+            conversationEndRef.current?.scrollIntoView({ behavior: 'smooth' });
+            break;
+          case 'error':
+            assistantResponseContent += (assistantResponseContent ? '\n\n' : '') + data.message;
+            updateAssistantMessage({ content: assistantResponseContent });
+            break;
+          case 'usage':
+            updateAssistantMessage({ usage: data });
+            break;
+          case 'timing':
+            updateAssistantMessage({ timing: data });
+            break;
+          case 'done':
+            updateAssistantMessage({ cached: Boolean(data.cached) });
+            break;
+        }
+      };
+
+      const decoder = new TextDecoder();
+      let buffer = '';
       while (true) {
         const { done, value } = await reader.read();
         if (done) {
           break;
         }
-        const chunk = new TextDecoder().decode(value);
-        assistantResponseContent += chunk;
-        setConversation(prev =>
-          prev.map(msg =>
-            msg.id === assistantMessageId ? { ...msg, content: assistantResponseContent } : msg
-          )
-        );
-        conversationEndRef.current?.scrollIntoView({ behavior: 'smooth' });
+        // stream 模式解碼，跨數據塊的多字節字符不會被截斷
+        buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+
+        // 事件以空行分隔，最後一段可能不完整，留到下次讀取後再解析
+        const events = buffer.split('\n\n');
+        buffer = events.pop() ?? '';
+        for (const rawEvent of events) {
+          let event = 'message';
+          const dataLines: string[] = [];
+          for (const line of rawEvent.split('\n')) {
+            if (line.startsWith('event:')) {
+              event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+              dataLines.push(line.slice(5).trimStart());
+            }
+          }
+          if (dataLines.length > 0) {
+            handleEvent(event, JSON.parse(dataLines.join('\n')));
+          }
+        }
       }
 
-      // 這裡可以處理 sources 和 processing_time，如果後端有發送的話
-      // 目前後端只發送了 answer 的 chunk，所以 sources 和 processing_time 需要額外處理
-      // 例如，可以在流結束時發送一個特殊的 JSON 塊，包含這些資訊
-      // 或者在流結束後再發送一個單獨的請求來獲取這些資訊
-
     } catch (error) {
       const errorMessage: ConversationMessage = { id: `assistant-${Date.now()}`, type: 'assistant', content: '網路請求失敗，請檢查後端服務是否正常運作。', query: currentQuery, timestamp: new Date().toISOString() };
       setConversation(prev => [...prev, errorMessage]);
@@ -0,0 +1,187 @@
+"""
+語義答案緩存
+同一用戶對同一份語料的改寫問題（如「付款條件是什麼」與「付款期限多久」）直接重放上次的回答，不再調用 LLM。
+緩存按用戶的索引代區分，用戶索引發佈新一代（上傳、刪除、重建）後該用戶的緩存自動失效
+"""
+
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 含數字的英文詞項（編號、金額、日期等），向量相近但編號不同的問題不能共用答案
+_IDENTIFIER_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*")
+
+
+def query_signature(query: str) -> FrozenSet[str]:
+    """查詢中含數字的詞項集合，命中緩存時必須完全一致"""
+    normalized = unicodedata.normalize("NFKC", query).lower()
+    return frozenset(
+        token for token in _IDENTIFIER_PATTERN.findall(normalized)
+        if any(char.isdigit() for char in token)
+    )
+
+
+class SemanticAnswerCache:
+    """以 (用戶, 索引代, 查詢向量) 為鍵、按相似度閾值匹配的答案緩存"""
+
+    def __init__(self, max_entries: int = 10000, threshold: float = 0.95, ttl_seconds: float = 86400):
+        """
+        初始化緩存
+
+        Args:
+            max_entries: 所有用戶合計最多緩存的回答數，0 表示停用
+            threshold: 查詢向量餘弦相似度不低於該值時視為同一問題
+            ttl_seconds: 回答有效期（秒），0 表示永不過期
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+
+        # 用戶 -> {'generation': 索引代, 'entries': [回答]}，按最近使用排序，超出容量時從最久未使用的用戶淘汰
+        self._users: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype='float32').reshape(-1)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _user_entries(self, user_id: int, generation: Optional[int]) -> Optional[List[Dict[str, Any]]]:
+        """獲取用戶當前索引代的緩存回答，索引代已變化時清空該用戶的緩存"""
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        if user['generation'] != generation:
+            self._size -= len(user['entries'])
+            del self._users[user_id]
+            self.invalidations += 1
+            return None
+        if self.ttl:
+            now = time.time()
+            live = [entry for entry in user['entries'] if now - entry['created'] <= self.ttl]
+            self._size -= len(user['entries']) - len(live)
+            if not live:
+                # 不保留沒有回答的用戶，淘汰時總能從隊首取到回答
+                del self._users[user_id]
+                return None
+            user['entries'] = live
+        self._users.move_to_end(user_id)
+        return user['entries']
+
+    def lookup(self, user_id: int, generation: Optional[int], scope: Hashable, query: str,
+               embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """
+        查找相似問題的緩存回答
+
+        Args:
+            user_id: 用戶 ID
+            generation: 用戶索引的當前代
+            scope: 其他影響回答的條件（如 LLM 模型、檢索參數），必須完全一致
+            query: 查詢文本
+            embedding: 查詢向量
+
+        Returns:
+            命中時返回 {'chunks', 'sources', 'usage', 'query', 'similarity'}，否則返回 None
+        """
+        if not self.enabled or generation is None:
+            return None
+
+        signature = query_signature(query)
+        embedding = self._normalize(embedding)
+        with self._lock:
+            entries = self._user_entries(user_id, generation) or []
+            candidates = [
+                entry for entry in entries
+                if entry['scope'] == scope and entry['signature'] == signature
+            ]
+            if candidates:
+                similarities = np.stack([entry['embedding'] for entry in candidates]) @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    entry = candidates[best]
+                    return {
+                        'chunks': entry['chunks'],
+                        'sources': entry['sources'],
+                        'usage': entry['usage'],
+                        'query': entry['query'],
+                        'similarity': float(similarities[best])
+                    }
+            self.misses += 1
+            return None
+
+    def store(self, user_id: int, generation: Optional[int], scope: Hashable, query: str,
+              embedding: np.ndarray, chunks: List[str], sources: List[dict], usage: Optional[Dict] = None):
+        """
+        緩存一次完整的回答
+
+        generation 應為檢索前讀取的索引代：生成回答期間索引已更新時，該回答會隨舊代一起失效
+        """
+        if not self.enabled or generation is None or not chunks:
+            return
+
+        entry = {
+            'scope': scope,
+            'signature': query_signature(query),
+            'embedding': self._normalize(embedding),
+            'query': query,
+            'chunks': list(chunks),
+            'sources': sources,
+            'usage': dict(usage or {}),
+            'created': time.time()
+        }
+        with self._lock:
+            entries = self._user_entries(user_id, generation)
+            if entries is None:
+                self._users[user_id] = {'generation': generation, 'entries': []}
+                entries = self._users[user_id]['entries']
+            entries.append(entry)
+            self._size += 1
+
+            while self._size > self.max_entries and self._users:
+                oldest_user, user = next(iter(self._users.items()))
+                if user['entries']:
+                    user['entries'].pop(0)
+                    self._size -= 1
+                if not user['entries']:
+                    del self._users[oldest_user]
+
+    def invalidate(self, user_id: int):
+        """清除用戶的全部緩存回答"""
+        with self._lock:
+            user = self._users.pop(user_id, None)
+            if user is not None:
+                self._size -= len(user['entries'])
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取命中率和容量"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': self._size,
+                'users': len(self._users),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'invalidations': self.invalidations
+            }
@@ -3,15 +3,21 @@
 提供用戶註冊、登入和個人文檔管理功能
 """
 
+import asyncio
 import time
 import base64
+import hashlib
+import json
 import os
+import re
 import sys
 import uuid
 import logging
+import mimetypes
+import zipfile
 from datetime import datetime, timedelta
-from pathlib import Path
-from typing import List, Optional, Annotated
+from pathlib import Path, PurePosixPath
+from typing import Callable, List, Optional, Annotated
 
 # 配置日誌
 log_dir = Path(__file__).parent.parent / 'logs'
@@ -26,6 +32,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 冷啟動計時：從載入本模塊到服務可以響應請求
+app_load_started = time.time()
+app_ready_seconds = None
 
 # 添加項目根目錄到 Python 路徑（用於雲端部署）
 current_dir = Path(__file__).parent
@@ -34,8 +43,9 @@ if str(parent_dir) not in sys.path:
     sys.path.insert(0, str(parent_dir))
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form
-from fastapi.responses import StreamingResponse # Import StreamingResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, status, UploadFile, File, Form
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
@@ -50,9 +60,12 @@ try:
         create_builtin_models, get_available_models, create_custom_model, delete_custom_model,
         set_user_model_preference, get_user_model_preferences, get_user_default_model, 
         delete_user_model_preference, delete_user_model_preference_by_id,
-        update_user_profile, update_user_password, delete_all_user_documents, verify_password
+        update_user_profile, update_user_password, delete_all_user_documents, verify_password,
+        create_ingestion_job, get_ingestion_job, create_documents, SessionLocal
     )
     from scripts.user_knowledge_base import UserKnowledgeBaseSystem
+    from scripts.ingestion_queue import IngestionQueue
+    from scripts.text_extraction import SUPPORTED_FORMATS
 except ImportError:
     # 本地開發環境的導入方式
     from database import (
@@ -62,9 +75,12 @@ except ImportError:
         create_builtin_models, get_available_models, create_custom_model, delete_custom_model,
         set_user_model_preference, get_user_model_preferences, get_user_default_model, 
         delete_user_model_preference, delete_user_model_preference_by_id,
-        update_user_profile, update_user_password, delete_all_user_documents, verify_password
+        update_user_profile, update_user_password, delete_all_user_documents, verify_password,
+        create_ingestion_job, get_ingestion_job, create_documents, SessionLocal
     )
     from user_knowledge_base import UserKnowledgeBaseSystem
+    from ingestion_queue import IngestionQueue
+    from text_extraction import SUPPORTED_FORMATS
 
 # 載入環境變數
 load_dotenv()
@@ -106,6 +122,50 @@ app.add_middleware(
 # 安全設置
 security = HTTPBearer()
 
+# 上傳設置：文件分塊寫入磁盤，不整體讀入內存
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", "500")) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+# 批量上傳設置：單次請求的文檔數上限和 zip 壓縮包大小上限
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "1000"))
+MAX_ARCHIVE_SIZE = int(os.getenv("MAX_ARCHIVE_MB", "2048")) * 1024 * 1024
+# 單次批量上傳中所有 zip 解壓後的總大小上限，防止高壓縮率的壓縮包寫滿磁盤
+MAX_EXTRACTED_SIZE = int(os.getenv("MAX_EXTRACTED_MB", "8192")) * 1024 * 1024
+# 單次批量上傳的請求體大小上限
+MAX_BATCH_UPLOAD_SIZE = int(os.getenv("MAX_BATCH_UPLOAD_MB", "2048")) * 1024 * 1024
+# multipart 表單的邊界和字段頭佔用的額外字節
+MULTIPART_OVERHEAD = 1024 * 1024
+
+# 上傳接口的請求體大小上限，按 Content-Length 在解析表單之前檢查
+UPLOAD_BODY_LIMITS = {
+    "/upload": MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+    "/upload/batch": MAX_BATCH_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+}
+
+
+@app.middleware("http")
+async def limit_upload_body(request: Request, call_next):
+    """
+    按 Content-Length 提前拒絕過大的上傳請求
+    
+    Starlette 在調用接口之前會把整個 multipart 請求體解析並暫存到臨時文件，
+    接口內的分塊寫入只能限制複製到文檔目錄的大小，無法阻止請求體本身佔滿臨時目錄，
+    因此在讀取請求體之前先按請求頭拒絕
+    """
+    limit = UPLOAD_BODY_LIMITS.get(request.url.path)
+    if limit is not None and request.method == "POST":
+        content_length = request.headers.get("content-length")
+        if content_length is not None:
+            try:
+                body_size = int(content_length)
+            except ValueError:
+                return JSONResponse(status_code=400, content={"detail": "無效的 Content-Length"})
+            if body_size > limit:
+                return JSONResponse(
+                    status_code=413,
+                    content={"detail": f"請求大小超過 {(limit - MULTIPART_OVERHEAD) / (1024*1024):.0f}MB 限制"}
+                )
+    return await call_next(request)
+
 # 全局知識庫實例 - 帶錯誤處理
 user_kb_system = None
 kb_system_error = None
@@ -130,6 +190,59 @@ def initialize_kb_system():
 # 嘗試初始化知識庫系統
 initialize_kb_system()
 
+# 後台索引任務隊列，上傳後的文本提取和嵌入不在請求中執行
+ingestion_queue = None
+if user_kb_system is not None:
+    ingestion_queue = IngestionQueue(
+        user_kb_system,
+        SessionLocal,
+        max_workers=int(os.getenv("INGESTION_WORKERS", "1")),
+        coalesce_ms=float(os.getenv("INGESTION_COALESCE_MS", "200"))
+    )
+
+@app.on_event("startup")
+async def record_startup_time():
+    """記錄冷啟動耗時（嵌入模型在後台載入，不計入）"""
+    global app_ready_seconds
+    app_ready_seconds = round(time.time() - app_load_started, 3)
+    logger.info(f"服務啟動完成，耗時 {app_ready_seconds:.2f}s")
+
+@app.on_event("startup")
+async def start_ingestion_queue():
+    """啟動時恢復未完成的索引任務"""
+    if ingestion_queue is not None:
+        ingestion_queue.start()
+
+@app.on_event("startup")
+async def start_index_migration():
+    """啟動時在後台升級舊格式的用戶索引"""
+    if user_kb_system is not None:
+        user_kb_system.start_index_migration()
+
+@app.on_event("shutdown")
+async def stop_ingestion_queue():
+    """關閉時停止索引任務隊列"""
+    if ingestion_queue is not None:
+        ingestion_queue.shutdown()
+
+@app.on_event("shutdown")
+async def close_llm_connections():
+    """關閉時釋放 LLM 連接池"""
+    if user_kb_system is not None:
+        await user_kb_system.llm_providers.aclose()
+
+@app.on_event("shutdown")
+async def save_query_embedding_cache():
+    """關閉時持久化查詢向量緩存"""
+    if user_kb_system is not None:
+        user_kb_system.save_query_embedding_cache()
+
+@app.on_event("shutdown")
+async def stop_text_extractor():
+    """關閉時停止文本提取進程池"""
+    if user_kb_system is not None:
+        user_kb_system.text_extractor.shutdown()
+
 # Pydantic 模型
 class UserRegister(BaseModel):
     username: str
@@ -156,6 +269,7 @@ class UserInfo(BaseModel):
 class QueryRequest(BaseModel):
     query: str
     top_k: Optional[int] = 5
+    min_score: Optional[float] = None  # 最低相關度，未設置時使用 MIN_RELEVANCE_SCORE
     conversation_history: Optional[List[dict]] = []
 
 class QueryResponse(BaseModel):
@@ -170,6 +284,16 @@ class DocumentInfo(BaseModel):
     original_filename: str
     file_size: int
     upload_time: datetime
+    is_indexed: bool = False
+
+class IngestionJobInfo(BaseModel):
+    id: int
+    document_id: Optional[int]
+    status: str
+    error: Optional[str]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
 
 # AI模型相關模型
 class AIModelInfo(BaseModel):
@@ -365,12 +489,138 @@ async def delete_all_user_documents_endpoint(
     try:
         delete_all_user_documents(db, current_user.id)
         # 如果 AI 系統可用，清除用戶的知識庫數據
-        if user_kb_system is not None:
-            user_kb_system.clear_user_data(current_user.id)
+        if ingestion_queue is not None:
+            # 經索引隊列排隊，執行中的批次完成後再清除，避免其寫回已刪除的文檔
+            await asyncio.wrap_future(ingestion_queue.request_clear(current_user.id))
+        elif user_kb_system is not None:
+            await run_in_threadpool(user_kb_system.clear_user_data, current_user.id)
         return {"message": "所有文檔已成功刪除"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"刪除文檔失敗: {str(e)}")
 
+async def save_upload_stream(file: UploadFile, file_path: Path, max_size: int = MAX_UPLOAD_SIZE) -> tuple:
+    """
+    將上傳文件分塊複製到文檔目錄，同時計算大小和 SHA-256，超過大小限制時立即中止
+    
+    此時請求體已由 Starlette 暫存完畢，這裡只限制寫入文檔目錄的大小；
+    請求體本身的大小由 limit_upload_body 按 Content-Length 在解析表單前限制。
+    先寫入 .part 臨時文件，完成後再改名，索引任務不會讀到寫了一半的文件
+    
+    Returns:
+        (文件大小, SHA-256 十六進制摘要)
+    """
+    tmp_path = file_path.with_name(file_path.name + ".part")
+    digest = hashlib.sha256()
+    file_size = 0
+    
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > max_size:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"文件大小超過 {max_size / (1024*1024):.0f}MB 限制"
+                    )
+                digest.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+        tmp_path.replace(file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    
+    return file_size, digest.hexdigest()
+
+def get_new_document_path(user_id: int, filename: str) -> Path:
+    """為新上傳的文檔生成唯一的保存路徑，AI 系統不可用時保存到基礎存儲目錄"""
+    if user_kb_system is not None:
+        return user_kb_system.get_new_document_path(user_id, filename)
+    user_docs_folder = Path("user_documents") / f"user_{user_id}"
+    user_docs_folder.mkdir(parents=True, exist_ok=True)
+    return user_docs_folder / f"{uuid.uuid4().hex}_{filename}"
+
+def _zip_member_name(info: zipfile.ZipInfo) -> str:
+    """獲取壓縮包成員的文件名，Windows 壓縮的中文文件名未標記 UTF-8 時按 GBK 解碼"""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('gbk')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+def extract_zip_documents(archive_path: Path, new_path: Callable[[str], Path], max_files: int,
+                          max_total_size: int = MAX_EXTRACTED_SIZE) -> tuple:
+    """
+    從 zip 壓縮包中解出支持格式的文檔，逐個成員分塊寫入磁盤
+    
+    壓縮包內的目錄結構不保留，只使用文件名；解壓大小按實際寫入的字節數限制，不信任壓縮包中記錄的大小。
+    單個成員超過 MAX_UPLOAD_SIZE 時跳過該成員，所有成員合計超過 max_total_size 時中止並返回 413
+    
+    Returns:
+        (已保存的 [(原文件名, 保存路徑, 大小, SHA-256, 內容類型)], 跳過的 [{filename, reason}])
+    """
+    saved, skipped = [], []
+    total_size = 0
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                name = _zip_member_name(info)
+                filename = PurePosixPath(name.replace("\\", "/")).name
+                if not filename or filename.startswith(".") or name.startswith("__MACOSX/"):
+                    # macOS 壓縮時附帶的元數據文件
+                    continue
+                if Path(filename).suffix.lower() not in SUPPORTED_FORMATS:
+                    skipped.append({"filename": name, "reason": "不支持的文件格式"})
+                    continue
+                if len(saved) >= max_files:
+                    raise HTTPException(status_code=413, detail=f"單次最多上傳 {max_files} 個文檔")
+                
+                file_path = new_path(filename)
+                tmp_path = file_path.with_name(file_path.name + ".part")
+                digest = hashlib.sha256()
+                file_size = 0
+                try:
+                    with archive.open(info) as src, open(tmp_path, 'wb') as dst:
+                        while True:
+                            chunk = src.read(UPLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            file_size += len(chunk)
+                            total_size += len(chunk)
+                            if total_size > max_total_size:
+                                raise HTTPException(
+                                    status_code=413,
+                                    detail=f"壓縮包解壓後總大小超過 {max_total_size / (1024*1024):.0f}MB 限制"
+                                )
+                            if file_size > MAX_UPLOAD_SIZE:
+                                raise ValueError(f"文件大小超過 {MAX_UPLOAD_SIZE / (1024*1024):.0f}MB 限制")
+                            digest.update(chunk)
+                            dst.write(chunk)
+                    tmp_path.replace(file_path)
+                except (ValueError, RuntimeError, EOFError, zipfile.BadZipFile) as e:
+                    # 單個成員超限、加密或損壞時跳過，不影響其他文檔
+                    tmp_path.unlink(missing_ok=True)
+                    total_size -= file_size
+                    skipped.append({"filename": name, "reason": str(e)})
+                    continue
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+                
+                content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                saved.append((filename, file_path, file_size, digest.hexdigest(), content_type))
+    except BaseException:
+        for _, file_path, _, _, _ in saved:
+            file_path.unlink(missing_ok=True)
+        raise
+    
+    return saved, skipped
+
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
@@ -379,44 +629,14 @@ async def upload_document(
 ):
     logger.info(f"User {current_user.username} uploading document: {file.filename}")
     """上傳文檔 (需要認證)"""
+    file_path = None
     try:
-        # 檢查文件大小限制 (500MB)
-        max_size = 500 * 1024 * 1024  # 500MB
-        file_size = 0
+        file_path = get_new_document_path(current_user.id, file.filename)
         
-        # 讀取文件內容並檢查大小
-        file_content = await file.read()
-        file_size = len(file_content)
-        
-        if file_size > max_size:
-            raise HTTPException(
-                status_code=413,
-                detail=f"文件大小 {file_size / (1024*1024):.2f}MB 超過 500MB 限制"
-            )
-        
-        # 檢查 AI 系統是否可用
-        if user_kb_system is None:
-            # AI 系統不可用，只做基本文件存儲
-            user_docs_folder = Path("user_documents") / f"user_{current_user.id}"
-            user_docs_folder.mkdir(parents=True, exist_ok=True)
-            
-            # 生成唯一文件名
-            import uuid
-            unique_filename = f"{uuid.uuid4().hex}_{file.filename}"
-            file_path = user_docs_folder / unique_filename
-            
-            # 保存文件
-            with open(file_path, 'wb') as f:
-                f.write(file_content)
-            
-            file_path_str = str(file_path)
-        else:
-            # AI 系統可用，使用完整功能
-            file_path_str = user_kb_system.save_user_document(
-                user_id=current_user.id,
-                filename=file.filename,
-                content=file_content
-            )
+        # 分塊寫入磁盤，邊寫邊計算大小和哈希
+        file_size, content_hash = await save_upload_stream(file, file_path)
+        file_path_str = str(file_path)
+        logger.info(f"用戶 {current_user.id} 保存文檔: {file.filename} -> {file_path.name} ({file_size} 字節, sha256 {content_hash})")
         
         # 在數據庫中記錄文檔信息
         db_document = create_document(
@@ -429,100 +649,318 @@ async def upload_document(
             owner_id=current_user.id
         )
         
-        # 嘗試重建用戶索引
+        # 創建索引任務，由後台隊列增量加入用戶索引
         index_status = "基礎存儲模式"
-        if user_kb_system is not None:
-            try:
-                user_kb_system.build_user_index(current_user.id)
-                index_status = "AI 索引已更新"
-            except Exception as e:
-                logger.error(f"索引建立失敗: {e}")
-                index_status = f"索引建立失敗: {str(e)}"
+        job_id = None
+        if ingestion_queue is not None:
+            job = create_ingestion_job(db, current_user.id, db_document.id)
+            ingestion_queue.submit(job.id, current_user.id)
+            job_id = job.id
+            index_status = "索引任務已排隊"
         
         return {
             "message": f"文檔 {file.filename} 上傳成功",
             "document_id": db_document.id,
+            "job_id": job_id,
             "filename": file.filename,
             "size": file_size,
+            "sha256": content_hash,
             "index_status": index_status,
             "ai_enabled": user_kb_system is not None
         }
+    except HTTPException:
+        raise
     except Exception as e:
+        if file_path is not None:
+            file_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"上傳失敗: {str(e)}")
 
+@app.post("/upload/batch")
+async def upload_documents_batch(
+    files: List[UploadFile] = File(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    批量上傳文檔或 zip 壓縮包 (需要認證)
+    
+    文件逐個分塊寫入磁盤，全部文檔記錄和索引任務在一個事務中寫入，
+    索引任務一次提交，由後台隊列合併為一次索引更新；不支持的格式和超限的文件跳過並在結果中列出
+    """
+    logger.info(f"User {current_user.username} batch uploading {len(files)} files")
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"單次最多上傳 {MAX_BATCH_FILES} 個文檔")
+    
+    def new_path(filename: str) -> Path:
+        return get_new_document_path(current_user.id, filename)
+    
+    saved, skipped = [], []
+    extracted_size = 0
+    try:
+        for file in files:
+            filename = Path(file.filename or "").name
+            suffix = Path(filename).suffix.lower()
+            if suffix == ".zip":
+                archive_path = new_path(filename)
+                try:
+                    await save_upload_stream(file, archive_path, MAX_ARCHIVE_SIZE)
+                except HTTPException as e:
+                    if e.status_code != 413:
+                        raise
+                    skipped.append({"filename": filename, "reason": e.detail})
+                    continue
+                try:
+                    members, member_skipped = await run_in_threadpool(
+                        extract_zip_documents, archive_path, new_path, MAX_BATCH_FILES - len(saved),
+                        MAX_EXTRACTED_SIZE - extracted_size
+                    )
+                except zipfile.BadZipFile:
+                    skipped.append({"filename": filename, "reason": "無效的 zip 文件"})
+                    continue
+                finally:
+                    archive_path.unlink(missing_ok=True)
+                saved.extend(members)
+                extracted_size += sum(member[2] for member in members)
+                skipped.extend({**item, "filename": f"{filename}/{item['filename']}"} for item in member_skipped)
+            elif suffix not in SUPPORTED_FORMATS:
+                skipped.append({"filename": filename, "reason": "不支持的文件格式"})
+            else:
+                if len(saved) >= MAX_BATCH_FILES:
+                    raise HTTPException(status_code=413, detail=f"單次最多上傳 {MAX_BATCH_FILES} 個文檔")
+                file_path = new_path(filename)
+                try:
+                    file_size, content_hash = await save_upload_stream(file, file_path)
+                except HTTPException as e:
+                    if e.status_code != 413:
+                        raise
+                    skipped.append({"filename": filename, "reason": e.detail})
+                    continue
+                saved.append((filename, file_path, file_size, content_hash,
+                              file.content_type or "application/octet-stream"))
+        
+        # 全部文檔記錄和索引任務一次提交
+        rows = create_documents(db, current_user.id, [
+            {
+                "filename": file_path.name,
+                "original_filename": filename,
+                "file_path": str(file_path),
+                "file_size": file_size,
+                "content_type": content_type
+            }
+            for filename, file_path, file_size, _, content_type in saved
+        ], create_jobs=ingestion_queue is not None) if saved else []
+    except BaseException as e:
+        for _, file_path, _, _, _ in saved:
+            file_path.unlink(missing_ok=True)
+        if isinstance(e, Exception) and not isinstance(e, HTTPException):
+            raise HTTPException(status_code=500, detail=f"上傳失敗: {str(e)}")
+        raise
+    
+    index_status = "基礎存儲模式"
+    if ingestion_queue is not None and rows:
+        ingestion_queue.submit_many([job_id for _, job_id in rows], current_user.id)
+        index_status = "索引任務已排隊"
+    logger.info(f"用戶 {current_user.id} 批量保存 {len(rows)} 個文檔，跳過 {len(skipped)} 個")
+    
+    return {
+        "message": f"成功上傳 {len(rows)} 個文檔",
+        "documents": [
+            {
+                "document_id": document_id,
+                "job_id": job_id,
+                "filename": filename,
+                "size": file_size,
+                "sha256": content_hash
+            }
+            for (document_id, job_id), (filename, _, file_size, content_hash, _) in zip(rows, saved)
+        ],
+        "skipped": skipped,
+        "index_status": index_status,
+        "ai_enabled": user_kb_system is not None
+    }
+
+def sse_event(event: str, data) -> bytes:
+    """編碼一個 SSE 事件，data 序列化為單行 JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+def sse_response(events) -> StreamingResponse:
+    """以 SSE 返回事件流，關閉緩存和反向代理緩衝，每個事件生成後立即送達客戶端"""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def sse_notice(message: str, start_time: float, error: Optional[str] = None):
+    """只有一條提示的事件流：error 為錯誤代碼時發送 error 事件，否則作為回答文本發送"""
+    if error:
+        yield sse_event("error", {"code": error, "message": message})
+    else:
+        yield sse_event("sources", [])
+        yield sse_event("token", {"text": message})
+    yield sse_event("done", {"processing_time": time.time() - start_time})
+
+async def replay_cached_answer(cached: dict, start_time: float):
+    """以與正常回答相同的事件重放緩存的回答，done 事件中標記 cached"""
+    yield sse_event("sources", cached['sources'])
+    first_token_ms = (time.time() - start_time) * 1000
+    for chunk in cached['chunks']:
+        yield sse_event("token", {"text": chunk})
+    # 沒有調用 LLM，不消耗 token
+    yield sse_event("usage", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+    processing_time = time.time() - start_time
+    yield sse_event("timing", {
+        "retrieval_ms": round(first_token_ms, 1),
+        "first_token_ms": round(first_token_ms, 1),
+        "generation_ms": 0.0,
+        "total_ms": round(processing_time * 1000, 1)
+    })
+    yield sse_event("done", {"processing_time": processing_time, "cached": True, "similarity": cached['similarity']})
+
+def source_info(result: dict) -> dict:
+    """檢索結果轉為 sources 事件中的引用來源"""
+    metadata = result.get('metadata', {})
+    source = {
+        "rank": result.get('rank'),
+        # 保存時添加的 uuid 前綴不顯示給用戶
+        "filename": re.sub(r"^[0-9a-f]{32}_", "", metadata.get('filename', '')),
+        "document_id": metadata.get('document_id'),
+        "chunk_index": metadata.get('chunk_index'),
+        "content": result['content'],
+        "similarity": result.get('score')
+    }
+    if 'rerank_score' in result:
+        source["rerank_score"] = result['rerank_score']
+    return source
+
 @app.post("/query")
 async def query_knowledge_base(
     request: QueryRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """
+    查詢個人知識庫 (需要認證)
+    
+    以 SSE 事件流返回：sources（引用來源，先於回答發送）、token（回答增量文本）、
+    usage（token 用量，提供商返回時）、timing（各階段耗時）、error（錯誤）、done（結束）
+    """
     logger.info(f"User {current_user.username} querying with: {request.query}")
-    """查詢個人知識庫 (需要認證)"""
     start_time = time.time()
     
     # 檢查 AI 系統是否可用
     if user_kb_system is None:
-        return {
-            "query": request.query,
-            "answer": f"AI 查詢功能暫時不可用。錯誤信息：{kb_system_error or '未知錯誤'}。\n\n您的文檔已安全存儲，一旦 AI 系統恢復，即可進行智能查詢。",
-            "sources": [],
-            "processing_time": time.time() - start_time,
-            "ai_enabled": False,
-            "error": "AI system unavailable"
-        }
+        return sse_response(sse_notice(
+            f"AI 查詢功能暫時不可用。錯誤信息：{kb_system_error or '未知錯誤'}。\n\n您的文檔已安全存儲，一旦 AI 系統恢復，即可進行智能查詢。",
+            start_time, error="ai_unavailable"
+        ))
+    
+    # 嵌入模型仍在後台載入時不排隊等待
+    if user_kb_system.get_model_status()["state"] == "loading":
+        return sse_response(sse_notice("AI 模型正在載入，請稍後重試。", start_time, error="models_loading"))
     
     try:
+        # 沒有對話歷史的問題先查找語義答案緩存，命中時不再檢索和調用 LLM
+        cache_context = None
+        if user_kb_system.answer_cache.enabled and not request.conversation_history:
+            cache_context = await user_kb_system.aget_answer_cache_context(
+                current_user.id, request.query, db, request.top_k, request.min_score
+            )
+            cached = user_kb_system.answer_cache.lookup(**cache_context)
+            if cached is not None:
+                logger.info(f"用戶 {current_user.id} 命中答案緩存（相似度 {cached['similarity']:.3f}）: {cached['query']}")
+                return sse_response(replay_cached_answer(cached, start_time))
+        
         # 搜索用戶的文檔
-        search_results = user_kb_system.search_user_documents(
+        search_results = await user_kb_system.asearch_user_documents(
             user_id=current_user.id,
             query=request.query,
-            top_k=request.top_k
+            top_k=request.top_k,
+            min_score=request.min_score,
+            rerank=True
         )
+    except Exception as e:
+        logger.error(f"用戶 {current_user.id} 檢索失敗: {e}")
+        return sse_response(sse_notice(
+            f"查詢過程中遇到錯誤：{str(e)}。請稍後重試或聯繫管理員。", start_time, error="search_failed"
+        ))
+    retrieval_ms = (time.time() - start_time) * 1000
+    
+    # 沒有足夠相關的內容時不調用 LLM
+    if not search_results:
+        return sse_response(sse_notice("抱歉，在您的文檔中沒有找到相關信息。請先上傳一些文檔。", start_time))
+    
+    # 提取最相關的上下文文檔（配置了重排模型時已按交叉編碼器分數排序）
+    context_results = search_results[:2]
+    usage = {}
+    answer_generator = user_kb_system.query_user_with_llm(
+        user_id=current_user.id,
+        query=request.query,
+        context_docs=[result['content'] for result in context_results],
+        db_session=db,
+        conversation_history=request.conversation_history,
+        usage=usage
+    )
+    
+    async def generate_events():
+        # 引用來源在調用 LLM 之前發送，客戶端可以先顯示檢索結果
+        sources = [source_info(result) for result in context_results]
+        yield sse_event("sources", sources)
         
-        if not search_results:
-            return {
-                "query": request.query,
-                "answer": "抱歉，在您的文檔中沒有找到相關信息。請先上傳一些文檔。",
-                "sources": [],
-                "processing_time": time.time() - start_time,
-                "ai_enabled": True
-            }
-        
-        # 提取最相關的上下文文檔
-        context_docs = [result['content'] for result in search_results[:2]]
-        
-        # 使用 LLM 生成回答 (現在是生成器)
-        answer_generator = user_kb_system.query_user_with_llm(
-            user_id=current_user.id,
-            query=request.query,
-            context_docs=context_docs,
-            db_session=db,
-            conversation_history=request.conversation_history
-        )
+        generation_started = time.time()
+        first_token_ms = None
+        chunks = []
+        try:
+            async for chunk in answer_generator:
+                if first_token_ms is None:
+                    first_token_ms = (time.time() - start_time) * 1000
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+        except Exception as e:
+            logger.error(f"LLM 調用錯誤: {e}")
+            yield sse_event("error", {"code": "llm_failed", "message": f"基於您的文檔，無法生成回答。錯誤: {str(e)}"})
+        else:
+            # 只緩存完整生成的回答；緩存寫入失敗不影響回答流
+            if cache_context is not None:
+                try:
+                    user_kb_system.answer_cache.store(**cache_context, chunks=chunks, sources=sources, usage=usage)
+                except Exception as e:
+                    logger.error(f"寫入答案緩存失敗: {e}")
         
-        # 將生成器包裝在 StreamingResponse 中
-        async def generate_response():
-            full_answer = ""
-            for chunk in answer_generator:
-                full_answer += chunk
-                yield chunk.encode("utf-8") # 將每個塊編碼為字節
-            
-            # 在流結束時發送額外信息 (例如 sources, processing_time)
-            # 這需要前端能夠解析這些額外信息
-            # 這裡為了簡化，先只發送答案，後續可以考慮更複雜的協議
-            # yield f"\n\nSOURCES: {json.dumps(search_results)}\nPROCESSING_TIME: {time.time() - start_time}".encode("utf-8")
-
-        return StreamingResponse(generate_response(), media_type="text/event-stream")
+        if usage:
+            usage.setdefault("total_tokens", usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+            yield sse_event("usage", usage)
+        processing_time = time.time() - start_time
+        yield sse_event("timing", {
+            "retrieval_ms": round(retrieval_ms, 1),
+            "first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "generation_ms": round((time.time() - generation_started) * 1000, 1),
+            "total_ms": round(processing_time * 1000, 1)
+        })
+        yield sse_event("done", {"processing_time": processing_time, "cached": False})
+    
+    return sse_response(generate_events())
 
-    except Exception as e:
-        return {
-            "query": request.query,
-            "answer": f"查詢過程中遇到錯誤：{str(e)}。請稍後重試或聯繫管理員。",
-            "sources": [],
-            "processing_time": time.time() - start_time,
-            "ai_enabled": True,
-            "error": str(e)
-        }
+@app.get("/jobs/{job_id}", response_model=IngestionJobInfo)
+async def get_ingestion_job_status(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """查詢文檔索引任務狀態 (需要認證)"""
+    job = get_ingestion_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="索引任務不存在")
+    
+    return IngestionJobInfo(
+        id=job.id,
+        document_id=job.document_id,
+        status=job.status,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
+    )
 
 @app.get("/documents", response_model=List[DocumentInfo])
 async def list_user_documents(
@@ -538,7 +976,8 @@ async def list_user_documents(
             filename=doc.original_filename,
             original_filename=doc.original_filename,
             file_size=doc.file_size,
-            upload_time=doc.upload_time
+            upload_time=doc.upload_time,
+            is_indexed=bool(doc.is_indexed)
         )
         for doc in documents
     ]
@@ -553,7 +992,7 @@ async def delete_user_document(
     # 先從數據庫獲取文檔信息
     doc = db.query(Document).filter(
         Document.id == document_id,
-        Document.user_id == current_user.id
+        Document.owner_id == current_user.id
     ).first()
     
     if not doc:
@@ -570,11 +1009,15 @@ async def delete_user_document(
     # 從數據庫刪除記錄
     delete_document(db, document_id, current_user.id)
     
-    # 重建索引
+    # 從索引中移除該文檔的向量
     index_status = "索引未更新"
     if user_kb_system is not None:
         try:
-            user_kb_system.build_user_index(current_user.id)
+            if ingestion_queue is not None:
+                # 與同一用戶的其他索引更新合併寫入
+                await asyncio.wrap_future(ingestion_queue.submit_removal(current_user.id, doc.filename))
+            else:
+                await run_in_threadpool(user_kb_system.remove_document_from_index, current_user.id, doc.filename)
             index_status = "文檔已刪除，AI 索引已更新"
         except Exception as e:
             logger.error(f"索引更新失敗: {e}")
@@ -586,6 +1029,52 @@ async def delete_user_document(
         "ai_enabled": user_kb_system is not None
     }
 
+@app.post("/index/rebuild")
+async def rebuild_user_index(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """完整重建用戶索引 (維護操作，需要認證)"""
+    if user_kb_system is None:
+        raise HTTPException(status_code=503, detail=f"AI 系統不可用: {kb_system_error or '未知錯誤'}")
+    
+    try:
+        if ingestion_queue is not None:
+            # 排在該用戶執行中的索引更新之後，重複點擊合併為一次重建
+            result = await asyncio.wrap_future(ingestion_queue.request_rebuild(current_user.id))
+            rebuilt = result['rebuilt']
+        else:
+            document_ids = {doc.filename: doc.id for doc in get_user_documents(db, current_user.id)}
+            rebuilt = await run_in_threadpool(user_kb_system.build_user_index, current_user.id, document_ids)
+    except Exception as e:
+        logger.error(f"索引重建失敗: {e}")
+        raise HTTPException(status_code=500, detail=f"索引重建失敗: {str(e)}")
+    
+    return {
+        "message": "索引重建完成" if rebuilt else "沒有文檔可建立索引",
+        "rebuilt": rebuilt
+    }
+
+@app.get("/index/report")
+async def get_index_report(
+    queries: int = 100,
+    top_k: int = 10,
+    current_user: User = Depends(get_current_user)
+):
+    """以精確搜索為基準報告用戶索引的召回率和延遲 (維護操作，需要認證)"""
+    if user_kb_system is None:
+        raise HTTPException(status_code=503, detail=f"AI 系統不可用: {kb_system_error or '未知錯誤'}")
+    
+    try:
+        report = await run_in_threadpool(user_kb_system.get_index_report, current_user.id, queries, top_k)
+    except Exception as e:
+        logger.error(f"索引評估失敗: {e}")
+        raise HTTPException(status_code=500, detail=f"索引評估失敗: {str(e)}")
+    
+    if report is None:
+        raise HTTPException(status_code=404, detail="索引尚未建立")
+    return report
+
 @app.get("/status")
 async def get_user_status(
     current_user: User = Depends(get_current_user),
@@ -596,7 +1085,7 @@ async def get_user_status(
     user_documents = get_user_documents(db, current_user.id)
     
     # 檢查 AI 系統狀態
-    ai_status = "ready" if user_kb_system is not None else "unavailable"
+    ai_status = user_kb_system.get_model_status()["state"] if user_kb_system is not None else "unavailable"
     
     # 獲取用戶的默認模型
     default_model_pref = get_user_default_model(db, current_user.id)
@@ -651,12 +1140,22 @@ async def get_user_status(
 @app.get("/health")
 async def health_check():
     """健康檢查 (無需認證)"""
-    return {
-        "status": "healthy", 
+    health = {
+        "status": "healthy",
         "timestamp": datetime.utcnow(),
-        "ai_system": "ready" if user_kb_system is not None else "initializing",
-        "version": "2.0.0"
+        "ai_system": "unavailable",
+        "version": "2.0.0",
+        "startup_seconds": app_ready_seconds
     }
+    if user_kb_system is not None:
+        # 服務啟動後即可響應，ai_system 為 loading 表示嵌入模型仍在後台載入
+        model_status = user_kb_system.get_model_status()
+        health["ai_system"] = model_status["state"]
+        health["models"] = model_status["models"]
+        health["index_cache"] = user_kb_system.get_index_cache_stats()
+        health["embedding"] = user_kb_system.get_embedding_stats()
+        health["answer_cache"] = user_kb_system.answer_cache.stats()
+    return health
 
 # AI模型管理端點
 @app.get("/ai-models", response_model=List[AIModelInfo])
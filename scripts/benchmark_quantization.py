@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+向量量化基準測試
+比較 none / fp16 / int8 / pq 四種存儲方式的索引大小、召回率（重排前後）和查詢延遲
+
+用法:
+    python benchmark_quantization.py [向量數] [維度]      # 使用聚類分佈的合成向量
+    python benchmark_quantization.py --user <用戶ID>      # 使用該用戶索引中的真實向量（從嵌入存儲讀取）
+
+環境變數 INDEX_TYPE / INDEX_NPROBE / INDEX_EF_SEARCH / INDEX_PQ_M / INDEX_RERANK_FACTOR 與服務使用相同的設置
+"""
+
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+try:
+    from scripts.vector_index import QUANTIZATIONS, VectorIndexBuilder
+except ImportError:
+    from vector_index import QUANTIZATIONS, VectorIndexBuilder
+
+N_QUERIES = 200
+TOP_K = 10
+
+
+def synthetic_vectors(n_vectors: int, dimension: int) -> np.ndarray:
+    """生成帶聚類結構的歸一化向量，比均勻隨機向量更接近真實文本嵌入"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(max(1, n_vectors // 100), dimension)).astype('float32')
+    vectors = centers[rng.integers(len(centers), size=n_vectors)]
+    vectors += rng.normal(scale=0.3, size=vectors.shape).astype('float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def user_vectors(user_id: int) -> np.ndarray:
+    """讀取用戶索引中全部文本塊的全精度向量"""
+    try:
+        from scripts.user_knowledge_base import UserKnowledgeBaseSystem
+    except ImportError:
+        from user_knowledge_base import UserKnowledgeBaseSystem
+
+    kb = UserKnowledgeBaseSystem()
+    _, chunk_store = kb.load_user_index(user_id)
+    if chunk_store is None:
+        print(f"❌ 用戶 {user_id} 索引尚未建立")
+        sys.exit(1)
+
+    id_start, id_end = kb._vector_id_range(user_id)
+    texts = [chunk_store.get_text(vid) for vid in chunk_store.ids() if id_start <= vid < id_end]
+    return kb._encode_documents(texts)
+
+
+def benchmark(vectors: np.ndarray):
+    dimension = vectors.shape[1]
+    vector_ids = np.arange(len(vectors), dtype='int64')
+    rerank_factor = max(1, int(os.getenv("INDEX_RERANK_FACTOR", "4")))
+
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), min(N_QUERIES, len(vectors)), replace=False)]
+    queries = queries + rng.normal(scale=0.05, size=queries.shape).astype('float32')
+    faiss.normalize_L2(queries)
+    top_k = min(TOP_K, len(vectors))
+
+    exact = faiss.IndexFlatIP(dimension)
+    exact.add(vectors)
+    _, exact_ids = exact.search(queries, top_k)
+
+    print(f"向量數 {len(vectors)}，維度 {dimension}，查詢 {len(queries)} 條，recall@{top_k}，重排候選 {rerank_factor}x\n")
+    print(f"{'量化':<6}{'索引':<24}{'字節/向量':>10}{'壓縮比':>8}{'召回率':>10}{'重排後':>10}{'延遲(ms)':>10}{'重排(ms)':>10}")
+
+    baseline_bytes = None
+    for quantization in QUANTIZATIONS:
+        builder = VectorIndexBuilder(
+            dimension,
+            index_type=os.getenv("INDEX_TYPE", "auto"),
+            flat_max_vectors=int(os.getenv("INDEX_FLAT_MAX_VECTORS", "20000")),
+            quantization=quantization,
+            pq_m=int(os.getenv("INDEX_PQ_M", "0")),
+            nprobe=int(os.getenv("INDEX_NPROBE", "16")),
+            ef_search=int(os.getenv("INDEX_EF_SEARCH", "64"))
+        )
+        faiss_index = builder.build(vectors, vector_ids)
+        size_bytes = faiss.serialize_index(faiss_index).nbytes / len(vectors)
+        baseline_bytes = baseline_bytes or size_bytes
+
+        started = time.perf_counter()
+        _, approx_ids = faiss_index.search(queries, top_k)
+        latency = (time.perf_counter() - started) / len(queries) * 1000
+
+        started = time.perf_counter()
+        _, candidate_ids = faiss_index.search(queries, top_k * rerank_factor)
+        reranked_ids = []
+        for query, row in zip(queries, candidate_ids):
+            row = [int(vid) for vid in row if vid >= 0]
+            reranked = builder.rerank_exact(query, row, vectors[row])[:top_k]
+            reranked_ids.append([vid for _, vid in reranked])
+        rerank_latency = (time.perf_counter() - started) / len(queries) * 1000
+
+        recall = np.mean([len(set(a) & set(b)) for a, b in zip(approx_ids.tolist(), exact_ids.tolist())]) / top_k
+        rerank_recall = np.mean([len(set(a) & set(b)) for a, b in zip(reranked_ids, exact_ids.tolist())]) / top_k
+
+        print(f"{builder.encoding_of(faiss_index):<6}{builder.factory_string(len(vectors)):<24}"
+              f"{size_bytes:>10.1f}{baseline_bytes / size_bytes:>7.1f}x"
+              f"{recall:>10.3f}{rerank_recall:>10.3f}{latency:>10.3f}{rerank_latency:>10.3f}")
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--user":
+        vectors = user_vectors(int(sys.argv[2]))
+    else:
+        n_vectors = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+        dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+        vectors = synthetic_vectors(n_vectors, dimension)
+
+    if len(vectors) == 0:
+        print("❌ 沒有可用的向量")
+        sys.exit(1)
+    benchmark(vectors)
+
+
+if __name__ == "__main__":
+    main()
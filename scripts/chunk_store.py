@@ -0,0 +1,171 @@
+"""
+文本塊列式存儲
+以向量 ID 數組、偏移量數組和 UTF-8 文本拼接區保存文本塊及其元數據，整個文件以內存映射方式打開：
+載入時間與文本量無關，搜索時只解碼 top-k 結果，多個工作進程共享同一份頁緩存
+"""
+
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# 文件格式: MAGIC | 頭部長度 (uint32) | JSON 頭部 | ids | text_offsets | meta_offsets | 文本區 | 元數據區
+MAGIC = b"KBCHUNK1"
+_HEADER_LEN = struct.Struct("<I")
+_ALIGN = 8
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class ChunkStore:
+    """只讀的文本塊存儲，按向量 ID 延遲讀取文本和元數據"""
+
+    def __init__(self, path: Path):
+        """
+        以內存映射方式打開存儲文件
+
+        Args:
+            path: write() 生成的存儲文件路徑
+        """
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self._mm.close()
+            raise ValueError(f"無效的文本塊存儲文件: {self.path}")
+
+        header_start = len(MAGIC) + _HEADER_LEN.size
+        (header_len,) = _HEADER_LEN.unpack_from(self._mm, len(MAGIC))
+        header = json.loads(self._mm[header_start:header_start + header_len])
+
+        self.count = header['count']
+        self._ids = self._array(header['ids'], self.count)
+        self._text_offsets = self._array(header['text_offsets'], self.count + 1)
+        self._meta_offsets = self._array(header['meta_offsets'], self.count + 1)
+        self._text_base = header['texts']
+        self._meta_base = header['metadata']
+
+    def _array(self, offset: int, count: int) -> np.ndarray:
+        return np.frombuffer(self._mm, dtype='<i8', count=count, offset=offset)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, vector_id: int) -> bool:
+        return self._row(vector_id) is not None
+
+    def _row(self, vector_id: int) -> Optional[int]:
+        row = int(np.searchsorted(self._ids, vector_id))
+        if row < self.count and self._ids[row] == vector_id:
+            return row
+        return None
+
+    def _text_at(self, row: int) -> str:
+        start = self._text_base + int(self._text_offsets[row])
+        end = self._text_base + int(self._text_offsets[row + 1])
+        return self._mm[start:end].decode('utf-8')
+
+    def _metadata_at(self, row: int) -> Dict:
+        start = self._meta_base + int(self._meta_offsets[row])
+        end = self._meta_base + int(self._meta_offsets[row + 1])
+        return json.loads(self._mm[start:end])
+
+    def get_text(self, vector_id: int) -> Optional[str]:
+        """獲取文本塊內容，ID 不存在時返回 None"""
+        row = self._row(vector_id)
+        return None if row is None else self._text_at(row)
+
+    def get_metadata(self, vector_id: int) -> Optional[Dict]:
+        """獲取文本塊元數據，ID 不存在時返回 None"""
+        row = self._row(vector_id)
+        return None if row is None else self._metadata_at(row)
+
+    def ids(self) -> List[int]:
+        return self._ids.tolist()
+
+    def max_id(self) -> int:
+        return int(self._ids[-1]) if self.count else -1
+
+    def items(self) -> Iterator[Tuple[int, str, Dict]]:
+        """按向量 ID 順序遍歷 (向量 ID, 文本, 元數據)"""
+        for row in range(self.count):
+            yield int(self._ids[row]), self._text_at(row), self._metadata_at(row)
+
+    def to_dicts(self) -> Tuple[Dict[int, str], Dict[int, Dict]]:
+        """解碼全部內容為 {向量 ID: 文本} 和 {向量 ID: 元數據}，用於增量更新後重寫"""
+        documents, metadata = {}, {}
+        for vector_id, text, meta in self.items():
+            documents[vector_id] = text
+            metadata[vector_id] = meta
+        return documents, metadata
+
+    def close(self):
+        # 先釋放引用映射內存的數組，否則 mmap 無法關閉
+        self._ids = self._text_offsets = self._meta_offsets = None
+        self._mm.close()
+
+    @staticmethod
+    def write(path: Path, documents: Dict[int, str], metadata: Dict[int, Dict]):
+        """
+        寫入存儲文件：先寫臨時文件再替換，已打開的舊映射不受影響
+
+        Args:
+            path: 存儲文件路徑
+            documents: {向量 ID: 文本}
+            metadata: {向量 ID: 元數據}，元數據需可 JSON 序列化
+        """
+        path = Path(path)
+        ids = np.array(sorted(documents), dtype='<i8')
+
+        text_parts = [documents[vid].encode('utf-8') for vid in ids.tolist()]
+        meta_parts = [
+            json.dumps(metadata.get(vid, {}), ensure_ascii=False).encode('utf-8')
+            for vid in ids.tolist()
+        ]
+        text_offsets = np.zeros(len(ids) + 1, dtype='<i8')
+        np.cumsum([len(part) for part in text_parts], out=text_offsets[1:])
+        meta_offsets = np.zeros(len(ids) + 1, dtype='<i8')
+        np.cumsum([len(part) for part in meta_parts], out=meta_offsets[1:])
+
+        # 頭部記錄各區段的絕對偏移，先以佔位值估算頭部長度
+        sections = [ids.nbytes, text_offsets.nbytes, meta_offsets.nbytes, int(text_offsets[-1])]
+        header = {'count': len(ids), 'ids': 0, 'text_offsets': 0, 'meta_offsets': 0, 'texts': 0, 'metadata': 0}
+        header_bytes = json.dumps(header).encode('utf-8')
+        while True:
+            offset = _align(len(MAGIC) + _HEADER_LEN.size + len(header_bytes))
+            layout = {}
+            for name, size in zip(['ids', 'text_offsets', 'meta_offsets', 'texts'], sections):
+                layout[name] = offset
+                offset = _align(offset + size)
+            layout['metadata'] = offset
+            new_header_bytes = json.dumps({'count': len(ids), **layout}).encode('utf-8')
+            if len(new_header_bytes) == len(header_bytes):
+                header_bytes = new_header_bytes
+                break
+            header_bytes = new_header_bytes
+
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for name, data in [('ids', ids.tobytes()), ('text_offsets', text_offsets.tobytes()),
+                               ('meta_offsets', meta_offsets.tobytes())]:
+                f.seek(layout[name])
+                f.write(data)
+            f.seek(layout['texts'])
+            f.writelines(text_parts)
+            f.seek(layout['metadata'])
+            f.writelines(meta_parts)
+            # 空區段不會寫入數據，補齊文件長度使各偏移都落在文件內
+            f.truncate(layout['metadata'] + int(meta_offsets[-1]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -5,7 +5,7 @@
 
 import os
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
@@ -62,6 +62,19 @@ class Document(Base):
     # 關聯關係
     owner = relationship("User", back_populates="documents")
 
+class IngestionJob(Base):
+    """文檔索引任務"""
+    __tablename__ = "ingestion_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
+    status = Column(String(20), default="pending", index=True)  # pending, running, completed, failed
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
 class UserSession(Base):
     """用戶會話模型"""
     __tablename__ = "user_sessions"
@@ -209,6 +222,7 @@ def update_user_password(db: Session, user_id: int, new_password: str) -> bool:
 
 def delete_all_user_documents(db: Session, user_id: int):
     """刪除用戶的所有文檔"""
+    db.query(IngestionJob).filter(IngestionJob.user_id == user_id).delete()
     db.query(Document).filter(Document.owner_id == user_id).delete()
     db.commit()
 
@@ -229,6 +243,37 @@ def create_document(db: Session, filename: str, original_filename: str, file_pat
     db.refresh(db_document)
     return db_document
 
+def create_documents(db: Session, owner_id: int, documents: List[dict],
+                     create_jobs: bool = False) -> List[Tuple[int, Optional[int]]]:
+    """
+    在一個事務中批量創建文檔記錄（及其索引任務）
+
+    Args:
+        documents: 每項包含 filename、original_filename、file_path、file_size、content_type
+        create_jobs: 是否同時為每個文檔創建待執行的索引任務
+
+    Returns:
+        [(文檔 ID, 索引任務 ID 或 None)]，順序與 documents 一致
+    """
+    db_documents = [Document(owner_id=owner_id, **document) for document in documents]
+    db.add_all(db_documents)
+    db.flush()  # 取得文檔 ID
+
+    db_jobs = []
+    if create_jobs:
+        db_jobs = [
+            IngestionJob(user_id=owner_id, document_id=document.id, status="pending")
+            for document in db_documents
+        ]
+        db.add_all(db_jobs)
+        db.flush()
+
+    # 提交前記錄 ID，提交後訪問已過期的對象會逐條重新查詢
+    document_ids = [document.id for document in db_documents]
+    job_ids = [job.id for job in db_jobs] if create_jobs else [None] * len(document_ids)
+    db.commit()
+    return list(zip(document_ids, job_ids))
+
 def get_user_documents(db: Session, user_id: int) -> List[Document]:
     """獲取用戶的所有文檔"""
     return db.query(Document).filter(Document.owner_id == user_id).all()
@@ -240,11 +285,61 @@ def delete_document(db: Session, document_id: int, user_id: int) -> bool:
         Document.owner_id == user_id
     ).first()
     if document:
+        db.query(IngestionJob).filter(IngestionJob.document_id == document_id).delete()
         db.delete(document)
         db.commit()
         return True
     return False
 
+def set_document_indexed(db: Session, document_id: int, is_indexed: bool = True) -> bool:
+    """更新文檔的索引狀態"""
+    document = db.query(Document).filter(Document.id == document_id).first()
+    if document:
+        document.is_indexed = is_indexed
+        db.commit()
+        return True
+    return False
+
+# 索引任務相關函數
+def create_ingestion_job(db: Session, user_id: int, document_id: int) -> IngestionJob:
+    """創建文檔索引任務"""
+    db_job = IngestionJob(
+        user_id=user_id,
+        document_id=document_id,
+        status="pending"
+    )
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def get_ingestion_job(db: Session, job_id: int, user_id: int) -> Optional[IngestionJob]:
+    """獲取用戶的索引任務"""
+    return db.query(IngestionJob).filter(
+        IngestionJob.id == job_id,
+        IngestionJob.user_id == user_id
+    ).first()
+
+def get_unfinished_ingestion_jobs(db: Session) -> List[IngestionJob]:
+    """獲取所有未完成的索引任務（用於服務重啟後恢復）"""
+    return db.query(IngestionJob).filter(
+        IngestionJob.status.in_(["pending", "running"])
+    ).order_by(IngestionJob.id).all()
+
+def update_ingestion_job_status(db: Session, job_id: int, status: str, error: str = None) -> Optional[IngestionJob]:
+    """更新索引任務狀態"""
+    job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+    if job:
+        job.status = status
+        job.error = error
+        if status == "running":
+            job.started_at = datetime.utcnow()
+        elif status in ("completed", "failed"):
+            job.finished_at = datetime.utcnow()
+        db.commit()
+        db.refresh(job)
+    return job
+
 # AI模型相關函數
 def create_builtin_models(db: Session):
     """創建內建模型"""
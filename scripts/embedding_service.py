@@ -0,0 +1,293 @@
+"""
+查詢嵌入服務
+將並發查詢的嵌入請求合併為小批次，一次前向計算服務多個請求；
+並緩存常見問題的查詢向量，重複提問時無需重新計算
+"""
+
+import logging
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """以最大批次大小和最長等待時間合併嵌入請求"""
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray],
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        """
+        初始化嵌入服務
+
+        Args:
+            encode_fn: 批量生成嵌入向量的函數，返回形狀為 (n, dim) 的數組
+            max_batch_size: 每批最多合併的請求數
+            max_wait_ms: 第一個請求到達後最多等待多久再開始計算
+        """
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._closed = False
+
+        # 指標
+        self._requests = 0
+        self._batches = 0
+        self._max_batch_seen = 0
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._total_encode_time = 0.0
+        self._batch_size_histogram: Dict[int, int] = {}
+
+    def submit(self, text: str) -> Future:
+        """提交一個待嵌入的文本，返回結果為一維向量的 Future"""
+        if self._closed:
+            raise RuntimeError("嵌入服務已關閉")
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future, time.monotonic()))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """同步生成單個文本的嵌入向量"""
+        return self.submit(text).result()
+
+    def shutdown(self):
+        """停止後台線程"""
+        self._closed = True
+        self._queue.put(None)
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取批次大小和排隊等待時間指標"""
+        with self._stats_lock:
+            return {
+                'requests': self._requests,
+                'batches': self._batches,
+                'avg_batch_size': self._requests / self._batches if self._batches else 0.0,
+                'max_batch_size': self._max_batch_seen,
+                'batch_size_histogram': dict(sorted(self._batch_size_histogram.items())),
+                'avg_queue_wait_ms': self._total_queue_wait / self._requests * 1000 if self._requests else 0.0,
+                'max_queue_wait_ms': self._max_queue_wait * 1000,
+                'avg_encode_ms': self._total_encode_time / self._batches * 1000 if self._batches else 0.0,
+                'pending': self._queue.qsize()
+            }
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            # 第一個請求到達後，在等待時間內繼續收集請求直到批次填滿
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            # 異步調用方斷開連接時 Future 已被取消，跳過這些請求
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                # 任何異常都不能終止後台線程，否則之後的嵌入請求會永遠等待
+                logger.error(f"處理嵌入批次失敗: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process_batch(self, batch: List[tuple]):
+        started = time.monotonic()
+        texts = [text for text, _, _ in batch]
+        try:
+            embeddings = np.asarray(self.encode_fn(texts), dtype='float32')
+            if len(embeddings) != len(batch):
+                raise ValueError(f"嵌入結果數 {len(embeddings)} 與請求數 {len(batch)} 不一致")
+        except Exception as e:
+            logger.error(f"批量嵌入失敗: {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future, _), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+        finished = time.monotonic()
+        with self._stats_lock:
+            size = len(batch)
+            self._requests += size
+            self._batches += 1
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._batch_size_histogram[size] = self._batch_size_histogram.get(size, 0) + 1
+            self._total_encode_time += finished - started
+            for _, _, submitted in batch:
+                wait = started - submitted
+                self._total_queue_wait += wait
+                self._max_queue_wait = max(self._max_queue_wait, wait)
+
+
+class QueryEmbeddingCache:
+    """以 (嵌入模型, 規範化查詢) 為鍵的 LRU/TTL 查詢向量緩存，所有用戶共享"""
+
+    def __init__(self, model_name: str, max_entries: int = 10000, ttl_seconds: float = 86400,
+                 persist_path: Optional[str] = None):
+        """
+        初始化緩存
+
+        Args:
+            model_name: 嵌入模型名稱，作為緩存鍵的一部分
+            max_entries: 最多緩存的查詢數，0 表示停用
+            ttl_seconds: 緩存有效期（秒），0 表示永不過期
+            persist_path: 持久化文件路徑 (.npz)，為空時只保存在內存
+        """
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.persist_path = Path(persist_path) if persist_path else None
+
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.persist_path is not None:
+            self.load()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """規範化查詢：統一全半角、大小寫並合併空白"""
+        query = unicodedata.normalize("NFKC", query)
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """獲取緩存的查詢向量，未命中或已過期時返回 None"""
+        key = (self.model_name, self.normalize(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, query: str, embedding: np.ndarray):
+        """放入查詢向量"""
+        if self.max_entries <= 0:
+            return
+
+        key = (self.model_name, self.normalize(query))
+        with self._lock:
+            self._entries[key] = (np.asarray(embedding, dtype='float32'), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取緩存命中統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'persistent': self.persist_path is not None
+            }
+
+    def save(self):
+        """將未過期的緩存寫入磁盤"""
+        if self.persist_path is None:
+            return
+
+        with self._lock:
+            now = time.time()
+            items = [
+                (key, embedding, created_at)
+                for key, (embedding, created_at) in self._entries.items()
+                if not self.ttl or now - created_at <= self.ttl
+            ]
+
+        if not items:
+            return
+
+        try:
+            self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.persist_path.with_name(self.persist_path.name + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    models=np.array([key[0] for key, _, _ in items]),
+                    queries=np.array([key[1] for key, _, _ in items]),
+                    embeddings=np.stack([embedding for _, embedding, _ in items]),
+                    created_at=np.array([created_at for _, _, created_at in items])
+                )
+            tmp_path.replace(self.persist_path)
+            logger.info(f"查詢向量緩存已保存 {len(items)} 條: {self.persist_path}")
+        except Exception as e:
+            logger.error(f"保存查詢向量緩存失敗: {e}")
+
+    def load(self):
+        """從磁盤載入緩存，只保留當前模型且未過期的條目"""
+        if self.persist_path is None or not self.persist_path.exists():
+            return
+
+        try:
+            with np.load(self.persist_path, allow_pickle=False) as data:
+                now = time.time()
+                loaded = 0
+                with self._lock:
+                    for model, query, embedding, created_at in zip(
+                        data['models'], data['queries'], data['embeddings'], data['created_at']
+                    ):
+                        if str(model) != self.model_name:
+                            continue
+                        if self.ttl and now - float(created_at) > self.ttl:
+                            continue
+                        self._entries[(str(model), str(query))] = (embedding.astype('float32'), float(created_at))
+                        loaded += 1
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            logger.info(f"載入查詢向量緩存 {loaded} 條: {self.persist_path}")
+        except Exception as e:
+            logger.error(f"載入查詢向量緩存失敗: {e}")
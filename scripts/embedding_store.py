@@ -0,0 +1,105 @@
+"""
+內容哈希嵌入向量存儲
+以 SHA-256(嵌入模型 + 文本) 為鍵持久化向量，重建索引時只對新增或修改的內容生成嵌入，
+不同用戶上傳的相同內容也只計算一次
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """基於 SQLite 的嵌入向量存儲"""
+
+    # SQLite 單條語句的參數數量上限較低，查詢時分批
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, db_path: Path, model_name: str):
+        """
+        初始化存儲
+
+        Args:
+            db_path: SQLite 文件路徑
+            model_name: 嵌入模型名稱，參與鍵的計算，換模型後不會誤用舊向量
+        """
+        self.db_path = Path(db_path)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "content_hash TEXT PRIMARY KEY, dimension INTEGER NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def content_hash(self, text: str) -> str:
+        """計算文本在當前模型下的內容哈希"""
+        digest = hashlib.sha256()
+        digest.update(self.model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, hashes: Iterable[str], track_stats: bool = True) -> Dict[str, np.ndarray]:
+        """批量獲取已存儲的向量，返回 {內容哈希: 向量}；track_stats 為 False 時不計入命中統計"""
+        hashes = list(dict.fromkeys(hashes))
+        found: Dict[str, np.ndarray] = {}
+
+        with self._lock:
+            for i in range(0, len(hashes), self.QUERY_BATCH_SIZE):
+                batch = hashes[i:i + self.QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT content_hash, vector FROM embeddings WHERE content_hash IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for content_hash, vector in rows:
+                    found[content_hash] = np.frombuffer(vector, dtype='float32')
+
+            if track_stats:
+                self.hits += len(found)
+                self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, items: List[Tuple[str, np.ndarray]]):
+        """批量寫入向量"""
+        if not items:
+            return
+
+        rows = [
+            (content_hash, int(vector.shape[-1]), np.asarray(vector, dtype='float32').tobytes())
+            for content_hash, vector in items
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (content_hash, dimension, vector) VALUES (?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取命中統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,107 @@
+"""
+用戶索引內存緩存
+以 LRU 方式保存已載入的用戶索引，避免每次查詢都從磁盤反序列化
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UserIndexCache:
+    """有內存預算的用戶索引 LRU 緩存"""
+
+    def __init__(self, max_bytes: int):
+        """
+        初始化緩存
+
+        Args:
+            max_bytes: 緩存內存預算（字節），0 表示停用緩存
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int, version: Hashable) -> Optional[Tuple]:
+        """
+        獲取緩存的索引
+
+        Args:
+            user_id: 用戶 ID
+            version: 當前磁盤上索引的版本標識，與緩存不一致時視為失效
+
+        Returns:
+            (faiss_index, documents, metadata)，未命中時返回 None
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry['version'] != version:
+                if entry is not None:
+                    self._remove_locked(user_id)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry['value']
+
+    def put(self, user_id: int, version: Hashable, value: Tuple, size_bytes: int):
+        """放入緩存，超出內存預算時淘汰最久未使用的用戶索引"""
+        if not self.max_bytes:
+            # 緩存已停用
+            return
+        if size_bytes > self.max_bytes:
+            # 單個索引超過整個預算，不緩存
+            logger.debug(f"用戶 {user_id} 索引大小 {size_bytes} 超過緩存預算，不進行緩存")
+            return
+
+        with self._lock:
+            if user_id in self._entries:
+                self._remove_locked(user_id)
+
+            while self._entries and self._current_bytes + size_bytes > self.max_bytes:
+                evicted_user_id, evicted = self._entries.popitem(last=False)
+                self._current_bytes -= evicted['size']
+                self.evictions += 1
+                logger.info(f"索引緩存淘汰用戶 {evicted_user_id}")
+
+            self._entries[user_id] = {'version': version, 'value': value, 'size': size_bytes}
+            self._current_bytes += size_bytes
+
+    def invalidate(self, user_id: int):
+        """使指定用戶的緩存失效"""
+        with self._lock:
+            if user_id in self._entries:
+                self._remove_locked(user_id)
+
+    def clear(self):
+        """清空緩存"""
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取緩存統計信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def _remove_locked(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._current_bytes -= entry['size']
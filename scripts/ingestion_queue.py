@@ -0,0 +1,225 @@
+"""
+後台文檔索引任務隊列
+上傳接口只負責保存文件和創建任務，文本提取、嵌入和索引寫入在後台線程執行。
+同一用戶的索引更新按用戶合併調度：每個用戶最多一個批次在執行、一個批次在等待，
+批量上傳期間到達的任務併入等待中的批次，整批只寫入一次索引
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Set
+
+try:
+    from scripts.database import (
+        Document, IngestionJob, get_unfinished_ingestion_jobs,
+        update_ingestion_job_status, set_document_indexed
+    )
+except ImportError:
+    from database import (
+        Document, IngestionJob, get_unfinished_ingestion_jobs,
+        update_ingestion_job_status, set_document_indexed
+    )
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingBatch:
+    """某個用戶等待執行的索引更新"""
+
+    def __init__(self):
+        self.job_ids: List[int] = []
+        self.removed: List[str] = []
+        self.rebuild = False
+        self.clear = False
+        # 批次執行完成時設置結果，提交到同一批次的請求共享
+        self.future: Future = Future()
+
+
+class IngestionQueue:
+    """以數據庫持久化任務狀態、按用戶合併索引更新的後台索引隊列"""
+
+    def __init__(self, kb_system, session_factory: Callable, max_workers: int = 1, coalesce_ms: float = 200.0):
+        """
+        初始化任務隊列
+
+        Args:
+            kb_system: UserKnowledgeBaseSystem 實例
+            session_factory: 創建數據庫會話的工廠函數
+            max_workers: 後台工作線程數（不同用戶的批次可並行執行）
+            coalesce_ms: 批次開始前等待同一用戶後續請求的時間（毫秒）
+        """
+        self.kb_system = kb_system
+        self.session_factory = session_factory
+        self.coalesce_seconds = max(coalesce_ms, 0.0) / 1000
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingestion")
+        self._lock = threading.Lock()
+        self._pending: Dict[int, _PendingBatch] = {}
+        self._running: Set[int] = set()
+        self._batches = 0
+        self._batched_jobs = 0
+
+    def start(self):
+        """恢復服務重啟前未完成的任務"""
+        db = self.session_factory()
+        try:
+            jobs = get_unfinished_ingestion_jobs(db)
+            for job in jobs:
+                if job.status == "running":
+                    # 上次執行時服務中斷，重新排隊
+                    update_ingestion_job_status(db, job.id, "pending")
+                self.submit(job.id, job.user_id)
+            if jobs:
+                logger.info(f"恢復 {len(jobs)} 個未完成的索引任務")
+        finally:
+            db.close()
+
+    def submit(self, job_id: int, user_id: int) -> Future:
+        """提交索引任務，併入該用戶等待中的批次"""
+        return self._enqueue(user_id, lambda batch: batch.job_ids.append(job_id))
+
+    def submit_many(self, job_ids: List[int], user_id: int) -> Future:
+        """批量提交同一用戶的索引任務，全部併入同一批次"""
+        return self._enqueue(user_id, lambda batch: batch.job_ids.extend(job_ids))
+
+    def submit_removal(self, user_id: int, filename: str) -> Future:
+        """提交文檔移除，與該用戶的其他索引更新合併寫入"""
+        return self._enqueue(user_id, lambda batch: batch.removed.append(filename))
+
+    def request_rebuild(self, user_id: int) -> Future:
+        """請求完整重建用戶索引，重複的請求合併為一次重建"""
+        def mark(batch: _PendingBatch):
+            batch.rebuild = True
+        return self._enqueue(user_id, mark)
+
+    def request_clear(self, user_id: int) -> Future:
+        """
+        請求清除用戶的全部索引數據和文檔文件
+
+        與其他索引更新一樣按用戶排隊，在執行中的批次完成後才清除，不會被其寫回；
+        清除之後到達的上傳仍併入同一批次，在清除後加入索引
+        """
+        def mark(batch: _PendingBatch):
+            batch.clear = True
+            # 清除前等待中的移除已無意義
+            batch.removed.clear()
+        return self._enqueue(user_id, mark)
+
+    def stats(self) -> Dict[str, int]:
+        """獲取調度狀態和合併效果"""
+        with self._lock:
+            return {
+                'running_users': len(self._running),
+                'pending_users': len(self._pending),
+                'pending_jobs': sum(len(batch.job_ids) for batch in self._pending.values()),
+                'batches': self._batches,
+                'batched_jobs': self._batched_jobs
+            }
+
+    def shutdown(self, wait: bool = False):
+        """停止任務隊列，未執行的任務保留在數據庫中，下次啟動時恢復"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _enqueue(self, user_id: int, update: Callable[[_PendingBatch], None]) -> Future:
+        with self._lock:
+            batch = self._pending.get(user_id)
+            if batch is None:
+                batch = self._pending[user_id] = _PendingBatch()
+            update(batch)
+            if user_id not in self._running:
+                # 該用戶沒有執行中的批次時才調度，執行期間到達的請求留在等待批次中
+                self._running.add(user_id)
+                self._executor.submit(self._run_user, user_id)
+            return batch.future
+
+    def _run_user(self, user_id: int):
+        """執行用戶等待中的批次，完成後若又有新的等待批次則重新調度"""
+        try:
+            if self.coalesce_seconds:
+                time.sleep(self.coalesce_seconds)
+            with self._lock:
+                batch = self._pending.pop(user_id, None)
+            if batch is not None:
+                self._run_batch(user_id, batch)
+        finally:
+            with self._lock:
+                rescheduled = False
+                if user_id in self._pending:
+                    # 重新提交而不是在本線程循環，避免單個用戶持續上傳時佔住工作線程
+                    try:
+                        self._executor.submit(self._run_user, user_id)
+                        rescheduled = True
+                    except RuntimeError:
+                        # 隊列已停止，等待中的任務保留在數據庫中，下次啟動時恢復
+                        pass
+                if not rescheduled:
+                    self._running.discard(user_id)
+
+    def _run_batch(self, user_id: int, batch: _PendingBatch):
+        """一次執行用戶的全部等待任務：移除、加入或重建只寫入一次索引"""
+        db = self.session_factory()
+        job_ids = []
+        try:
+            jobs = db.query(IngestionJob).filter(
+                IngestionJob.id.in_(batch.job_ids),
+                IngestionJob.status.in_(("pending", "running"))
+            ).all() if batch.job_ids else []
+
+            documents = {}
+            for job in jobs:
+                document = db.query(Document).filter(Document.id == job.document_id).first()
+                if document is None:
+                    update_ingestion_job_status(db, job.id, "failed", "文檔不存在")
+                    continue
+                update_ingestion_job_status(db, job.id, "running")
+                documents[job.id] = document
+                job_ids.append(job.id)
+
+            if batch.clear:
+                # 保留清除請求之後上傳、已併入本批次的文檔
+                if not self.kb_system.clear_user_data(
+                    user_id, keep_files=[document.file_path for document in documents.values()]
+                ):
+                    raise RuntimeError("清除用戶數據失敗")
+
+            if batch.rebuild:
+                # 完整重建會重新讀取用戶目錄中的全部文檔，已包含本批次的加入和移除
+                rebuilt = self.kb_system.build_user_index(user_id, document_ids={
+                    document.filename: document.id
+                    for document in db.query(Document).filter(Document.owner_id == user_id).all()
+                })
+                indexed = {str(Path(document.file_path)): rebuilt for document in documents.values()}
+            else:
+                indexed = self.kb_system.update_user_index(
+                    user_id,
+                    added=[(document.file_path, document.id) for document in documents.values()],
+                    removed=batch.removed
+                )
+                rebuilt = False
+
+            for job_id, document in documents.items():
+                if indexed.get(str(Path(document.file_path))):
+                    set_document_indexed(db, document.id, True)
+                    update_ingestion_job_status(db, job_id, "completed")
+                    logger.info(f"索引任務 {job_id} 完成: 用戶 {user_id} 文檔 {document.original_filename}")
+                else:
+                    update_ingestion_job_status(db, job_id, "failed", "沒有提取到文本內容")
+
+            with self._lock:
+                self._batches += 1
+                self._batched_jobs += len(documents)
+            if len(documents) > 1:
+                logger.info(f"用戶 {user_id} 的 {len(documents)} 個索引任務合併為一次索引更新")
+            batch.future.set_result({
+                'jobs': len(documents), 'removed': len(batch.removed), 'rebuilt': rebuilt, 'cleared': batch.clear
+            })
+        except Exception as e:
+            logger.error(f"用戶 {user_id} 索引任務 {job_ids} 失敗: {e}")
+            db.rollback()
+            for job_id in job_ids:
+                update_ingestion_job_status(db, job_id, "failed", str(e))
+            batch.future.set_exception(e)
+        finally:
+            db.close()
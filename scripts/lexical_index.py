@@ -0,0 +1,265 @@
+"""
+BM25 詞法索引
+與向量索引並存，彌補向量檢索對產品編號、合同號等精確詞項不敏感的問題。
+倒排表以 numpy 數組按詞項連續存放，增量更新只對新增或變更的文本塊分詞
+"""
+
+import logging
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 英文和數字詞項（保留 ABC-123、v1.2 這類編號的連接符），以及連續的中日韓文字
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_SPLIT_PATTERN = re.compile(r"[-_./:#]")
+
+
+class Tokenizer:
+    """中英文混合分詞：英文按單詞，中文按字符二元組，或在安裝 jieba 時使用 jieba 搜索引擎模式"""
+
+    def __init__(self, mode: str = "bigram"):
+        """
+        Args:
+            mode: bigram（字符二元組）或 jieba，jieba 未安裝時回退為 bigram
+        """
+        self._jieba = None
+        if mode == "jieba":
+            try:
+                import jieba
+                jieba.setLogLevel(logging.WARNING)
+                self._jieba = jieba
+            except ImportError:
+                logger.warning("jieba 未安裝，詞法索引使用字符二元組分詞")
+                mode = "bigram"
+        elif mode != "bigram":
+            raise ValueError(f"不支持的分詞方式: {mode}")
+        self.mode = mode
+
+    def tokenize(self, text: str) -> List[str]:
+        """分詞，全角字符先轉為半角並統一小寫"""
+        tokens = []
+        for match in _TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+            token = match.group()
+            if token[0].isascii():
+                tokens.append(token)
+                # 帶連接符的編號同時索引各部分，查詢只輸入其中一段也能命中
+                parts = _SPLIT_PATTERN.split(token)
+                if len(parts) > 1:
+                    tokens.extend(part for part in parts if part)
+            elif self._jieba is not None:
+                tokens.extend(word for word in self._jieba.cut_for_search(token) if word.strip())
+            elif len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return tokens
+
+
+class LexicalIndex:
+    """
+    BM25 倒排索引
+
+    文本塊按向量 ID 排序存放，倒排表為 (詞項 -> 文本塊行號, 詞頻) 的連續數組；
+    每個文本塊記錄內容指紋，sync() 據此只處理新增、變更和刪除的文本塊
+    """
+
+    def __init__(self, tokenizer: Tokenizer, k1: float = 1.2, b: float = 0.75):
+        self.tokenizer = tokenizer
+        self.k1 = k1
+        self.b = b
+        self.terms: List[str] = []
+        self.vocab: Dict[str, int] = {}
+        self.doc_ids = np.zeros(0, dtype='int64')
+        self.doc_lengths = np.zeros(0, dtype='int32')
+        self.fingerprints = np.zeros(0, dtype='uint32')
+        self.term_offsets = np.zeros(1, dtype='int64')
+        self.posting_rows = np.zeros(0, dtype='int64')
+        self.posting_tfs = np.zeros(0, dtype='int32')
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @staticmethod
+    def fingerprint(text: str) -> int:
+        return zlib.crc32(text.encode('utf-8'))
+
+    def sync(self, documents: Dict[int, str]) -> Tuple[int, int]:
+        """
+        使索引內容與 {向量 ID: 文本} 一致，只對新增或內容變更的文本塊分詞
+
+        Returns:
+            (重新分詞的文本塊數, 移除的文本塊數)
+        """
+        current = dict(zip(self.doc_ids.tolist(), self.fingerprints.tolist()))
+        changed = {}
+        for vector_id, text in documents.items():
+            fingerprint = self.fingerprint(text)
+            if current.get(vector_id) != fingerprint:
+                changed[vector_id] = (text, fingerprint)
+        removed = [vector_id for vector_id in current if vector_id not in documents]
+        if not changed and not removed:
+            return 0, 0
+
+        # 對新增和變更的文本塊分詞
+        new_terms, new_ids, new_tfs = [], [], []
+        new_doc_ids, new_lengths, new_fingerprints = [], [], []
+        for vector_id, (text, fingerprint) in changed.items():
+            counts = Counter(self.tokenizer.tokenize(text))
+            for term, tf in counts.items():
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    term_id = self.vocab[term] = len(self.terms)
+                    self.terms.append(term)
+                new_terms.append(term_id)
+                new_ids.append(vector_id)
+                new_tfs.append(tf)
+            new_doc_ids.append(vector_id)
+            new_lengths.append(sum(counts.values()))
+            new_fingerprints.append(fingerprint)
+
+        stale = np.array(list(changed) + removed, dtype='int64')
+        doc_keep = ~np.isin(self.doc_ids, stale)
+        doc_ids = np.concatenate([self.doc_ids[doc_keep], np.array(new_doc_ids, dtype='int64')])
+        order = np.argsort(doc_ids, kind='stable')
+        old_doc_ids = self.doc_ids
+        self.doc_ids = doc_ids[order]
+        self.doc_lengths = np.concatenate([self.doc_lengths[doc_keep], np.array(new_lengths, dtype='int32')])[order]
+        self.fingerprints = np.concatenate([self.fingerprints[doc_keep], np.array(new_fingerprints, dtype='uint32')])[order]
+
+        # 保留未變更文本塊的倒排項；行號映射是單調的，保留項仍按 (詞項, 行號) 有序
+        keep = doc_keep[self.posting_rows]
+        old_term_ids = np.repeat(np.arange(len(self.term_offsets) - 1, dtype='int64'), np.diff(self.term_offsets))
+        row_map = np.searchsorted(self.doc_ids, old_doc_ids)
+        term_ids = old_term_ids[keep]
+        rows = row_map[self.posting_rows[keep]]
+        tfs = self.posting_tfs[keep]
+
+        # 只對新增的倒排項排序，再按位置插入，避免每次更新都重排全部倒排項
+        n_rows = max(len(self.doc_ids), 1)
+        added_terms = np.array(new_terms, dtype='int64')
+        added_rows = np.searchsorted(self.doc_ids, np.array(new_ids, dtype='int64'))
+        added_keys = added_terms * n_rows + added_rows
+        added_order = np.argsort(added_keys, kind='stable')
+        positions = np.searchsorted(term_ids * n_rows + rows, added_keys[added_order])
+        self._set_postings(
+            np.insert(term_ids, positions, added_terms[added_order]),
+            np.insert(rows, positions, added_rows[added_order]),
+            np.insert(tfs, positions, np.array(new_tfs, dtype='int32')[added_order])
+        )
+        return len(changed), len(removed)
+
+    def _set_postings(self, term_ids: np.ndarray, rows: np.ndarray, tfs: np.ndarray):
+        """以按 (詞項, 行號) 排序的倒排項設置倒排數組，並移除已無任何文本塊包含的詞項"""
+        df = np.bincount(term_ids, minlength=len(self.terms))
+        live = np.flatnonzero(df)
+        if len(live) < len(self.terms):
+            # 詞項按原順序重新編號，倒排項的順序不變
+            self.terms = [self.terms[i] for i in live.tolist()]
+            self.vocab = {term: i for i, term in enumerate(self.terms)}
+            df = df[live]
+
+        self.posting_rows = rows.astype('int64')
+        self.posting_tfs = tfs.astype('int32')
+        self.term_offsets = np.zeros(len(self.terms) + 1, dtype='int64')
+        np.cumsum(df, out=self.term_offsets[1:])
+
+    def search(self, query: str, top_k: int, id_range: Optional[Tuple[int, int]] = None) -> List[Tuple[float, int, float]]:
+        """
+        BM25 搜索
+
+        Args:
+            query: 查詢文本
+            top_k: 返回結果數
+            id_range: 只檢索向量 ID 在 [start, end) 內的文本塊，文檔數、平均長度和文檔頻率也只按該範圍統計，
+                      共享索引中其他用戶的文本塊不影響分數
+
+        Returns:
+            [(BM25 分數, 向量 ID, 命中的查詢詞項比例)]，按分數降序
+        """
+        query_terms = set(self.tokenizer.tokenize(query))
+        term_ids = [self.vocab[term] for term in query_terms if term in self.vocab]
+        if not term_ids or not len(self.doc_ids):
+            return []
+
+        row_start, row_end = 0, len(self.doc_ids)
+        if id_range is not None:
+            # 文本塊按向量 ID 排序，ID 範圍對應連續的行號範圍
+            row_start, row_end = np.searchsorted(self.doc_ids, id_range).tolist()
+
+        n_docs = row_end - row_start
+        if not n_docs:
+            return []
+        avg_length = max(float(self.doc_lengths[row_start:row_end].mean()), 1.0)
+        rows_parts, score_parts = [], []
+        for term_id in term_ids:
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            rows = self.posting_rows[start:end]
+            tfs = self.posting_tfs[start:end].astype('float32')
+            mask = (rows >= row_start) & (rows < row_end)
+            rows, tfs = rows[mask], tfs[mask]
+            if not len(rows):
+                continue
+            df = len(rows)
+            idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[rows] / avg_length)
+            rows_parts.append(rows)
+            score_parts.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not rows_parts:
+            return []
+
+        rows, inverse = np.unique(np.concatenate(rows_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        matched = np.bincount(inverse)
+
+        top = np.argsort(-scores, kind='stable')[:top_k]
+        return [
+            (float(scores[i]), int(self.doc_ids[rows[i]]), float(matched[i]) / len(query_terms))
+            for i in top.tolist()
+        ]
+
+    def nbytes(self) -> int:
+        """倒排數組佔用的內存"""
+        return int(sum(a.nbytes for a in (
+            self.doc_ids, self.doc_lengths, self.fingerprints,
+            self.term_offsets, self.posting_rows, self.posting_tfs
+        )) + sum(len(term) for term in self.terms) * 4)
+
+    def save(self, path: Path):
+        """寫入臨時文件後替換，已載入的舊索引不受影響"""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                tokenizer=np.frombuffer(self.tokenizer.mode.encode('utf-8'), dtype='uint8'),
+                terms=np.frombuffer("\n".join(self.terms).encode('utf-8'), dtype='uint8'),
+                doc_ids=self.doc_ids,
+                doc_lengths=self.doc_lengths,
+                fingerprints=self.fingerprints,
+                term_offsets=self.term_offsets,
+                posting_rows=self.posting_rows,
+                posting_tfs=self.posting_tfs
+            )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path, tokenizer: Tokenizer) -> "LexicalIndex":
+        """載入索引，分詞方式與建立時不同則拋出 ValueError"""
+        index = cls(tokenizer)
+        with np.load(path, allow_pickle=False) as data:
+            mode = data['tokenizer'].tobytes().decode('utf-8')
+            if mode != tokenizer.mode:
+                raise ValueError(f"詞法索引以 {mode} 分詞建立，與當前設置 {tokenizer.mode} 不一致")
+            terms = data['terms'].tobytes().decode('utf-8')
+            index.terms = terms.split("\n") if terms else []
+            index.vocab = {term: i for i, term in enumerate(index.terms)}
+            for name in ('doc_ids', 'doc_lengths', 'fingerprints', 'term_offsets', 'posting_rows', 'posting_tfs'):
+                setattr(index, name, data[name])
+        return index
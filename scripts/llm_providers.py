@@ -0,0 +1,260 @@
+"""
+LLM 提供商調用層
+所有提供商共用按提供商劃分的長連接 httpx.AsyncClient，避免每次提問都重新建立 TCP/TLS 連接
+"""
+
+import os
+import json
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 安裝 h2 後啟用 HTTP/2
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def _provider_setting(provider: str, name: str, default: str) -> str:
+    """讀取提供商設置，LLM_<NAME>_<PROVIDER> 優先於全局的 LLM_<NAME>"""
+    return os.getenv(f"LLM_{name}_{provider.upper()}", os.getenv(f"LLM_{name}", default))
+
+
+class LLMError(Exception):
+    """LLM 調用失敗：未設置 API 密鑰或 API 請求失敗"""
+
+
+class LLMProvider:
+    """OpenAI 兼容的流式聊天接口（如 Google, Microsoft 等）"""
+
+    display_name: Optional[str] = None
+    chat_path = "/chat/completions"
+    # 是否請求在流的最後一個數據塊中返回 token 用量（stream_options.include_usage）
+    stream_usage = False
+
+    def __init__(self, registry: "LLMProviderRegistry"):
+        self.registry = registry
+
+    def get_api_key(self, model_config: Dict) -> Optional[str]:
+        return model_config.get('api_key')
+
+    def build_messages(self, user_id: int, prompt: str, conversation_history: List[dict] = None) -> List[dict]:
+        """構建包含系統提示和最近對話歷史的消息列表"""
+        messages = [
+            {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"}
+        ]
+
+        if conversation_history:
+            for msg in conversation_history[-6:]:
+                if msg.get('role') in ['user', 'assistant']:
+                    messages.append({
+                        "role": msg['role'],
+                        "content": msg['content']
+                    })
+
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def build_headers(self, api_key: str) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+
+    def build_payload(self, model_config: Dict, messages: List[dict]) -> Dict:
+        payload = {
+            "model": model_config['model_id'],
+            "messages": messages,
+            "temperature": 0.7,
+            "stream": True
+        }
+        if self.stream_usage:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def parse_chunk(self, chunk: Dict) -> str:
+        """從流式數據塊中提取文本"""
+        choices = chunk.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def parse_usage(self, chunk: Dict) -> Dict[str, int]:
+        """從流式數據塊中提取 token 用量，沒有時返回空字典"""
+        usage = chunk.get("usage") or {}
+        return {
+            key: usage[key] for key in ("prompt_tokens", "completion_tokens")
+            if isinstance(usage.get(key), int)
+        }
+
+    async def stream_chat(self, user_id: int, prompt: str, model_config: Dict,
+                          conversation_history: List[dict] = None,
+                          usage: Optional[Dict[str, int]] = None) -> AsyncIterator[str]:
+        """
+        調用提供商 API，支持對話歷史，並以流式返回文本
+
+        Args:
+            usage: 提供商返回 token 用量時寫入 prompt_tokens、completion_tokens
+
+        Raises:
+            LLMError: 未設置 API 密鑰或 API 請求失敗
+        """
+        provider_name = model_config['provider']
+        display_name = self.display_name or provider_name
+
+        api_key = self.get_api_key(model_config)
+        if not api_key:
+            raise LLMError(f"未設置 {display_name} API 密鑰")
+
+        client = self.registry.get_client(provider_name)
+        messages = self.build_messages(user_id, prompt, conversation_history)
+
+        try:
+            async with client.stream(
+                "POST",
+                f"{model_config['api_base_url'].rstrip('/')}{self.chat_path}",
+                headers=self.build_headers(api_key),
+                json=self.build_payload(model_config, messages)
+            ) as response:
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    json_data = line[len('data:'):].strip()
+                    if json_data == '[DONE]':
+                        # 不提前退出：響應體讀完後連接才會放回連接池復用，提前關閉響應會斷開連接
+                        continue
+                    try:
+                        chunk = json.loads(json_data)
+                    except json.JSONDecodeError:
+                        logger.warning(f"無法解析 JSON 數據塊: {json_data}")
+                        continue
+                    if usage is not None:
+                        usage.update(self.parse_usage(chunk))
+                    content = self.parse_chunk(chunk)
+                    if content:
+                        yield content
+        except httpx.HTTPError as e:
+            logger.error(f"{display_name} API 調用失敗: {e}")
+            raise LLMError(f"{display_name} API 調用失敗: {e}") from e
+
+
+class DeepSeekProvider(LLMProvider):
+    """DeepSeek API，未設置用戶密鑰時使用 DEEPSEEK_API_KEY"""
+
+    display_name = "DeepSeek"
+    chat_path = "/v1/chat/completions"
+    stream_usage = True
+
+    def get_api_key(self, model_config: Dict) -> Optional[str]:
+        return model_config.get('api_key') or os.getenv("DEEPSEEK_API_KEY")
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI API"""
+
+    display_name = "OpenAI"
+    stream_usage = True
+
+
+class AnthropicProvider(LLMProvider):
+    """Anthropic Claude Messages API"""
+
+    display_name = "Anthropic"
+    chat_path = "/v1/messages"
+
+    def build_messages(self, user_id: int, prompt: str, conversation_history: List[dict] = None) -> List[dict]:
+        messages = []
+        system_message = f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"
+
+        if conversation_history:
+            for msg in conversation_history[-6:]:
+                if msg.get('role') in ['user', 'assistant']:
+                    messages.append({
+                        "role": msg['role'],
+                        "content": msg['content']
+                    })
+
+        if messages:
+            messages.append({"role": "user", "content": prompt})
+        else:
+            messages.append({"role": "user", "content": f"{system_message}\n\n{prompt}"})
+        return messages
+
+    def build_headers(self, api_key: str) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01"
+        }
+
+    def build_payload(self, model_config: Dict, messages: List[dict]) -> Dict:
+        return {
+            "model": model_config['model_id'],
+            "max_tokens": 1000,
+            "messages": messages,
+            "stream": True
+        }
+
+    def parse_chunk(self, chunk: Dict) -> str:
+        # content_block_delta 事件的 delta.text 為增量文本
+        return chunk.get("delta", {}).get("text") or ""
+
+    def parse_usage(self, chunk: Dict) -> Dict[str, int]:
+        # 輸入用量在 message_start 事件中，輸出用量在 message_delta 事件中
+        usage = (chunk.get("message") or {}).get("usage") or chunk.get("usage") or {}
+        parsed = {}
+        if isinstance(usage.get("input_tokens"), int):
+            parsed["prompt_tokens"] = usage["input_tokens"]
+        if isinstance(usage.get("output_tokens"), int) and chunk.get("type") == "message_delta":
+            parsed["completion_tokens"] = usage["output_tokens"]
+        return parsed
+
+
+class LLMProviderRegistry:
+    """管理 LLM 提供商及其共享的連接池"""
+
+    def __init__(self):
+        self._providers: Dict[str, LLMProvider] = {
+            'deepseek': DeepSeekProvider(self),
+            'openai': OpenAIProvider(self),
+            'anthropic': AnthropicProvider(self)
+        }
+        self._default_provider = LLMProvider(self)
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, provider_name: str) -> LLMProvider:
+        """獲取提供商，未知提供商按 OpenAI 兼容接口處理"""
+        return self._providers.get(provider_name, self._default_provider)
+
+    def get_client(self, provider_name: str) -> httpx.AsyncClient:
+        """獲取提供商共享的 HTTP 客戶端，首次使用時創建"""
+        client = self._clients.get(provider_name)
+        if client is None or client.is_closed:
+            client = self._create_client(provider_name)
+            self._clients[provider_name] = client
+        return client
+
+    def _create_client(self, provider_name: str) -> httpx.AsyncClient:
+        max_connections = int(_provider_setting(provider_name, "MAX_CONNECTIONS", "100"))
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=int(_provider_setting(provider_name, "MAX_KEEPALIVE", str(max_connections))),
+            keepalive_expiry=float(_provider_setting(provider_name, "KEEPALIVE_EXPIRY", "60"))
+        )
+        timeout = httpx.Timeout(
+            float(_provider_setting(provider_name, "READ_TIMEOUT", "300")),
+            connect=float(_provider_setting(provider_name, "CONNECT_TIMEOUT", "10"))
+        )
+        logger.info(f"創建 {provider_name} HTTP 連接池: 最大連接數 {max_connections}, HTTP/2 {'啟用' if HTTP2_AVAILABLE else '未啟用'}")
+        return httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits, timeout=timeout)
+
+    async def aclose(self):
+        """關閉所有連接池"""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
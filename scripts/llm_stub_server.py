@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+本地 LLM 模擬服務
+以 OpenAI / DeepSeek / Anthropic 的流式格式返回固定回答，用於在不調用真實 API 的情況下測試問答流程
+
+用法:
+    python llm_stub_server.py [端口] [每個數據塊延遲秒數]
+
+然後在系統設置中新增自定義模型，API 地址填寫 http://127.0.0.1:<端口>
+"""
+
+import sys
+import json
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI(title="LLM 模擬服務")
+
+CHUNK_DELAY = 0.05
+STUB_ANSWER = ["這是", "來自本地", "模擬服務", "的回答。", "問題：", "{question}"]
+
+
+def _last_user_message(payload: dict) -> str:
+    for message in reversed(payload.get("messages", [])):
+        if message.get("role") == "user":
+            return message.get("content", "")[-50:]
+    return ""
+
+
+def _answer_pieces(payload: dict):
+    question = _last_user_message(payload)
+    return [piece.format(question=question) for piece in STUB_ANSWER]
+
+
+def _prompt_tokens(payload: dict) -> int:
+    """以字符數粗略模擬輸入 token 數"""
+    return sum(len(message.get("content", "")) for message in payload.get("messages", []))
+
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI 兼容的流式聊天接口"""
+    payload = await request.json()
+
+    async def stream():
+        pieces = _answer_pieces(payload)
+        for piece in pieces:
+            chunk = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(CHUNK_DELAY)
+        if payload.get("stream_options", {}).get("include_usage"):
+            # 與 OpenAI 一致：用量在 choices 為空的最後一個數據塊中返回
+            usage = {"prompt_tokens": _prompt_tokens(payload), "completion_tokens": len(pieces)}
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    """Anthropic Messages 流式接口"""
+    payload = await request.json()
+
+    async def stream():
+        pieces = _answer_pieces(payload)
+        start = {"type": "message_start", "message": {"usage": {"input_tokens": _prompt_tokens(payload), "output_tokens": 1}}}
+        yield f"event: message_start\ndata: {json.dumps(start)}\n\n"
+        for piece in pieces:
+            chunk = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}
+            yield f"event: content_block_delta\ndata: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(CHUNK_DELAY)
+        delta = {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(pieces)}}
+        yield f"event: message_delta\ndata: {json.dumps(delta)}\n\n"
+        yield "event: message_stop\ndata: {\"type\": \"message_stop\"}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    if len(sys.argv) > 2:
+        CHUNK_DELAY = float(sys.argv[2])
+
+    print(f"🧪 LLM 模擬服務運行於 http://127.0.0.1:{port}")
+    uvicorn.run(app, host="127.0.0.1", port=port)
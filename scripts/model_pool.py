@@ -0,0 +1,152 @@
+"""
+進程內模型池
+嵌入模型和重排模型在後台線程中載入，服務啟動和健康檢查不必等待；
+同一模型在進程內只載入一次，由所有使用方共享，並記錄各模型的載入狀態和耗時
+"""
+
+import inspect
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ModelPool:
+    """按鍵共享已載入模型的模型池"""
+
+    def __init__(self):
+        self._entries: Dict[Hashable, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, key: Hashable, loader: Callable[[], Any]) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    'state': 'pending',
+                    'model': None,
+                    'error': None,
+                    'load_seconds': None,
+                    'loader': loader,
+                    'lock': threading.Lock()
+                }
+            return entry
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        獲取模型，尚未載入時在當前線程載入（其他線程正在載入時等待其完成）
+
+        上次載入失敗時會重新嘗試，失敗則拋出載入時的異常
+        """
+        entry = self._entry(key, loader)
+        if entry['state'] == 'ready':
+            return entry['model']
+
+        with entry['lock']:
+            if entry['state'] != 'ready':
+                self._load(key, entry)
+        return entry['model']
+
+    def preload(self, key: Hashable, loader: Callable[[], Any]) -> threading.Thread:
+        """在後台線程中載入模型"""
+        def run():
+            try:
+                self.get(key, loader)
+            except Exception:
+                # 錯誤已記錄在模型狀態中，使用時會重新嘗試載入
+                pass
+
+        thread = threading.Thread(target=run, name=f"model-preload-{key}", daemon=True)
+        thread.start()
+        return thread
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """獲取已載入完成的模型，尚未就緒時返回 None，不等待"""
+        entry = self._entries.get(key)
+        if entry is None or entry['state'] != 'ready':
+            return None
+        return entry['model']
+
+    def state(self, key: Hashable) -> str:
+        """模型狀態: pending / loading / ready / failed"""
+        entry = self._entries.get(key)
+        return 'pending' if entry is None else entry['state']
+
+    def error(self, key: Hashable) -> Optional[str]:
+        entry = self._entries.get(key)
+        return None if entry is None else entry['error']
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """各模型的載入狀態、耗時和錯誤"""
+        with self._lock:
+            entries = list(self._entries.items())
+        return {
+            "/".join(str(part) for part in key) if isinstance(key, tuple) else str(key): {
+                'state': entry['state'],
+                'load_seconds': entry['load_seconds'],
+                'error': entry['error']
+            }
+            for key, entry in entries
+        }
+
+    def _load(self, key: Hashable, entry: Dict[str, Any]):
+        entry['state'] = 'loading'
+        started = time.perf_counter()
+        logger.info(f"開始載入模型 {key}")
+        try:
+            model = entry['loader']()
+        except Exception as e:
+            entry['state'] = 'failed'
+            entry['error'] = str(e)
+            logger.error(f"模型 {key} 載入失敗: {e}")
+            raise
+
+        entry['model'] = model
+        entry['error'] = None
+        entry['load_seconds'] = round(time.perf_counter() - started, 3)
+        entry['state'] = 'ready'
+        logger.info(f"模型 {key} 載入完成，耗時 {entry['load_seconds']:.2f}s")
+
+
+def _accepts_local_files_only(model_cls) -> bool:
+    """模型類是否支持 local_files_only 參數（sentence-transformers 2.2.2 不支持）"""
+    try:
+        return 'local_files_only' in inspect.signature(model_cls.__init__).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _load_local_first(model_cls, model_name: str, **kwargs):
+    """
+    優先從本地緩存載入，避免每次啟動都向 Hugging Face 查詢模型版本；本地沒有時再下載
+
+    舊版 sentence-transformers 不支持 local_files_only，此時直接載入：
+    其 SentenceTransformer 會先查找自己的緩存目錄，CrossEncoder 則由 transformers 按默認方式解析
+    """
+    if not _accepts_local_files_only(model_cls):
+        logger.debug(f"{model_cls.__name__} 不支持 local_files_only，直接載入模型 {model_name}")
+        return model_cls(model_name, **kwargs)
+    try:
+        return model_cls(model_name, local_files_only=True, **kwargs)
+    except (OSError, ValueError) as e:
+        # 本地緩存中沒有模型時 huggingface_hub / transformers 拋出 OSError 或其子類，其他錯誤直接拋出
+        logger.info(f"本地緩存中沒有可用的模型 {model_name}，從遠端下載: {e}")
+        return model_cls(model_name, **kwargs)
+
+
+def load_sentence_transformer(model_name: str, **kwargs):
+    """載入嵌入模型（sentence-transformers 和 torch 在此才導入，不拖慢服務啟動）"""
+    from sentence_transformers import SentenceTransformer
+    return _load_local_first(SentenceTransformer, model_name, **kwargs)
+
+
+def load_cross_encoder(model_name: str, **kwargs):
+    """載入交叉編碼器重排模型"""
+    from sentence_transformers import CrossEncoder
+    return _load_local_first(CrossEncoder, model_name, **kwargs)
+
+
+# 進程內共享的模型池
+model_pool = ModelPool()
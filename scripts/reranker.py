@@ -0,0 +1,154 @@
+"""
+交叉編碼器重排
+以交叉編碼器（如 bge-reranker）一次批量重新評分檢索候選，只把最相關的少數文本塊交給 LLM；
+按實測的單條評分耗時估算延遲，超出預算時縮減候選數或跳過重排；模型在後台載入，就緒前不重排
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    from scripts.model_pool import load_cross_encoder, model_pool
+except ImportError:
+    from model_pool import load_cross_encoder, model_pool
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    """有延遲預算的交叉編碼器重排器"""
+
+    def __init__(self, model_name: str, max_candidates: int = 20, budget_ms: float = 300.0,
+                 batch_size: int = 32, min_score: Optional[float] = None, device: str = "cpu"):
+        """
+        初始化重排器
+
+        Args:
+            model_name: 交叉編碼器模型名稱
+            max_candidates: 每次最多重排的候選數
+            budget_ms: 重排延遲預算（毫秒），0 表示不限制
+            batch_size: 模型前向計算的批次大小
+            min_score: 重排分數低於該值的文本塊被丟棄（至少保留一條），為 None 時不過濾
+            device: 模型運行設備
+        """
+        self.model_name = model_name
+        self.device = device
+        self.max_candidates = max_candidates
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.min_score = min_score
+
+        # 單條候選評分耗時的指數移動平均，用於估算本次重排延遲
+        self._ms_per_pair: Optional[float] = None
+        self._stats_lock = threading.Lock()
+        self._calls = 0
+        self._skipped = 0
+        self._trimmed = 0
+        self._pairs = 0
+        self._total_ms = 0.0
+
+        self._model_key = ("cross_encoder", model_name, device)
+        model_pool.preload(self._model_key, self._load_model)
+
+    def _load_model(self):
+        model = load_cross_encoder(self.model_name, device=self.device)
+        # 首次前向計算包含初始化開銷，預熱後再開始計時，避免高估延遲
+        model.predict([("預熱", "預熱")], show_progress_bar=False)
+        return model
+
+    def candidate_budget(self, n_candidates: int) -> int:
+        """按延遲預算計算本次可以重排的候選數"""
+        n_candidates = min(n_candidates, self.max_candidates)
+        with self._stats_lock:
+            ms_per_pair = self._ms_per_pair
+        if not self.budget_ms or ms_per_pair is None:
+            return n_candidates
+        return min(n_candidates, int(self.budget_ms / ms_per_pair))
+
+    def rerank(self, query: str, results: List[dict], top_k: int) -> List[dict]:
+        """
+        重排檢索結果
+
+        Args:
+            query: 查詢文本
+            results: 按檢索分數排序的結果，需包含 content 字段
+            top_k: 返回的結果數
+
+        Returns:
+            按重排分數排序的結果（附加 rerank_score 字段），因預算未參與重排的候選按檢索排序補在其後，共 top_k 條
+            （有候選被 min_score 過濾時不補位）；跳過重排時返回原結果的前 top_k 條
+        """
+        model = model_pool.peek(self._model_key)
+        if model is None:
+            # 模型仍在載入或載入失敗，直接使用檢索排序
+            with self._stats_lock:
+                self._skipped += 1
+            return results[:top_k]
+
+        n_pairs = self.candidate_budget(len(results))
+        if n_pairs < 2:
+            # 沒有可比較的候選，或預算內連兩條都無法評分
+            if len(results) >= 2:
+                with self._stats_lock:
+                    self._skipped += 1
+                    # 逐次調低估算，偶發的慢請求不會永久停用重排
+                    if self._ms_per_pair is not None:
+                        self._ms_per_pair *= 0.9
+                logger.info(f"重排預計超出 {self.budget_ms:.0f}ms 預算，直接使用檢索排序")
+            return results[:top_k]
+
+        candidates = results[:n_pairs]
+        started = time.perf_counter()
+        scores = model.predict(
+            [(query, result['content']) for result in candidates],
+            batch_size=self.batch_size,
+            show_progress_bar=False
+        )
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._record(n_pairs, elapsed_ms, trimmed=n_pairs < min(len(results), self.max_candidates))
+
+        reranked = [
+            {**result, 'rerank_score': float(score)}
+            for score, result in sorted(zip(scores, candidates), key=lambda item: -item[0])
+        ]
+        filtered = False
+        if self.min_score is not None:
+            kept = [result for result in reranked if result['rerank_score'] >= self.min_score] or reranked[:1]
+            filtered = len(kept) < len(reranked)
+            reranked = kept
+
+        reranked = reranked[:top_k]
+        if not filtered:
+            # 預算縮減了候選數時，未評分的候選保持檢索排序補足 top_k 條；
+            # 已有候選被 min_score 過濾時不補位，排名更靠後的未評分候選不應取代被模型否定的候選
+            reranked += [dict(result) for result in results[n_pairs:n_pairs + top_k - len(reranked)]]
+        for rank, result in enumerate(reranked, 1):
+            result['rank'] = rank
+        return reranked
+
+    def _record(self, n_pairs: int, elapsed_ms: float, trimmed: bool):
+        with self._stats_lock:
+            ms_per_pair = elapsed_ms / n_pairs
+            self._ms_per_pair = ms_per_pair if self._ms_per_pair is None else 0.8 * self._ms_per_pair + 0.2 * ms_per_pair
+            self._calls += 1
+            self._pairs += n_pairs
+            self._total_ms += elapsed_ms
+            if trimmed:
+                self._trimmed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """獲取重排次數、跳過次數和延遲指標"""
+        with self._stats_lock:
+            return {
+                'model': self.model_name,
+                'state': model_pool.state(self._model_key),
+                'calls': self._calls,
+                'skipped': self._skipped,
+                'trimmed': self._trimmed,
+                'avg_candidates': self._pairs / self._calls if self._calls else 0.0,
+                'avg_latency_ms': self._total_ms / self._calls if self._calls else 0.0,
+                'ms_per_candidate': self._ms_per_pair or 0.0,
+                'budget_ms': self.budget_ms
+            }
@@ -0,0 +1,243 @@
+"""
+文檔文本提取
+提取函數定義在模塊級別，可在進程池中並行執行；大型 PDF 按頁碼範圍拆分到多個進程
+"""
+
+import os
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_FORMATS = ['.txt', '.md', '.pdf', '.docx', '.doc']
+
+
+def extract_pdf_pages(file_path: str, start: int, end: Optional[int] = None) -> Tuple[List[str], int]:
+    """
+    提取 PDF 指定頁碼範圍的文本
+
+    Returns:
+        (每頁文本列表, PDF 總頁數)
+    """
+    import pypdf
+
+    with open(file_path, 'rb') as f:
+        pdf_reader = pypdf.PdfReader(f)
+        total_pages = len(pdf_reader.pages)
+        end = total_pages if end is None else min(end, total_pages)
+        pages = [pdf_reader.pages[i].extract_text() or "" for i in range(start, end)]
+    return pages, total_pages
+
+
+def join_pages(pages: List[str]) -> str:
+    """合併頁面文本，每頁以換行結尾"""
+    return "".join(f"{page}\n" for page in pages)
+
+
+def extract_text(file_path: str) -> str:
+    """從不同格式的文件中提取文本"""
+    file_path = Path(file_path)
+    try:
+        suffix = file_path.suffix.lower()
+
+        if suffix in ['.txt', '.md']:
+            # 純文本文件
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+
+        elif suffix == '.pdf':
+            # PDF 文件
+            try:
+                pages, _ = extract_pdf_pages(str(file_path), 0)
+                return join_pages(pages)
+            except ImportError:
+                logger.error("pypdf 未安裝，無法處理 PDF 文件")
+                return ""
+            except Exception as e:
+                logger.error(f"PDF 文本提取失敗: {e}")
+                return ""
+
+        elif suffix in ['.docx', '.doc']:
+            # Word 文件
+            try:
+                from docx import Document
+                doc = Document(file_path)
+                return "".join(f"{paragraph.text}\n" for paragraph in doc.paragraphs)
+            except ImportError:
+                logger.error("python-docx 未安裝，無法處理 Word 文件")
+                return ""
+            except Exception as e:
+                logger.error(f"Word 文本提取失敗: {e}")
+                return ""
+
+        else:
+            logger.warning(f"不支持的文件格式: {suffix}")
+            return ""
+
+    except Exception as e:
+        logger.error(f"文本提取失敗 {file_path}: {e}")
+        return ""
+
+
+def _extract_task(file_path: str, pdf_pages_per_task: int) -> Tuple[Optional[List[str]], int]:
+    """
+    進程池任務：PDF 只提取第一段頁碼範圍並返回總頁數，其他格式提取全文
+
+    Returns:
+        (PDF 頁面文本列表或 [全文], PDF 總頁數；非 PDF 為 0)，PDF 提取失敗時頁面列表為 None
+    """
+    if Path(file_path).suffix.lower() != '.pdf':
+        return [extract_text(file_path)], 0
+
+    try:
+        return extract_pdf_pages(file_path, 0, pdf_pages_per_task)
+    except ImportError:
+        logger.error("pypdf 未安裝，無法處理 PDF 文件")
+    except Exception as e:
+        logger.error(f"PDF 文本提取失敗 {file_path}: {e}")
+    return None, 0
+
+
+class TextExtractor:
+    """多進程文本提取器，跨文件並行，大型 PDF 再按頁碼範圍並行"""
+
+    def __init__(self, max_workers: Optional[int] = None, pdf_pages_per_task: int = 50):
+        """
+        初始化提取器
+
+        Args:
+            max_workers: 提取進程數，默認為 CPU 核心數，1 表示在當前進程中順序提取
+            pdf_pages_per_task: 大型 PDF 每個子任務處理的頁數
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+        # 只在支持 fork 的平台使用進程池；spawn 和 forkserver 的子進程會重新導入主模塊，
+        # 服務以 python auth_api_server.py 啟動時即在每個子進程中重新初始化 API 服務並載入模型
+        self._mp_context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._mp_context = multiprocessing.get_context("fork")
+        if self._mp_context is None and self.max_workers > 1:
+            logger.info("當前平台不支持 fork，文本提取將在當前進程中順序執行")
+            self.max_workers = 1
+
+    def start(self):
+        """
+        立即創建進程池並 fork 全部工作進程
+
+        應在啟動任何線程（模型載入、嵌入批處理、索引隊列）之前調用：從多線程進程 fork 時，
+        子進程可能繼承其他線程持有的鎖（如導入鎖、內存分配器鎖）而死鎖
+        """
+        if self.max_workers <= 1:
+            return
+        executor = self._get_executor()
+        if executor is not None:
+            # fork 上下文的進程池在首次提交任務時一次創建全部工作進程
+            executor.submit(os.getpid).result()
+
+    def extract(self, file_path: Path) -> str:
+        """提取單個文件的文本"""
+        return self.extract_many([file_path]).get(Path(file_path), "")
+
+    def extract_many(self, file_paths: List[Path]) -> Dict[Path, str]:
+        """並行提取多個文件的文本，返回 {文件路徑: 文本}"""
+        file_paths = [Path(file_path) for file_path in file_paths]
+        results: Dict[Path, str] = {}
+
+        # 純文本讀取很快，不值得進程間傳輸
+        pooled = []
+        for file_path in file_paths:
+            if file_path.suffix.lower() in ['.txt', '.md']:
+                results[file_path] = extract_text(str(file_path))
+            else:
+                pooled.append(file_path)
+
+        if not pooled:
+            return results
+
+        executor = self._get_executor() if self.max_workers > 1 else None
+        if executor is None:
+            for file_path in pooled:
+                results[file_path] = extract_text(str(file_path))
+            return results
+
+        # 第一輪：每個文件一個任務，PDF 只提取前 pdf_pages_per_task 頁並返回總頁數
+        try:
+            first_pass = {
+                file_path: executor.submit(_extract_task, str(file_path), self.pdf_pages_per_task)
+                for file_path in pooled
+            }
+        except BrokenProcessPool as e:
+            self._discard_executor(executor, e)
+            return self.extract_many(file_paths)
+
+        # 第二輪：大型 PDF 的剩餘頁碼範圍分發到多個進程
+        remaining = {}
+        for file_path, future in first_pass.items():
+            try:
+                pages, total_pages = future.result()
+                if pages is None:
+                    results[file_path] = ""
+                    continue
+                remaining[file_path] = (pages, [
+                    executor.submit(extract_pdf_pages, str(file_path), start, start + self.pdf_pages_per_task)
+                    for start in range(self.pdf_pages_per_task, total_pages, self.pdf_pages_per_task)
+                ])
+            except BrokenProcessPool as e:
+                self._discard_executor(executor, e)
+                results[file_path] = extract_text(str(file_path))
+
+        for file_path, (pages, range_futures) in remaining.items():
+            if file_path.suffix.lower() != '.pdf':
+                results[file_path] = pages[0]
+                continue
+            try:
+                for range_future in range_futures:
+                    pages.extend(range_future.result()[0])
+                results[file_path] = join_pages(pages)
+            except BrokenProcessPool as e:
+                self._discard_executor(executor, e)
+                results[file_path] = extract_text(str(file_path))
+            except Exception as e:
+                logger.error(f"PDF 文本提取失敗 {file_path}: {e}")
+                results[file_path] = ""
+
+        return results
+
+    def shutdown(self):
+        """關閉進程池"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        """獲取進程池；尚未創建且當前進程已有其他線程時不再 fork，返回 None 改為順序提取"""
+        with self._executor_lock:
+            if self._executor is None and self.max_workers > 1:
+                if threading.active_count() > 1:
+                    logger.warning("進程中已有其他線程，從多線程進程 fork 可能死鎖，文本提取改為在當前進程中順序執行")
+                    self.max_workers = 1
+                    return None
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._mp_context)
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor, error: Exception):
+        """
+        停用已損壞（工作進程異常退出）的進程池，之後的提取在當前進程中順序執行
+
+        此時服務的其他線程已在運行，不能重新 fork 工作進程
+        """
+        with self._executor_lock:
+            if self._executor is executor:
+                logger.error(f"文本提取進程池已損壞，改為在當前進程中提取: {error}")
+                self._executor = None
+                self.max_workers = 1
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+"""
+文本分塊工具
+按句子邊界將長文檔切分為帶重疊的文本塊，支持中日韓文標點
+"""
+
+import re
+from typing import List, Tuple
+
+# 句末標點（中英文）與換行都視為句子邊界，標點保留在句子末尾
+SENTENCE_BOUNDARY = re.compile(r'[^。！？；!?;…\n]*(?:[。！？；!?;…]+[」』”’）)]*|\n+|$)')
+# 英文句點後接空白時也視為邊界，避免把小數點和縮寫切開
+LATIN_PERIOD_BOUNDARY = re.compile(r'(?<=[a-zA-Z][.])\s+')
+
+
+class TextSplitter:
+    """按句子邊界切分文本，並保留塊在原文中的位置"""
+
+    def __init__(self, chunk_size: int = 500, chunk_overlap: int = 50):
+        """
+        初始化分塊器
+
+        Args:
+            chunk_size: 每個文本塊的最大字符數
+            chunk_overlap: 相鄰文本塊之間重疊的字符數
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size 必須大於 0")
+        if chunk_overlap < 0 or chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap 必須介於 0 和 chunk_size 之間")
+
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def split_sentences(self, text: str) -> List[Tuple[int, int]]:
+        """將文本切分為句子，返回每個句子的 (起始, 結束) 位置"""
+        spans = []
+        for match in SENTENCE_BOUNDARY.finditer(text):
+            start, end = match.span()
+            if start == end:
+                continue
+
+            # 長英文段落再按句點細分
+            segment_start = start
+            for period in LATIN_PERIOD_BOUNDARY.finditer(text, start, end):
+                spans.append((segment_start, period.end()))
+                segment_start = period.end()
+            if segment_start < end:
+                spans.append((segment_start, end))
+
+        return spans
+
+    def split(self, text: str) -> List[Tuple[str, int, int]]:
+        """
+        將文本切分為文本塊
+
+        Returns:
+            [(文本塊, 起始位置, 結束位置), ...]，空白塊會被略過
+        """
+        chunks = []
+        sentences = self._limit_sentence_length(self.split_sentences(text))
+
+        first = 0
+        while first < len(sentences):
+            # 從 first 開始盡量合併句子，直到超過 chunk_size
+            chunk_start = sentences[first][0]
+            last = first
+            while last + 1 < len(sentences) and sentences[last + 1][1] - chunk_start <= self.chunk_size:
+                last += 1
+            chunk_end = sentences[last][1]
+            self._append_chunk(chunks, text, chunk_start, chunk_end)
+
+            if last + 1 >= len(sentences):
+                break
+
+            # 下一塊往回包含末尾 chunk_overlap 個字符內的句子作為重疊
+            next_first = last + 1
+            while (next_first - 1 > first
+                   and chunk_end - sentences[next_first - 1][0] <= self.chunk_overlap
+                   and sentences[last + 1][1] - sentences[next_first - 1][0] <= self.chunk_size):
+                next_first -= 1
+            first = next_first
+
+        return chunks
+
+    def _limit_sentence_length(self, sentences: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """超過 chunk_size 的單個句子按固定長度硬切分"""
+        step = self.chunk_size - self.chunk_overlap
+        limited = []
+        for start, end in sentences:
+            if end - start <= self.chunk_size:
+                limited.append((start, end))
+                continue
+            for piece_start in range(start, end, step):
+                limited.append((piece_start, min(piece_start + self.chunk_size, end)))
+                if piece_start + self.chunk_size >= end:
+                    break
+        return limited
+
+    @staticmethod
+    def _append_chunk(chunks: List[Tuple[str, int, int]], text: str, start: int, end: int):
+        chunk = text[start:end]
+        if chunk.strip():
+            chunks.append((chunk, start, end))
@@ -4,16 +4,49 @@
 """
 
 import os
+import asyncio
+import functools
+import hashlib
+import json
 import logging
+import shutil
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import Dict, Iterable, List, Optional, Sequence, Union
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 import pickle
 
+try:
+    from scripts.answer_cache import SemanticAnswerCache
+    from scripts.chunk_store import ChunkStore
+    from scripts.embedding_service import EmbeddingBatcher, QueryEmbeddingCache
+    from scripts.embedding_store import EmbeddingStore
+    from scripts.index_cache import UserIndexCache
+    from scripts.lexical_index import LexicalIndex, Tokenizer
+    from scripts.llm_providers import LLMProviderRegistry
+    from scripts.model_pool import load_sentence_transformer, model_pool
+    from scripts.reranker import CrossEncoderReranker
+    from scripts.text_extraction import SUPPORTED_FORMATS, TextExtractor
+    from scripts.text_splitter import TextSplitter
+    from scripts.vector_index import VectorIndexBuilder
+except ImportError:
+    from answer_cache import SemanticAnswerCache
+    from chunk_store import ChunkStore
+    from embedding_service import EmbeddingBatcher, QueryEmbeddingCache
+    from embedding_store import EmbeddingStore
+    from index_cache import UserIndexCache
+    from lexical_index import LexicalIndex, Tokenizer
+    from llm_providers import LLMProviderRegistry
+    from model_pool import load_sentence_transformer, model_pool
+    from reranker import CrossEncoderReranker
+    from text_extraction import SUPPORTED_FORMATS, TextExtractor
+    from text_splitter import TextSplitter
+    from vector_index import VectorIndexBuilder
+
 # 載入環境變數
 load_dotenv()
 
@@ -21,9 +54,28 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _fsync_path(path: Path):
+    """將文件或目錄項落盤，不支持對目錄 fsync 的平台（Windows）忽略目錄"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 class UserKnowledgeBaseSystem:
     """支持用戶隔離的企業知識庫系統"""
     
+    # 索引格式版本：1 為未歸一化的原始向量，2 為 L2 歸一化向量（內積即餘弦相似度）
+    INDEX_FORMAT_VERSION = 2
+    # 分塊之前建立的索引以整篇文檔為一條記錄，重新分塊前檢索結果只返回開頭的字符數
+    UNCHUNKED_CONTENT_CHARS = 500
+    
     def __init__(self, 
                  base_docs_folder: str = "user_documents",
                  base_index_path: str = "user_indexes",
@@ -44,16 +96,156 @@ class UserKnowledgeBaseSystem:
         self.base_docs_folder.mkdir(exist_ok=True)
         self.base_index_path.mkdir(exist_ok=True)
         
-        # 初始化嵌入模型
-        logger.info(f"載入嵌入模型: {embed_model_name}")
-        self.embed_model = SentenceTransformer(embed_model_name)
+        # 多進程文本提取：工作進程在啟動模型載入等後台線程之前 fork，不繼承其他線程持有的鎖
+        self.text_extractor = TextExtractor(
+            max_workers=int(os.getenv("EXTRACTION_WORKERS", "0")) or None,
+            pdf_pages_per_task=int(os.getenv("PDF_PAGES_PER_TASK", "50"))
+        )
+        self.text_extractor.start()
         
-        # 模型維度
-        self.dimension = 768  # BGE 模型維度
+        # 嵌入模型在後台線程中載入，初始化和健康檢查不必等待；首次需要嵌入時才等待載入完成
+        self._embed_model_key = ("sentence_transformer", embed_model_name)
+        model_pool.preload(self._embed_model_key, self._load_embed_model)
+        self._dimension: Optional[int] = None
+
+        # 按語料規模選擇向量索引類型，向量維度以嵌入模型實際輸出為準，模型就緒後才創建
+        self._index_builder: Optional[VectorIndexBuilder] = None
+        self._index_builder_options = dict(
+            index_type=os.getenv("INDEX_TYPE", "auto"),
+            flat_max_vectors=int(os.getenv("INDEX_FLAT_MAX_VECTORS", "20000")),
+            ivf_nlist=int(os.getenv("INDEX_IVF_NLIST", "0")),
+            quantization=os.getenv("INDEX_QUANTIZATION") or ("pq" if int(os.getenv("INDEX_PQ_M", "0")) else "none"),
+            pq_m=int(os.getenv("INDEX_PQ_M", "0")),
+            hnsw_m=int(os.getenv("INDEX_HNSW_M", "32")),
+            nprobe=int(os.getenv("INDEX_NPROBE", "16")),
+            ef_search=int(os.getenv("INDEX_EF_SEARCH", "64"))
+        )
+        # 量化索引先取 top_k 的若干倍候選，再以全精度向量重排
+        self.rerank_factor = max(1, int(os.getenv("INDEX_RERANK_FACTOR", "4")))
+
+        # 混合檢索：BM25 詞法索引與向量索引並存，兩路各取 top_k 的若干倍候選，以倒數排名融合 (RRF) 合併
+        self.hybrid_search = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+        self.lexical_tokenizer = Tokenizer(os.getenv("LEXICAL_TOKENIZER", "bigram"))
+        self.hybrid_candidate_factor = max(1, int(os.getenv("HYBRID_CANDIDATE_FACTOR", "4")))
+        self.rrf_k = int(os.getenv("HYBRID_RRF_K", "60"))
+
+        # 可選的交叉編碼器重排（RERANKER_MODEL 留空時停用），在延遲預算內重新評分前 N 個候選
+        self.reranker = None
+        reranker_model = os.getenv("RERANKER_MODEL")
+        if reranker_model:
+            reranker_min_score = os.getenv("RERANKER_MIN_SCORE")
+            self.reranker = CrossEncoderReranker(
+                reranker_model,
+                max_candidates=max(2, int(os.getenv("RERANKER_CANDIDATES", "20"))),
+                budget_ms=float(os.getenv("RERANKER_BUDGET_MS", "300")),
+                batch_size=int(os.getenv("RERANKER_BATCH_SIZE", "32")),
+                min_score=float(reranker_min_score) if reranker_min_score else None
+            )
         
         # 用戶會話緩存
         self.user_sessions = {}
-        
+
+        # 已載入索引的內存緩存 (INDEX_CACHE_MAX_MB=0 停用)
+        index_cache_mb = int(os.getenv("INDEX_CACHE_MAX_MB", "512"))
+        self.index_cache = UserIndexCache(max_bytes=index_cache_mb * 1024 * 1024)
+
+        # 相關度閾值，檢索結果都低於該分數時視為沒有找到相關內容，未設置時不過濾
+        min_score = os.getenv("MIN_RELEVANCE_SCORE")
+        self.min_relevance_score = float(min_score) if min_score else None
+
+        # 文檔分塊設置，語料以中文為主，按中英文句子邊界切分
+        self.text_splitter = TextSplitter(
+            chunk_size=int(os.getenv("CHUNK_SIZE", "500")),
+            chunk_overlap=int(os.getenv("CHUNK_OVERLAP", "50"))
+        )
+        self.embed_batch_size = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+
+        # 以內容哈希持久化的文本塊嵌入向量，所有用戶共享
+        self.embedding_store = EmbeddingStore(
+            self.base_index_path / "embedding_store.sqlite3",
+            embed_model_name
+        )
+
+        # 並發查詢的嵌入請求合併為小批次計算
+        self.embedding_batcher = EmbeddingBatcher(
+            self._encode_queries,
+            max_batch_size=int(os.getenv("EMBED_MAX_BATCH_SIZE", "32")),
+            max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+        )
+
+        # 查詢向量緩存，嵌入與用戶無關，所有用戶共享
+        self.query_embedding_cache = QueryEmbeddingCache(
+            embed_model_name,
+            max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "10000")),
+            ttl_seconds=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400")),
+            persist_path=os.getenv("QUERY_EMBEDDING_CACHE_PATH") or None
+        )
+
+        # 語義答案緩存，同一用戶語料上改寫的重複問題直接重放上次的回答
+        self.answer_cache = SemanticAnswerCache(
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "10000")),
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+        )
+
+        # 向量搜索在專用線程池中執行，不阻塞事件循環
+        self.search_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("SEARCH_WORKERS", "4")),
+            thread_name_prefix="kb-search"
+        )
+
+        # LLM 提供商及其共享的 HTTP 連接池
+        self.llm_providers = LLMProviderRegistry()
+
+        # 索引存儲模式：per_user 每個用戶一個索引；shared 所有用戶的向量按用戶 ID 分片存放在共享索引中，
+        # 向量 ID 高 32 位為用戶 ID，搜索時以 ID 範圍過濾，只返回該用戶的向量
+        self.storage_mode = os.getenv("INDEX_STORAGE_MODE", "per_user")
+        if self.storage_mode not in ("per_user", "shared"):
+            raise ValueError(f"不支持的索引存儲模式: {self.storage_mode}")
+        self.index_shards = int(os.getenv("INDEX_SHARDS", "16"))
+
+        # 索引以代為單位發佈，保留最近幾代供仍在讀取舊代的查詢使用
+        self.keep_generations = max(2, int(os.getenv("INDEX_KEEP_GENERATIONS", "2")))
+
+        # 每個索引（用戶或分片）的寫入鎖，保證增量更新不互相覆蓋
+        self._index_locks: Dict[Union[int, str], threading.RLock] = {}
+        self._index_locks_guard = threading.Lock()
+
+    def _load_embed_model(self):
+        return load_sentence_transformer(self.embed_model_name)
+
+    @property
+    def embed_model(self):
+        """嵌入模型，尚未載入完成時等待"""
+        return model_pool.get(self._embed_model_key, self._load_embed_model)
+
+    @property
+    def dimension(self) -> int:
+        """嵌入向量維度"""
+        if self._dimension is None:
+            self._dimension = self.embed_model.get_sentence_embedding_dimension() or 768
+        return self._dimension
+
+    @property
+    def index_builder(self) -> VectorIndexBuilder:
+        if self._index_builder is None:
+            self._index_builder = VectorIndexBuilder(self.dimension, **self._index_builder_options)
+        return self._index_builder
+
+    def get_model_status(self) -> Dict:
+        """
+        模型就緒狀態
+
+        Returns:
+            {'state': loading / ready / failed, 'error': 嵌入模型載入錯誤, 'models': 各模型載入狀態和耗時}
+        """
+        state = model_pool.state(self._embed_model_key)
+        return {
+            'state': 'loading' if state in ('pending', 'loading') else state,
+            'error': model_pool.error(self._embed_model_key),
+            'models': model_pool.status()
+        }
+
     def get_user_docs_folder(self, user_id: int) -> Path:
         """獲取用戶文檔目錄"""
         user_folder = self.base_docs_folder / f"user_{user_id}"
@@ -66,103 +258,143 @@ class UserKnowledgeBaseSystem:
         index_folder.mkdir(exist_ok=True)
         return index_folder
     
-    def save_user_document(self, user_id: int, filename: str, content: bytes) -> str:
-        """保存用戶文檔"""
-        user_docs_folder = self.get_user_docs_folder(user_id)
-        
+    def get_new_document_path(self, user_id: int, filename: str) -> Path:
+        """為新上傳的文檔生成唯一的保存路徑"""
         # 生成唯一文件名避免衝突
-        file_extension = Path(filename).suffix
         unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = user_docs_folder / unique_filename
+        return self.get_user_docs_folder(user_id) / unique_filename
+    
+    def save_user_document(self, user_id: int, filename: str, content: bytes) -> str:
+        """保存用戶文檔"""
+        file_path = self.get_new_document_path(user_id, filename)
         
         with open(file_path, 'wb') as f:
             f.write(content)
         
-        logger.info(f"用戶 {user_id} 保存文檔: {filename} -> {unique_filename}")
+        logger.info(f"用戶 {user_id} 保存文檔: {filename} -> {file_path.name}")
         return str(file_path)
     
     def extract_text_from_file(self, file_path: Path) -> str:
         """從不同格式的文件中提取文本"""
-        try:
-            suffix = file_path.suffix.lower()
-            
-            if suffix in ['.txt', '.md']:
-                # 純文本文件
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            
-            elif suffix == '.pdf':
-                # PDF 文件
-                try:
-                    import pypdf
-                    with open(file_path, 'rb') as f:
-                        pdf_reader = pypdf.PdfReader(f)
-                        text = ""
-                        for page in pdf_reader.pages:
-                            text += page.extract_text() + "\n"
-                        return text
-                except ImportError:
-                    logger.error("pypdf 未安裝，無法處理 PDF 文件")
-                    return ""
-                except Exception as e:
-                    logger.error(f"PDF 文本提取失敗: {e}")
-                    return ""
-            
-            elif suffix in ['.docx', '.doc']:
-                # Word 文件
-                try:
-                    from docx import Document
-                    doc = Document(file_path)
-                    text = ""
-                    for paragraph in doc.paragraphs:
-                        text += paragraph.text + "\n"
-                    return text
-                except ImportError:
-                    logger.error("python-docx 未安裝，無法處理 Word 文件")
-                    return ""
-                except Exception as e:
-                    logger.error(f"Word 文本提取失敗: {e}")
-                    return ""
-            
-            else:
-                logger.warning(f"不支持的文件格式: {suffix}")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"文本提取失敗 {file_path}: {e}")
-            return ""
+        return self.text_extractor.extract(file_path)
     
+    def _load_document(self, user_id: int, file_path: Path, content: Optional[str] = None) -> Optional[tuple]:
+        """提取單個文檔的文本和元數據，沒有提取到內容時返回 None"""
+        if content is None:
+            content = self._extract_text_cached(user_id, file_path)
+        if not content.strip():  # 確保提取到內容
+            logger.warning(f"用戶 {user_id} 文檔 {file_path.name} 沒有提取到文本內容")
+            return None
+
+        return content, {
+            'filename': file_path.name,
+            'path': str(file_path),
+            'size': len(content),
+            'user_id': user_id
+        }
+
+    def _get_text_cache_file(self, user_id: int, filename: str) -> Path:
+        """獲取文檔提取文本的緩存文件路徑（保存在用戶索引目錄中）"""
+        cache_folder = self.get_user_index_path(user_id) / "extracted"
+        cache_folder.mkdir(exist_ok=True)
+        return cache_folder / f"{hashlib.sha1(filename.encode('utf-8')).hexdigest()}.json"
+
+    def _read_text_cache(self, user_id: int, file_path: Path) -> Optional[str]:
+        """讀取上次提取的文本，文件大小或修改時間已變化時返回 None"""
+        cache_file = self._get_text_cache_file(user_id, file_path.name)
+        if not cache_file.exists():
+            return None
+
+        try:
+            file_stat = file_path.stat()
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached['size'] == file_stat.st_size and cached['mtime_ns'] == file_stat.st_mtime_ns:
+                return cached['text']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"提取文本緩存無效 {cache_file}: {e}")
+        return None
+
+    def _write_text_cache(self, user_id: int, file_path: Path, content: str):
+        """保存提取的文本"""
+        # 只緩存成功提取的內容，解析器缺失等問題修復後可重新提取
+        if not content.strip():
+            return
+
+        file_stat = file_path.stat()
+        cache_file = self._get_text_cache_file(user_id, file_path.name)
+        tmp_file = cache_file.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'filename': file_path.name,
+                'size': file_stat.st_size,
+                'mtime_ns': file_stat.st_mtime_ns,
+                'text': content
+            }, f, ensure_ascii=False)
+        tmp_file.replace(cache_file)
+
+    def _extract_text_cached(self, user_id: int, file_path: Path) -> str:
+        """提取文檔文本，文件大小和修改時間未變時直接讀取上次提取的結果"""
+        content = self._read_text_cache(user_id, file_path)
+        if content is None:
+            content = self.extract_text_from_file(file_path)
+            self._write_text_cache(user_id, file_path, content)
+        return content
+
+    def _remove_text_cache(self, user_id: int, filename: str):
+        """刪除文檔的提取文本緩存"""
+        self._get_text_cache_file(user_id, filename).unlink(missing_ok=True)
+
+    def _prune_text_cache(self, user_id: int, filenames: List[str]):
+        """刪除已不存在的文檔的提取文本緩存"""
+        keep = {self._get_text_cache_file(user_id, filename).name for filename in filenames}
+        cache_folder = self.get_user_index_path(user_id) / "extracted"
+        for cache_file in cache_folder.glob("*.json"):
+            if cache_file.name not in keep:
+                cache_file.unlink(missing_ok=True)
+
     def load_user_documents(self, user_id: int) -> List[Dict]:
         """載入用戶文檔"""
         user_docs_folder = self.get_user_docs_folder(user_id)
         documents = []
         metadata = []
         
-        # 支持的文件格式
-        supported_formats = ['.txt', '.md', '.pdf', '.docx', '.doc']
+        file_paths = [
+            file_path for file_path in user_docs_folder.glob("**/*")
+            if file_path.is_file() and file_path.suffix.lower() in SUPPORTED_FORMATS
+        ]
         
-        for file_path in user_docs_folder.glob("**/*"):
-            if file_path.is_file() and file_path.suffix.lower() in supported_formats:
-                try:
-                    content = self.extract_text_from_file(file_path)
-                    if content.strip():  # 確保提取到內容
-                        documents.append(content)
-                        metadata.append({
-                            'filename': file_path.name,
-                            'path': str(file_path),
-                            'size': len(content),
-                            'user_id': user_id
-                        })
-                        logger.info(f"載入用戶 {user_id} 文檔: {file_path.name}")
-                    else:
-                        logger.warning(f"用戶 {user_id} 文檔 {file_path.name} 沒有提取到文本內容")
-                except Exception as e:
-                    logger.error(f"載入用戶 {user_id} 文檔失敗 {file_path}: {e}")
+        # 先讀取緩存，未命中的文件交給進程池並行提取
+        contents = {file_path: self._read_text_cache(user_id, file_path) for file_path in file_paths}
+        to_extract = [file_path for file_path, content in contents.items() if content is None]
+        if to_extract:
+            logger.info(f"用戶 {user_id} 需要提取 {len(to_extract)} 個文檔的文本")
+            for file_path, content in self.text_extractor.extract_many(to_extract).items():
+                contents[file_path] = content
+                self._write_text_cache(user_id, file_path, content)
+        
+        for file_path in file_paths:
+            try:
+                loaded = self._load_document(user_id, file_path, contents[file_path])
+                if loaded is not None:
+                    content, doc_metadata = loaded
+                    documents.append(content)
+                    metadata.append(doc_metadata)
+                    logger.info(f"載入用戶 {user_id} 文檔: {file_path.name}")
+            except Exception as e:
+                logger.error(f"載入用戶 {user_id} 文檔失敗 {file_path}: {e}")
         
+        self._prune_text_cache(user_id, [file_path.name for file_path in file_paths])
         return documents, metadata
     
-    def build_user_index(self, user_id: int):
-        """為特定用戶建立向量索引"""
+    def build_user_index(self, user_id: int, document_ids: Optional[Dict[str, int]] = None):
+        """
+        為特定用戶完整重建向量索引（維護操作，上傳和刪除請使用增量更新）
+
+        Args:
+            user_id: 用戶 ID
+            document_ids: {保存的文件名: 數據庫文檔 ID}，未提供的文件沿用當前索引中記錄的文檔 ID
+        """
         documents, metadata = self.load_user_documents(user_id)
         
         if not documents:
@@ -171,86 +403,996 @@ class UserKnowledgeBaseSystem:
         
         logger.info(f"開始為用戶 {user_id} 建立向量索引...")
         
-        # 生成文檔嵌入向量
-        embeddings = self.embed_model.encode(documents)
-        embeddings = np.array(embeddings).astype('float32')
+        # 文本塊元數據記錄所屬的數據庫文檔，檢索結果可關聯回文檔
+        known_ids = {**self._indexed_document_ids(user_id), **(document_ids or {})}
+        for doc_metadata in metadata:
+            if doc_metadata['filename'] in known_ids:
+                doc_metadata['document_id'] = known_ids[doc_metadata['filename']]
         
-        # 創建 FAISS 索引
-        faiss_index = faiss.IndexFlatIP(self.dimension)
-        faiss_index.add(embeddings)
+        # 將文檔切分為文本塊，每個文本塊對應一個向量
+        chunk_texts = []
+        chunk_metadata = []
+        for content, doc_metadata in zip(documents, metadata):
+            texts, metas = self._chunk_document(content, doc_metadata)
+            chunk_texts.extend(texts)
+            chunk_metadata.extend(metas)
         
-        # 保存索引和元數據
-        user_index_path = self.get_user_index_path(user_id)
-        index_file = user_index_path / "faiss.index"
-        metadata_file = user_index_path / "metadata.pkl"
-        documents_file = user_index_path / "documents.pkl"
-        
-        faiss.write_index(faiss_index, str(index_file))
-        
-        with open(metadata_file, 'wb') as f:
-            pickle.dump(metadata, f)
+        # 批量生成文本塊嵌入向量
+        embeddings = self._encode_documents(chunk_texts)
         
-        with open(documents_file, 'wb') as f:
-            pickle.dump(documents, f)
+        if self.storage_mode == "shared":
+            # 共享分片中還有其他用戶的向量，只替換該用戶的部分
+            self._replace_user_vectors(user_id, chunk_texts, chunk_metadata, embeddings)
+        else:
+            # 創建以向量 ID 映射的 FAISS 索引，支持增量添加和刪除
+            vector_ids = list(range(len(chunk_texts)))
+            faiss_index = self.index_builder.build(embeddings, np.array(vector_ids, dtype='int64'))
+            
+            with self._get_index_lock(user_id):
+                self._write_user_index(
+                    user_id,
+                    faiss_index,
+                    dict(zip(vector_ids, chunk_texts)),
+                    dict(zip(vector_ids, chunk_metadata))
+                )
         
-        logger.info(f"用戶 {user_id} 索引建立完成，包含 {len(documents)} 個文檔")
+        logger.info(f"用戶 {user_id} 索引建立完成，包含 {len(documents)} 個文檔、{len(chunk_texts)} 個文本塊")
         return True
-    
-    def load_user_index(self, user_id: int) -> tuple:
-        """載入用戶的索引"""
+
+    def _indexed_document_ids(self, user_id: int) -> Dict[str, int]:
+        """從當前發佈的索引中讀取用戶文件對應的數據庫文檔 ID"""
+        index_key = self._index_key(user_id)
+        generation = self._current_generation(index_key)
+        if generation is None:
+            return {}
+        _, chunks_file, _ = self._get_index_files(index_key, generation)
+        if not chunks_file.exists():
+            return {}
+
+        id_start, id_end = self._vector_id_range(user_id)
+        document_ids = {}
+        try:
+            chunk_store = ChunkStore(chunks_file)
+            try:
+                for vector_id, _, meta in chunk_store.items():
+                    if id_start <= vector_id < id_end and meta.get('document_id') is not None:
+                        document_ids[meta['filename']] = meta['document_id']
+            finally:
+                chunk_store.close()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"讀取索引 {index_key} 的文檔 ID 失敗: {e}")
+        return document_ids
+
+    def _replace_user_vectors(self, user_id: int, chunk_texts: List[str], chunk_metadata: List[Dict],
+                              embeddings: np.ndarray):
+        """在共享分片中以新的文本塊替換用戶的全部向量（傳入空列表即移除該用戶）"""
+        index_key = self._index_key(user_id)
+        id_start, id_end = self._vector_id_range(user_id)
+        vector_ids = list(range(id_start, id_start + len(chunk_texts)))
+
+        with self._get_index_lock(index_key):
+            faiss_index, documents, metadata = self._read_user_index_for_update(index_key)
+            if faiss_index is None:
+                if not vector_ids:
+                    return
+                faiss_index = self.index_builder.build(embeddings, np.array(vector_ids, dtype='int64'))
+                documents, metadata = {}, {}
+            else:
+                old_ids = [vid for vid in documents if id_start <= vid < id_end]
+                for vid in old_ids:
+                    documents.pop(vid, None)
+                    metadata.pop(vid, None)
+                if old_ids and self.index_builder.supports_remove(faiss_index):
+                    faiss_index.remove_ids(faiss.IDSelectorRange(id_start, id_end))
+                    old_ids = []
+                if vector_ids:
+                    faiss_index.add_with_ids(embeddings, np.array(vector_ids, dtype='int64'))
+                if old_ids:
+                    # HNSW 不支持刪除，以分片中剩餘的文本塊重建
+                    faiss_index = None
+
+            documents.update(zip(vector_ids, chunk_texts))
+            metadata.update(zip(vector_ids, chunk_metadata))
+            if faiss_index is None or self.index_builder.needs_rebuild(faiss_index):
+                faiss_index = self._rebuild_faiss_index(documents)
+
+            self._write_user_index(index_key, faiss_index, documents, metadata, user_id=user_id)
+
+    def add_document_to_index(self, user_id: int, file_path: str, document_id: Optional[int] = None) -> bool:
+        """
+        將單個新文檔增量加入用戶索引，只對該文檔生成嵌入向量
+
+        Args:
+            user_id: 用戶 ID
+            file_path: 已保存到用戶目錄的文檔路徑
+            document_id: 數據庫中的文檔 ID，記錄在元數據中
+        """
+        return self.update_user_index(user_id, added=[(file_path, document_id)])[str(Path(file_path))]
+
+    def update_user_index(self, user_id: int, added: Sequence[tuple] = (),
+                          removed: Sequence[str] = ()) -> Dict[str, bool]:
+        """
+        批量加入和移除文檔，所有變更合併為一次索引寫入
+
+        Args:
+            user_id: 用戶 ID
+            added: 要加入的 (文檔路徑, 數據庫文檔 ID 或 None)
+            removed: 要移除的文件名
+
+        Returns:
+            {文檔路徑: 是否已加入索引}，沒有提取到文本內容的文檔為 False
+        """
+        for filename in removed:
+            self._remove_text_cache(user_id, filename)
+
+        # 提取、分塊和嵌入計算在鎖外進行，避免阻塞同一用戶的其他更新
+        results = {}
+        new_files, chunk_texts, chunk_metadata = [], [], []
+        for file_path, document_id in added:
+            file_path = Path(file_path)
+            loaded = self._load_document(user_id, file_path)
+            results[str(file_path)] = loaded is not None
+            if loaded is None:
+                continue
+
+            content, doc_metadata = loaded
+            if document_id is not None:
+                doc_metadata['document_id'] = document_id
+            texts, metas = self._chunk_document(content, doc_metadata)
+            new_files.append(file_path.name)
+            chunk_texts.extend(texts)
+            chunk_metadata.extend(metas)
+        if not new_files and not removed:
+            return results
+
+        embeddings = self._encode_documents(chunk_texts)
+
+        index_key = self._index_key(user_id)
+        with self._get_index_lock(index_key):
+            # 需要重新分塊的舊索引不讀取，直接從文檔文件重建
+            rechunk = self._needs_rechunk(index_key)
+            faiss_index, documents, metadata = (None, None, None) if rechunk else self._read_user_index_for_update(index_key)
+            if faiss_index is None and not new_files and not rechunk:
+                return results
+            if rechunk or faiss_index is None or not isinstance(faiss_index, faiss.IndexIDMap2):
+                # 尚未建立索引或為舊格式索引，從文檔文件執行一次完整的分塊重建
+                rebuilt = self.build_user_index(user_id, document_ids={
+                    Path(file_path).name: document_id for file_path, document_id in added if document_id is not None
+                })
+                return {path: indexed and rebuilt for path, indexed in results.items()}
+
+            # 移除已刪除的文件，同名文件重新索引時也先移除舊向量
+            changed = False
+            for filename in list(removed) + new_files:
+                faiss_index, count = self._remove_document_vectors(user_id, faiss_index, documents, metadata, filename)
+                changed = changed or count > 0
+
+            if chunk_texts:
+                id_start, id_end = self._vector_id_range(user_id)
+                first_id = max((vid for vid in documents if id_start <= vid < id_end), default=id_start - 1) + 1
+                vector_ids = list(range(first_id, first_id + len(chunk_texts)))
+                faiss_index.add_with_ids(embeddings, np.array(vector_ids, dtype='int64'))
+                documents.update(zip(vector_ids, chunk_texts))
+                metadata.update(zip(vector_ids, chunk_metadata))
+                changed = True
+
+                # 語料規模跨過分級閾值時改用對應類型的索引
+                if self.index_builder.needs_rebuild(faiss_index):
+                    faiss_index = self._rebuild_faiss_index(documents)
+
+            if changed:
+                self._write_user_index(index_key, faiss_index, documents, metadata, user_id=user_id)
+
+        logger.info(f"用戶 {user_id} 索引已更新：加入 {len(new_files)} 個文檔，移除 {len(removed)} 個文檔")
+        return results
+
+    def remove_document_from_index(self, user_id: int, filename: str) -> bool:
+        """從用戶索引中就地移除指定文檔的向量"""
+        self._remove_text_cache(user_id, filename)
+
+        index_key = self._index_key(user_id)
+        with self._get_index_lock(index_key):
+            if self._needs_rechunk(index_key):
+                # 舊索引沒有分塊，從文檔文件執行一次完整重建
+                return self.build_user_index(user_id)
+            faiss_index, documents, metadata = self._read_user_index_for_update(index_key)
+            if faiss_index is None:
+                return False
+            if not isinstance(faiss_index, faiss.IndexIDMap2):
+                # 舊格式索引不支持按 ID 刪除，執行一次完整重建
+                return self.build_user_index(user_id)
+
+            faiss_index, removed = self._remove_document_vectors(user_id, faiss_index, documents, metadata, filename)
+            if removed:
+                self._write_user_index(index_key, faiss_index, documents, metadata, user_id=user_id)
+
+        logger.info(f"用戶 {user_id} 文檔 {filename} 已從索引移除 {removed} 個向量")
+        return True
+
+    def _remove_document_vectors(self, user_id: int, faiss_index, documents: Dict, metadata: Dict,
+                                 filename: str) -> tuple:
+        """移除用戶指定文件的向量及其文本和元數據，返回 (更新後的索引, 移除數量)"""
+        id_start, id_end = self._vector_id_range(user_id)
+        vector_ids = [
+            vid for vid, meta in metadata.items()
+            if id_start <= vid < id_end and meta.get('filename') == filename
+        ]
+        if not vector_ids:
+            return faiss_index, 0
+
+        for vid in vector_ids:
+            documents.pop(vid, None)
+            metadata.pop(vid, None)
+
+        if self.index_builder.supports_remove(faiss_index) and not self.index_builder.needs_rebuild(faiss_index, len(documents)):
+            faiss_index.remove_ids(np.array(vector_ids, dtype='int64'))
+        else:
+            # HNSW 不支持刪除，或語料縮小到應使用其他索引類型時，以剩餘文本塊重建
+            faiss_index = self._rebuild_faiss_index(documents)
+        return faiss_index, len(vector_ids)
+
+    def _rebuild_faiss_index(self, documents: Dict[int, str]):
+        """以現有文本塊重建 FAISS 索引，嵌入向量從嵌入存儲讀取，無需重新計算"""
+        vector_ids = sorted(documents)
+        embeddings = self._encode_documents([documents[vid] for vid in vector_ids])
+        return self.index_builder.build(embeddings, np.array(vector_ids, dtype='int64'))
+
+    def _chunk_document(self, content: str, doc_metadata: Dict) -> tuple:
+        """將文檔切分為文本塊，元數據中記錄文本塊在原文中的位置"""
+        chunk_texts = []
+        chunk_metadata = []
+        for chunk_index, (chunk, start, end) in enumerate(self.text_splitter.split(content)):
+            chunk_texts.append(chunk)
+            chunk_metadata.append({
+                **doc_metadata,
+                'chunk_index': chunk_index,
+                'chunk_start': start,
+                'chunk_end': end
+            })
+        return chunk_texts, chunk_metadata
+
+    def _encode_documents(self, documents: List[str]) -> np.ndarray:
+        """分批生成文本嵌入向量，已存儲過的內容直接讀取，只對新內容計算"""
+        if not documents:
+            return np.zeros((0, self.dimension), dtype='float32')
+
+        content_hashes = [self.embedding_store.content_hash(text) for text in documents]
+        stored = self.embedding_store.get_many(content_hashes)
+
+        # 相同內容只計算一次
+        missing = {}
+        for content_hash, text in zip(content_hashes, documents):
+            if content_hash not in stored:
+                missing.setdefault(content_hash, text)
+
+        if missing:
+            new_embeddings = self.embed_model.encode(list(missing.values()), batch_size=self.embed_batch_size)
+            new_embeddings = np.array(new_embeddings).astype('float32')
+            new_items = list(zip(missing.keys(), new_embeddings))
+            self.embedding_store.put_many(new_items)
+            stored.update(new_items)
+
+        logger.info(f"嵌入向量: 複用 {len(documents) - len(missing)} 個，新計算 {len(missing)} 個")
+        # 存儲中保留模型的原始輸出，入索引前歸一化
+        return self._normalize(np.stack([stored[content_hash] for content_hash in content_hashes]))
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        """生成一批查詢的嵌入向量"""
+        embeddings = self.embed_model.encode(queries, batch_size=len(queries))
+        return self._normalize(embeddings)
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        """L2 歸一化，使內積索引計算餘弦相似度，分數不受文本長度影響且可跨用戶比較"""
+        embeddings = np.array(embeddings, dtype='float32')
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def _index_key(self, user_id: int) -> Union[int, str]:
+        """用戶向量所在索引的鍵：per_user 模式為用戶 ID，shared 模式為分片名"""
+        if self.storage_mode == "shared":
+            return f"shard_{user_id % self.index_shards}"
+        return user_id
+
+    def _vector_id_range(self, user_id: int) -> tuple:
+        """用戶向量 ID 的範圍 [start, end)，shared 模式以高 32 位區分用戶"""
+        if self.storage_mode == "shared":
+            return user_id << 32, (user_id + 1) << 32
+        return 0, 1 << 62
+
+    def _get_index_lock(self, index_key: Union[int, str]) -> threading.RLock:
+        """獲取索引寫入鎖"""
+        with self._index_locks_guard:
+            return self._index_locks.setdefault(index_key, threading.RLock())
+
+    def _get_index_dir(self, index_key: Union[int, str]) -> Path:
+        """獲取索引目錄：用戶目錄或共享分片目錄"""
+        if isinstance(index_key, int):
+            return self.get_user_index_path(index_key)
+        shard_dir = self.base_index_path / "shared" / index_key
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        return shard_dir
+
+    def _get_index_files(self, index_key: Union[int, str], generation: Optional[int] = None) -> tuple:
+        """
+        獲取某一代索引的文件路徑 (faiss.index, chunks.bin, lexical.npz)
+
+        Args:
+            generation: 索引代號，為 None 時使用清單中當前發佈的一代
+        """
+        if generation is None:
+            generation = self._current_generation(index_key) or 0
+        generation_dir = self._get_generation_dir(index_key, generation)
+        return (
+            generation_dir / "faiss.index",
+            generation_dir / "chunks.bin",
+            generation_dir / "lexical.npz"
+        )
+
+    def _get_generation_dir(self, index_key: Union[int, str], generation: int) -> Path:
+        """獲取某一代索引的目錄，第 0 代為引入分代之前直接寫在索引目錄中的舊索引"""
+        index_dir = self._get_index_dir(index_key)
+        return index_dir if generation == 0 else index_dir / f"gen_{generation}"
+
+    def _get_manifest_file(self, index_key: Union[int, str]) -> Path:
+        """獲取記錄當前索引代號和格式版本的清單文件路徑"""
+        return self._get_index_dir(index_key) / "index.json"
+
+    def _read_manifest(self, index_key: Union[int, str]) -> Optional[Dict]:
+        """讀取索引清單，不存在時返回 None"""
+        try:
+            with open(self._get_manifest_file(index_key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"索引 {index_key} 清單無效: {e}")
+            return None
+
+    def _current_generation(self, index_key: Union[int, str]) -> Optional[int]:
+        """當前發佈的索引代號，尚未建立索引時返回 None"""
+        manifest = self._read_manifest(index_key)
+        if manifest is not None:
+            return manifest.get('generation', 0)
+        # 沒有清單的舊索引，文件直接位於索引目錄中
+        return 0 if (self._get_index_dir(index_key) / "faiss.index").exists() else None
+
+    def _user_generation(self, user_id: int) -> Optional[int]:
+        """
+        用戶向量最近一次變更時的索引代號，用作答案緩存的版本，尚未建立索引時返回 None
+
+        per_user 模式即索引的當前代；shared 模式為清單中該用戶的記錄，同一分片中其他用戶的更新不改變該值，
+        清單中沒有記錄的用戶（引入記錄之前寫入）為 0
+        """
+        index_key = self._index_key(user_id)
+        if isinstance(index_key, int):
+            return self._current_generation(index_key)
+        manifest = self._read_manifest(index_key)
+        if manifest is None:
+            return None
+        return (manifest.get('user_generations') or {}).get(str(user_id), 0)
+
+    def _get_index_format_version(self, index_key: Union[int, str]) -> int:
+        """讀取索引的格式版本，沒有清單文件的舊索引為版本 1"""
+        manifest = self._read_manifest(index_key)
+        return 1 if manifest is None else manifest.get('format_version', 1)
+
+    def _needs_rechunk(self, index_key: Union[int, str]) -> bool:
+        """
+        索引是否需要從文檔文件重新分塊建立：版本 1 的索引（包括由舊版 pkl 轉換的索引）
+        可能以整篇文檔為一條記錄，只重新計算向量無法得到文本塊
+        """
+        manifest = self._read_manifest(index_key)
+        if manifest is None:
+            return self._current_generation(index_key) is not None
+        return manifest.get('format_version', 1) < self.INDEX_FORMAT_VERSION or manifest.get('rechunk', False)
+
+    def _write_user_index(self, index_key: Union[int, str], faiss_index, documents: Dict, metadata: Dict,
+                          user_id: Optional[int] = None):
+        """
+        以新的一代發佈索引：全部文件先寫入臨時目錄並落盤，改名為 gen_N 後再原子替換清單
+
+        讀取方只通過清單定位文件，不會看到寫了一半的索引；替換清單前崩潰時舊的一代保持不變
+
+        Args:
+            user_id: 共享分片中本次變更了向量的用戶，清單中記錄其最近變更的一代，
+                     該用戶的答案緩存以此為版本，不受同一分片中其他用戶更新的影響
+        """
+        index_dir = self._get_index_dir(index_key)
+        current = self._current_generation(index_key)
+        generation = self._next_generation(index_dir, current)
+
+        tmp_dir = index_dir / f"gen_{generation}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+        faiss.write_index(faiss_index, str(tmp_dir / "faiss.index"))
+        ChunkStore.write(tmp_dir / "chunks.bin", documents, metadata)
+        if self.hybrid_search:
+            # 停用混合檢索時新的一代不帶詞法索引，重新啟用時由啟動遷移補建
+            previous = self._get_index_files(index_key, current)[2] if current is not None else None
+            self._update_lexical_index(index_key, documents, previous, tmp_dir / "lexical.npz")
+
+        for file_path in tmp_dir.iterdir():
+            _fsync_path(file_path)
+        generation_dir = self._get_generation_dir(index_key, generation)
+        tmp_dir.rename(generation_dir)
+        _fsync_path(index_dir)
+
+        manifest_file = self._get_manifest_file(index_key)
+        tmp_file = manifest_file.with_suffix(".tmp")
+        manifest = {
+            'format_version': self.INDEX_FORMAT_VERSION,
+            'generation': generation,
+            'index_type': self.index_builder.kind_of(faiss_index),
+            'vectors': int(faiss_index.ntotal)
+        }
+        if not isinstance(index_key, int):
+            user_generations = ((self._read_manifest(index_key) or {}).get('user_generations') or {}).copy()
+            if user_id is not None:
+                user_generations[str(user_id)] = generation
+            manifest['user_generations'] = user_generations
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_file.replace(manifest_file)
+        _fsync_path(index_dir)
+
+        # 新的一代已發佈，舊的緩存不再有效
+        self.index_cache.invalidate(index_key)
+        self.index_cache.invalidate((index_key, "lexical"))
+        self._collect_generations(index_key, generation)
+
+    @staticmethod
+    def _next_generation(index_dir: Path, current: Optional[int]) -> int:
+        """下一代的代號，跳過崩潰後殘留的未發佈目錄"""
+        numbers = [current or 0]
+        for path in index_dir.glob("gen_*"):
+            try:
+                numbers.append(int(path.name[len("gen_"):].split(".")[0]))
+            except ValueError:
+                continue
+        return max(numbers) + 1
+
+    def _collect_generations(self, index_key: Union[int, str], current: int):
+        """
+        清理舊的索引代，保留最近 INDEX_KEEP_GENERATIONS 代供仍在使用舊代的讀取方完成查詢
+
+        已打開的內存映射文件在刪除後仍可讀取；無法刪除時（如 Windows 上文件仍被映射）留待下次清理
+        """
+        index_dir = self._get_index_dir(index_key)
+        oldest_kept = current - self.keep_generations + 1
+        for path in index_dir.glob("gen_*"):
+            name = path.name[len("gen_"):]
+            try:
+                generation = int(name.split(".")[0])
+            except ValueError:
+                continue
+            # 未發佈的臨時目錄是崩潰殘留（寫入方持有索引鎖，不會與正在寫的目錄衝突）
+            if name.endswith(".tmp") or generation < oldest_kept:
+                shutil.rmtree(path, ignore_errors=True)
+
+        if oldest_kept > 0:
+            for name in ("faiss.index", "chunks.bin", "lexical.npz"):
+                try:
+                    (index_dir / name).unlink(missing_ok=True)
+                except OSError:
+                    pass
+
+    def _remove_index(self, index_key: Union[int, str]):
+        """刪除索引：先刪除清單使讀取方不再找到索引，再刪除各代文件"""
+        index_dir = self._get_index_dir(index_key)
+        self._get_manifest_file(index_key).unlink(missing_ok=True)
+        for path in index_dir.glob("gen_*"):
+            shutil.rmtree(path, ignore_errors=True)
+        for name in ("faiss.index", "chunks.bin", "lexical.npz"):
+            (index_dir / name).unlink(missing_ok=True)
+        self.index_cache.invalidate(index_key)
+        self.index_cache.invalidate((index_key, "lexical"))
+
+    def _update_lexical_index(self, index_key: Union[int, str], documents: Dict[int, str],
+                              source_file: Optional[Path], target_file: Path):
+        """
+        按文本塊內容指紋增量更新 BM25 索引，只對新增或變更的文本塊分詞
+
+        Args:
+            source_file: 上一代的詞法索引文件，不存在時重新建立
+            target_file: 更新後寫入的文件，可與 source_file 相同
+        """
+        lexical_index = None
+        if source_file is not None and source_file.exists():
+            try:
+                lexical_index = LexicalIndex.load(source_file, self.lexical_tokenizer)
+            except Exception as e:
+                logger.warning(f"索引 {index_key} 詞法索引無效，重新建立: {e}")
+        if lexical_index is None:
+            lexical_index = LexicalIndex(self.lexical_tokenizer)
+
+        added, removed = lexical_index.sync(documents)
+        if added or removed or source_file is None or not source_file.exists() or source_file == target_file:
+            lexical_index.save(target_file)
+            logger.info(f"索引 {index_key} 詞法索引已更新：重新分詞 {added} 個文本塊，移除 {removed} 個")
+        else:
+            # 內容未變，新的一代直接沿用上一代的文件
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                shutil.copyfile(source_file, target_file)
+
+    def _migrate_legacy_index(self, user_id: int) -> bool:
+        """
+        將舊版 documents.pkl/metadata.pkl 轉換為文本塊存儲（第 0 代），返回是否執行了轉換
+
+        舊版索引以整篇文檔為一條記錄，轉換後只供重建前的查詢使用，清單中標記為待重新分塊，
+        由啟動時的索引升級從文檔文件重新建立
+        """
         user_index_path = self.get_user_index_path(user_id)
-        index_file = user_index_path / "faiss.index"
         metadata_file = user_index_path / "metadata.pkl"
         documents_file = user_index_path / "documents.pkl"
-        
-        if not all([index_file.exists(), metadata_file.exists(), documents_file.exists()]):
-            return None, None, None
-        
-        try:
-            faiss_index = faiss.read_index(str(index_file))
-            
+        _, chunks_file, _ = self._get_index_files(user_id, 0)
+
+        # 先在鎖外檢查，已轉換的索引在查詢路徑上不需要獲取寫入鎖
+        if not (metadata_file.exists() and documents_file.exists()):
+            return False
+
+        with self._get_index_lock(user_id):
+            if chunks_file.exists() or not (metadata_file.exists() and documents_file.exists()):
+                return False
+
             with open(metadata_file, 'rb') as f:
                 metadata = pickle.load(f)
-            
+
             with open(documents_file, 'rb') as f:
                 documents = pickle.load(f)
-            
-            logger.info(f"載入用戶 {user_id} 索引成功")
-            return faiss_index, documents, metadata
-        except Exception as e:
-            logger.error(f"載入用戶 {user_id} 索引失敗: {e}")
+
+            # 舊格式索引以列表保存，向量 ID 即列表位置
+            if isinstance(documents, list):
+                documents = dict(enumerate(documents))
+            if isinstance(metadata, list):
+                metadata = dict(enumerate(metadata))
+
+            ChunkStore.write(chunks_file, documents, metadata)
+            manifest_file = self._get_manifest_file(user_id)
+            tmp_file = manifest_file.with_suffix(".tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'format_version': 1, 'generation': 0, 'rechunk': True}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            tmp_file.replace(manifest_file)
+            metadata_file.unlink()
+            documents_file.unlink()
+
+        logger.info(f"用戶 {user_id} 舊版索引數據已轉換為文本塊存儲，等待重新分塊")
+        return True
+
+    def _read_user_index(self, index_key: Union[int, str], generation: Optional[int] = None) -> tuple:
+        """從磁盤讀取某一代索引（默認為當前發佈的一代），返回 (FAISS 索引, 文本塊存儲)"""
+        if isinstance(index_key, int):
+            self._migrate_legacy_index(index_key)
+        if generation is None:
+            generation = self._current_generation(index_key)
+            if generation is None:
+                return None, None
+        index_file, chunks_file, _ = self._get_index_files(index_key, generation)
+
+        if not (index_file.exists() and chunks_file.exists()):
+            return None, None
+
+        faiss_index = faiss.read_index(str(index_file))
+        self.index_builder.apply_search_params(faiss_index)
+        return faiss_index, ChunkStore(chunks_file)
+
+    def _read_user_index_for_update(self, index_key: Union[int, str]) -> tuple:
+        """讀取索引用於增量更新，返回 (FAISS 索引, {向量 ID: 文本}, {向量 ID: 元數據})"""
+        faiss_index, chunk_store = self._read_user_index(index_key)
+        if faiss_index is None:
             return None, None, None
+
+        documents, metadata = chunk_store.to_dicts()
+        chunk_store.close()
+
+        # 舊格式的向量未歸一化，先以歸一化向量重建，避免同一索引中混用兩種向量；
+        # 用戶索引在此之前已按 _needs_rechunk 從文檔文件重建，這裡只處理共享分片
+        if self._get_index_format_version(index_key) < self.INDEX_FORMAT_VERSION:
+            logger.info(f"索引 {index_key} 格式過舊，以歸一化向量重建")
+            faiss_index = self._rebuild_faiss_index(documents)
+        return faiss_index, documents, metadata
+
+    def _existing_index_keys(self) -> List[Union[int, str]]:
+        """列出磁盤上已有的索引鍵"""
+        if self.storage_mode == "shared":
+            return sorted(path.name for path in (self.base_index_path / "shared").glob("shard_*"))
+
+        index_keys = []
+        for user_index_path in sorted(self.base_index_path.glob("user_*")):
+            try:
+                index_keys.append(int(user_index_path.name[len("user_"):]))
+            except ValueError:
+                continue
+        return index_keys
+
+    def migrate_outdated_indexes(self) -> int:
+        """
+        將所有舊格式的索引升級到當前格式，並為缺少詞法索引的索引補建 BM25 索引；
+        舊格式的用戶索引從文檔文件重新分塊建立，shared 模式下同時導入各用戶原有的獨立索引，返回升級的索引數
+        """
+        migrated = 0
+        if self.storage_mode == "shared":
+            migrated += self._import_per_user_indexes()
+
+        for index_key in self._existing_index_keys():
+            if isinstance(index_key, int):
+                self._migrate_legacy_index(index_key)
+            outdated = self._needs_rechunk(index_key)
+            # 詞法索引不存在或分詞方式已改變時無法載入，需要重新建立
+            missing_lexical = self.hybrid_search and self._load_lexical_index(index_key) is None
+            if not (outdated or missing_lexical):
+                continue
+
+            try:
+                with self._get_index_lock(index_key):
+                    if outdated and isinstance(index_key, int):
+                        # 舊索引可能以整篇文檔為一條記錄，從文檔文件重新分塊建立
+                        if not self.build_user_index(index_key):
+                            logger.warning(f"用戶 {index_key} 的舊索引沒有可重新分塊的文檔文件，保留舊索引")
+                            continue
+                    elif outdated:
+                        faiss_index, documents, metadata = self._read_user_index_for_update(index_key)
+                        if faiss_index is None:
+                            continue
+                        self._write_user_index(index_key, faiss_index, documents, metadata)
+                    else:
+                        # 詞法索引以原子替換的方式補入當前這一代，不影響其他文件
+                        _, chunks_file, lexical_file = self._get_index_files(index_key)
+                        if not chunks_file.exists():
+                            continue
+                        chunk_store = ChunkStore(chunks_file)
+                        documents, _ = chunk_store.to_dicts()
+                        chunk_store.close()
+                        self._update_lexical_index(index_key, documents, lexical_file, lexical_file)
+                        self.index_cache.invalidate((index_key, "lexical"))
+                migrated += 1
+            except Exception as e:
+                logger.error(f"索引 {index_key} 升級失敗: {e}")
+
+        logger.info(f"索引格式升級完成，共升級 {migrated} 個索引")
+        return migrated
+
+    def _import_per_user_indexes(self) -> int:
+        """將 per_user 模式下建立的用戶索引導入共享分片，嵌入向量從嵌入存儲讀取"""
+        imported = 0
+        for user_index_path in sorted(self.base_index_path.glob("user_*")):
+            try:
+                user_id = int(user_index_path.name[len("user_"):])
+            except ValueError:
+                continue
+
+            try:
+                self._migrate_legacy_index(user_id)
+                generation = self._current_generation(user_id)
+                if generation is None:
+                    continue
+                if self._needs_rechunk(user_id):
+                    # 舊索引沒有文本塊，從文檔文件重新分塊寫入共享分片
+                    if self.build_user_index(user_id):
+                        self._remove_index(user_id)
+                        imported += 1
+                    continue
+                _, chunks_file, _ = self._get_index_files(user_id, generation)
+                if not chunks_file.exists():
+                    continue
+
+                chunk_store = ChunkStore(chunks_file)
+                documents, metadata = chunk_store.to_dicts()
+                chunk_store.close()
+
+                vector_ids = sorted(documents)
+                chunk_texts = [documents[vid] for vid in vector_ids]
+                chunk_metadata = [metadata.get(vid, {}) for vid in vector_ids]
+                self._replace_user_vectors(user_id, chunk_texts, chunk_metadata, self._encode_documents(chunk_texts))
+
+                self._remove_index(user_id)
+                imported += 1
+                logger.info(f"用戶 {user_id} 的獨立索引已導入共享分片 {self._index_key(user_id)}")
+            except Exception as e:
+                logger.error(f"用戶 {user_id} 索引導入共享分片失敗: {e}")
+        return imported
+
+    def start_index_migration(self) -> threading.Thread:
+        """在後台線程中升級舊格式索引，不阻塞服務啟動"""
+        thread = threading.Thread(target=self.migrate_outdated_indexes, name="index-migration", daemon=True)
+        thread.start()
+        return thread
+
+    def load_user_index(self, user_id: int) -> tuple:
+        """
+        載入用戶向量所在的索引（優先使用內存緩存），返回 (FAISS 索引, 文本塊存儲)
+
+        shared 模式下返回的是整個分片，搜索時需按 _vector_id_range 過濾
+        """
+        index_key = self._index_key(user_id)
+        if isinstance(index_key, int):
+            self._migrate_legacy_index(index_key)
+
+        # 讀取不需要寫入鎖：清單指向的一代已完整寫入，重建期間繼續使用舊的一代
+        for attempt in range(2):
+            generation = self._current_generation(index_key)
+            if generation is None:
+                return None, None
+
+            # 以索引代號作為緩存版本，發佈新的一代後自動失效
+            cached = self.index_cache.get(index_key, generation)
+            if cached is not None:
+                return cached
+
+            try:
+                faiss_index, chunk_store = self._read_user_index(index_key, generation)
+                if faiss_index is None:
+                    return None, None
+
+                logger.info(f"載入索引 {index_key} 第 {generation} 代成功")
+                # 文本塊存儲以內存映射方式讀取，由操作系統頁緩存管理，只計入 FAISS 索引大小
+                self.index_cache.put(
+                    index_key,
+                    generation,
+                    (faiss_index, chunk_store),
+                    size_bytes=self._get_index_files(index_key, generation)[0].stat().st_size
+                )
+                return faiss_index, chunk_store
+            except FileNotFoundError:
+                # 讀取清單後這一代已被清理，重新讀取清單
+                continue
+            except Exception as e:
+                logger.error(f"載入用戶 {user_id} 索引失敗: {e}")
+                return None, None
+        return None, None
+
+    def _load_lexical_index(self, index_key: Union[int, str]) -> Optional[LexicalIndex]:
+        """載入當前一代的 BM25 詞法索引（優先使用內存緩存），尚未建立時返回 None"""
+        generation = self._current_generation(index_key)
+        if generation is None:
+            return None
+        _, _, lexical_file = self._get_index_files(index_key, generation)
+        try:
+            file_stat = lexical_file.stat()
+        except FileNotFoundError:
+            return None
+
+        # 詞法索引可能由啟動遷移補入當前一代，版本同時包含文件修改時間
+        cache_key = (index_key, "lexical")
+        version = (generation, file_stat.st_mtime_ns, file_stat.st_size)
+        cached = self.index_cache.get(cache_key, version)
+        if cached is not None:
+            return cached
+
+        try:
+            lexical_index = LexicalIndex.load(lexical_file, self.lexical_tokenizer)
+        except Exception as e:
+            logger.warning(f"載入索引 {index_key} 詞法索引失敗，僅使用向量檢索: {e}")
+            return None
+        self.index_cache.put(cache_key, version, lexical_index, size_bytes=lexical_index.nbytes())
+        return lexical_index
+
+    def get_index_report(self, user_id: int, n_queries: int = 100, top_k: int = 10) -> Optional[Dict]:
+        """以 Flat 精確搜索為基準，報告用戶索引在不同搜索參數下的召回率和延遲"""
+        faiss_index, chunk_store = self.load_user_index(user_id)
+        if faiss_index is None or len(chunk_store) == 0:
+            return None
+
+        vector_ids = chunk_store.ids()
+        embeddings = self._encode_documents([chunk_store.get_text(vid) for vid in vector_ids])
+        # 在副本上調整搜索參數，不影響正在使用緩存索引的查詢
+        return self.index_builder.evaluate(
+            faiss.clone_index(faiss_index), embeddings, np.array(vector_ids, dtype='int64'),
+            n_queries=n_queries, top_k=top_k
+        )
+
+    def get_index_cache_stats(self) -> Dict:
+        """獲取索引緩存的命中統計"""
+        return self.index_cache.stats()
     
-    def search_user_documents(self, user_id: int, query: str, top_k: int = 5) -> List[dict]:
-        """搜索用戶的相關文檔"""
-        faiss_index, documents, metadata = self.load_user_index(user_id)
+    def search_user_documents(self, user_id: int, query: str, top_k: int = 5,
+                              min_score: Optional[float] = None, rerank: bool = False) -> List[dict]:
+        """搜索用戶的相關文檔，返回匹配的文本塊；rerank 為 True 且配置了重排模型時以交叉編碼器重排"""
+        query_embedding = self._embed_query(query)
+        return self._search_with_embedding(user_id, query_embedding, top_k, min_score, query, rerank)
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        """生成查詢向量：優先使用緩存，否則與其他並發查詢合併為同一批次計算"""
+        query_embedding = self.query_embedding_cache.get(query)
+        if query_embedding is None:
+            query_embedding = self.embedding_batcher.encode(query)
+            self.query_embedding_cache.put(query, query_embedding)
+        return query_embedding
+
+    async def _aembed_query(self, query: str) -> np.ndarray:
+        """_embed_query 的異步版本，等待批次結果時不佔用線程"""
+        query_embedding = self.query_embedding_cache.get(query)
+        if query_embedding is None:
+            query_embedding = await asyncio.wrap_future(self.embedding_batcher.submit(query))
+            self.query_embedding_cache.put(query, query_embedding)
+        return query_embedding
+
+    def _search_with_embedding(self, user_id: int, query_embedding: np.ndarray, top_k: int,
+                               min_score: Optional[float] = None, query: Optional[str] = None,
+                               rerank: bool = False) -> List[dict]:
+        """
+        以已生成的查詢向量搜索用戶索引，提供查詢文本時與 BM25 詞法檢索結果融合
+
+        Args:
+            min_score: 最低相關度，低於該分數的結果被過濾；為 None 時使用 MIN_RELEVANCE_SCORE
+            query: 查詢文本，用於詞法檢索和重排
+            rerank: 是否以交叉編碼器重排，需配置 RERANKER_MODEL
+        """
+        if rerank and self.reranker is not None and query:
+            # 先取更多候選，重排後保留前 top_k 個
+            results = self._search_with_embedding(
+                user_id, query_embedding, max(top_k, self.reranker.max_candidates), min_score, query
+            )
+            return self.reranker.rerank(query, results, top_k)
+
+        if min_score is None:
+            min_score = self.min_relevance_score
+        faiss_index, chunk_store = self.load_user_index(user_id)
         
         if faiss_index is None:
             logger.error(f"用戶 {user_id} 索引未建立")
             return []
         
-        # 生成查詢向量
-        query_embedding = self.embed_model.encode([query])
-        query_embedding = np.array(query_embedding).astype('float32')
+        # 搜索（持久化緩存中可能有未歸一化的舊查詢向量，這裡統一歸一化）
+        query_embedding = self._normalize(np.asarray(query_embedding).reshape(1, -1))
+        lexical_index = self._load_lexical_index(self._index_key(user_id)) if self.hybrid_search and query else None
+        candidate_k = top_k * self.hybrid_candidate_factor if lexical_index is not None else top_k
+        quantized = self.index_builder.encoding_of(faiss_index) != 'none'
+        search_k = max(top_k * self.rerank_factor if quantized else top_k, candidate_k)
+        id_start, id_end = self._vector_id_range(user_id)
+        if self.storage_mode == "shared":
+            # 共享分片中只搜索該用戶的向量 ID 範圍
+            selector = faiss.IDSelectorRange(id_start, id_end)
+            params = self.index_builder.search_params(faiss_index, selector)
+            scores, indices = faiss_index.search(query_embedding, search_k, params=params)
+        else:
+            scores, indices = faiss_index.search(query_embedding, search_k)
         
-        # 搜索
-        scores, indices = faiss_index.search(query_embedding, top_k)
+        # 再次校驗 ID 範圍，保證不會返回其他用戶的內容
+        candidates = [
+            (float(score), int(idx)) for score, idx in zip(scores[0], indices[0])
+            if id_start <= idx < id_end
+        ]
+        if quantized:
+            candidates = self._rerank_full_precision(query_embedding, candidates, chunk_store)
+        candidates = candidates[:candidate_k]
+
+        lexical_hits = {}
+        if lexical_index is not None:
+            id_range = (id_start, id_end) if self.storage_mode == "shared" else None
+            lexical_results = lexical_index.search(query, candidate_k, id_range)
+            candidates, lexical_hits = self._fuse_results(query_embedding, candidates, lexical_results, chunk_store)
         
         results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(documents):
-                results.append({
-                    'rank': i + 1,
+        for score, idx in candidates[:top_k]:
+            lexical_score, coverage = lexical_hits.get(idx, (0.0, 0.0))
+            # 包含全部查詢詞項的精確匹配（如產品編號）不受相關度閾值限制
+            if min_score is not None and score < min_score and coverage < 1.0:
+                continue
+            # 只解碼命中的文本塊
+            content = chunk_store.get_text(idx)
+            if content is not None:
+                metadata = chunk_store.get_metadata(idx)
+                if 'chunk_start' not in metadata and len(content) > self.UNCHUNKED_CONTENT_CHARS:
+                    # 尚未重新分塊的舊索引，不把整篇文檔交給 LLM
+                    content = content[:self.UNCHUNKED_CONTENT_CHARS] + "..."
+                result = {
+                    'rank': len(results) + 1,
                     'score': float(score),
-                    'content': documents[idx][:500] + "..." if len(documents[idx]) > 500 else documents[idx],
-                    'metadata': metadata[idx] if idx < len(metadata) else {},
+                    'content': content,
+                    'metadata': metadata,
                     'user_id': user_id
-                })
+                }
+                if lexical_index is not None:
+                    result['lexical_score'] = lexical_score
+                results.append(result)
         
         return results
+
+    def _fuse_results(self, query_embedding: np.ndarray, dense: List[tuple], lexical: List[tuple],
+                      chunk_store) -> tuple:
+        """
+        以倒數排名融合 (RRF) 合併向量和 BM25 結果
+
+        Returns:
+            (按融合分數排序的 [(餘弦分數, 向量 ID)], {向量 ID: (BM25 分數, 查詢詞項命中比例)})
+        """
+        fused = {}
+        for rank, (_, idx) in enumerate(dense, 1):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (self.rrf_k + rank)
+        for rank, (_, idx, _) in enumerate(lexical, 1):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (self.rrf_k + rank)
+
+        # 只由詞法檢索命中的文本塊補算餘弦分數，使結果分數和相關度閾值保持同一含義
+        cosine = {idx: score for score, idx in dense}
+        lexical_only = [idx for _, idx, _ in lexical if idx not in cosine]
+        if lexical_only:
+            cosine.update(self._exact_scores(query_embedding, lexical_only, chunk_store))
+
+        ranked = sorted(fused, key=lambda idx: -fused[idx])
+        lexical_hits = {idx: (score, coverage) for score, idx, coverage in lexical}
+        return [(cosine.get(idx, 0.0), idx) for idx in ranked], lexical_hits
+
+    def _exact_scores(self, query_embedding: np.ndarray, vector_ids: List[int], chunk_store) -> Dict[int, float]:
+        """以嵌入存儲中的全精度向量計算文本塊與查詢的相似度，缺少向量的文本塊不在結果中"""
+        hashes = {}
+        for idx in vector_ids:
+            text = chunk_store.get_text(idx)
+            if text is not None:
+                hashes[idx] = self.embedding_store.content_hash(text)
+        stored = self.embedding_store.get_many(hashes.values(), track_stats=False)
+
+        exact_ids = [idx for idx in vector_ids if hashes.get(idx) in stored]
+        if not exact_ids:
+            return {}
+        vectors = self._normalize(np.stack([stored[hashes[idx]] for idx in exact_ids]))
+        return {idx: score for score, idx in self.index_builder.rerank_exact(query_embedding, exact_ids, vectors)}
     
-    def query_user_with_llm(self, user_id: int, query: str, context_docs: List[str], db_session=None, conversation_history: List[dict] = None): # Changed return type to generator
-        """為特定用戶結合檢索結果調用 LLM，使用用戶選擇的模型，支持對話歷史，並以流式返回"""
+    def _rerank_full_precision(self, query_embedding: np.ndarray, candidates: List[tuple], chunk_store) -> List[tuple]:
+        """以全精度向量重新計算量化索引候選結果的分數並排序，缺少全精度向量的候選保留量化分數"""
+        exact = self._exact_scores(query_embedding, [idx for _, idx in candidates], chunk_store)
+        reranked = [(exact.get(idx, score), idx) for score, idx in candidates]
+        return sorted(reranked, key=lambda item: -item[0])
+
+    async def asearch_user_documents(self, user_id: int, query: str, top_k: int = 5,
+                                     min_score: Optional[float] = None, rerank: bool = False) -> List[dict]:
+        """異步搜索：等待批量嵌入結果後，在搜索線程池中執行向量搜索和重排"""
+        query_embedding = await self._aembed_query(query)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.search_executor,
+            functools.partial(self._search_with_embedding, user_id, query_embedding, top_k, min_score, query, rerank)
+        )
+
+    async def aget_answer_cache_context(self, user_id: int, query: str, db_session=None, *options) -> Dict:
+        """
+        答案緩存的查找和寫入條件：用戶向量最近變更的索引代、查詢向量，以及由 LLM 模型和 options（檢索參數）組成的範圍
+
+        應在檢索前獲取，生成回答期間索引發佈新一代時，寫入的回答歸入舊代並隨之失效
+        """
+        loop = asyncio.get_running_loop()
+        # 讀取用戶模型設置（數據庫查詢）和索引清單會阻塞，在搜索線程池中執行，同時等待查詢嵌入
+        model_config, generation, embedding = await asyncio.gather(
+            loop.run_in_executor(self.search_executor, self._get_model_config, user_id, db_session),
+            loop.run_in_executor(self.search_executor, self._user_generation, user_id),
+            self._aembed_query(query)
+        )
+        return {
+            'user_id': user_id,
+            'generation': generation,
+            'scope': (model_config['provider'], model_config['model_id'], model_config.get('api_base_url')) + options,
+            'query': query,
+            'embedding': embedding
+        }
+
+    def get_embedding_stats(self) -> Dict:
+        """獲取查詢嵌入批次、查詢向量緩存、文檔嵌入存儲和重排指標"""
+        stats = {
+            **self.embedding_batcher.stats(),
+            'query_cache': self.query_embedding_cache.stats(),
+            'document_store': self.embedding_store.stats()
+        }
+        if self.reranker is not None:
+            stats['reranker'] = self.reranker.stats()
+        return stats
+
+    def save_query_embedding_cache(self):
+        """持久化查詢向量緩存（未配置持久化路徑時不執行任何操作）"""
+        self.query_embedding_cache.save()
+
+    async def query_user_with_llm(self, user_id: int, query: str, context_docs: List[str], db_session=None,
+                                  conversation_history: List[dict] = None, usage: Optional[Dict[str, int]] = None):
+        """
+        為特定用戶結合檢索結果調用 LLM，使用用戶選擇的模型，支持對話歷史，並以異步流式返回
+
+        提供商返回 token 用量時寫入 usage；調用失敗時拋出 LLMError
+        """
         # 構建檢索到的文檔上下文
         context = "\n\n".join([f"文檔{i+1}: {doc}" for i, doc in enumerate(context_docs)])
         
@@ -278,9 +1420,18 @@ class UserKnowledgeBaseSystem:
 
 請基於上述您上傳的文檔內容提供準確、詳細的回答："""
         
-        # 獲取用戶的預設模型
-        model_config = self._get_user_preferred_model(user_id, db_session)
+        model_config = await asyncio.get_running_loop().run_in_executor(
+            self.search_executor, self._get_model_config, user_id, db_session
+        )
         
+        # 根據提供商調用不同的 API，共用該提供商的連接池
+        provider = self.llm_providers.get(model_config['provider'])
+        async for chunk in provider.stream_chat(user_id, prompt, model_config, conversation_history, usage=usage):
+            yield chunk
+    
+    def _get_model_config(self, user_id: int, db_session) -> Dict:
+        """獲取用戶的預設模型配置，未設置時使用默認 DeepSeek"""
+        model_config = self._get_user_preferred_model(user_id, db_session)
         if not model_config:
             logger.warning(f"用戶 {user_id} 未設置預設模型，使用默認 DeepSeek")
             model_config = {
@@ -289,22 +1440,8 @@ class UserKnowledgeBaseSystem:
                 'api_base_url': 'https://api.deepseek.com',
                 'api_key': os.getenv("DEEPSEEK_API_KEY")
             }
-        
-        # 根據提供商調用不同的 API
-        try:
-            if model_config['provider'] == 'deepseek':
-                yield from self._call_deepseek_api(user_id, prompt, model_config, conversation_history)
-            elif model_config['provider'] == 'openai':
-                yield from self._call_openai_api(user_id, prompt, model_config, conversation_history)
-            elif model_config['provider'] == 'anthropic':
-                yield from self._call_anthropic_api(user_id, prompt, model_config, conversation_history)
-            else:
-                yield from self._call_openai_compatible_api(user_id, prompt, model_config, conversation_history)
-                
-        except Exception as e:
-            logger.error(f"LLM 調用錯誤: {e}")
-            yield f"基於您的文檔，無法生成回答。錯誤: {str(e)}"
-    
+        return model_config
+
     def _get_user_preferred_model(self, user_id: int, db_session) -> Optional[Dict]:
         """獲取用戶的預設模型配置"""
         if not db_session:
@@ -326,257 +1463,6 @@ class UserKnowledgeBaseSystem:
         
         return None
     
-    def _call_deepseek_api(self, user_id: int, prompt: str, model_config: Dict, conversation_history: List[dict] = None):
-        """調用 DeepSeek API，支持對話歷史，並以流式返回"""
-        import requests
-        import json # Import json for parsing stream chunks
-        
-        api_key = model_config.get('api_key') or os.getenv("DEEPSEEK_API_KEY")
-        if not api_key:
-            yield "錯誤：未設置 DeepSeek API 密鑰"
-            return
-        
-        messages = [
-            {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"}
-        ]
-        
-        if conversation_history:
-            for msg in conversation_history[-6:]:
-                if msg.get('role') in ['user', 'assistant']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-        
-        messages.append({"role": "user", "content": prompt})
-            
-        try:
-            with requests.post(
-                f"{model_config['api_base_url']}/v1/chat/completions",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}"
-                },
-                json={
-                    "model": model_config['model_id'],
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "stream": True # Enable streaming
-                },
-                stream=True, # Important for requests to stream
-                timeout=300
-            ) as response:
-                response.raise_for_status() # Raise an exception for HTTP errors
-                
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data:'):
-                            json_data = decoded_line[len('data:'):].strip()
-                            if json_data == '[DONE]':
-                                break
-                            try:
-                                chunk = json.loads(json_data)
-                                # Extract content from the chunk
-                                content = chunk["choices"][0]["delta"].get("content", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                logger.warning(f"無法解析 JSON 數據塊: {json_data}")
-                                continue
-        except requests.exceptions.RequestException as e:
-            logger.error(f"DeepSeek API 調用失敗: {e}")
-            yield f"API 調用失敗: {str(e)}"
-    
-    def _call_openai_api(self, user_id: int, prompt: str, model_config: Dict, conversation_history: List[dict] = None):
-        """調用 OpenAI API，支持對話歷史，並以流式返回"""
-        import requests
-        import json
-        
-        api_key = model_config.get('api_key')
-        if not api_key:
-            yield "錯誤：未設置 OpenAI API 密鑰"
-            return
-        
-        messages = [
-            {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"}
-        ]
-        
-        if conversation_history:
-            for msg in conversation_history[-6:]:
-                if msg.get('role') in ['user', 'assistant']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-        
-        messages.append({"role": "user", "content": prompt})
-            
-        try:
-            with requests.post(
-                f"{model_config['api_base_url']}/chat/completions",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}"
-                },
-                json={
-                    "model": model_config['model_id'],
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "stream": True
-                },
-                stream=True,
-                timeout=300
-            ) as response:
-                response.raise_for_status()
-                
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data:'):
-                            json_data = decoded_line[len('data:'):].strip()
-                            if json_data == '[DONE]':
-                                break
-                            try:
-                                chunk = json.loads(json_data)
-                                content = chunk["choices"][0]["delta"].get("content", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                logger.warning(f"無法解析 JSON 數據塊: {json_data}")
-                                continue
-        except requests.exceptions.RequestException as e:
-            logger.error(f"OpenAI API 調用失敗: {e}")
-            yield f"API 調用失敗: {str(e)}"
-    
-    def _call_anthropic_api(self, user_id: int, prompt: str, model_config: Dict, conversation_history: List[dict] = None):
-        """調用 Anthropic Claude API，支持對話歷史，並以流式返回"""
-        import requests
-        import json
-        
-        api_key = model_config.get('api_key')
-        if not api_key:
-            yield "錯誤：未設置 Anthropic API 密鑰"
-            return
-        
-        messages = []
-        system_message = f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"
-        
-        if conversation_history:
-            for msg in conversation_history[-6:]:
-                if msg.get('role') in ['user', 'assistant']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-        
-        if messages:
-            messages.append({"role": "user", "content": prompt})
-        else:
-            messages.append({"role": "user", "content": f"{system_message}\n\n{prompt}"})
-            
-        try:
-            with requests.post(
-                f"{model_config['api_base_url']}/v1/messages",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}",
-                    "anthropic-version": "2023-06-01"
-                },
-                json={
-                    "model": model_config['model_id'],
-                    "max_tokens": 1000,
-                    "messages": messages,
-                    "stream": True
-                },
-                stream=True,
-                timeout=300
-            ) as response:
-                response.raise_for_status()
-                
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data:'):
-                            json_data = decoded_line[len('data:'):].strip()
-                            if json_data == '[DONE]':
-                                break
-                            try:
-                                chunk = json.loads(json_data)
-                                # Anthropic stream response structure might be different
-                                # Need to check Anthropic API docs for exact streaming format
-                                # Assuming it's similar to OpenAI's delta.content for now
-                                content = chunk.get("delta", {}).get("text", "") # Adjust based on actual Anthropic stream format
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                logger.warning(f"無法解析 JSON 數據塊: {json_data}")
-                                continue
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Anthropic API 調用失敗: {e}")
-            yield f"API 調用失敗: {str(e)}"
-    
-    def _call_openai_compatible_api(self, user_id: int, prompt: str, model_config: Dict, conversation_history: List[dict] = None):
-        """調用 OpenAI 兼容的 API（如 Google, Microsoft 等），支持對話歷史，並以流式返回"""
-        import requests
-        import json
-        
-        api_key = model_config.get('api_key')
-        if not api_key:
-            yield f"錯誤：未設置 {model_config['provider']} API 密鑰"
-            return
-        
-        messages = [
-            {"role": "system", "content": f"你是用戶 {user_id} 的私人知識庫助手，只能基於該用戶上傳的文檔回答問題。請保持對話的連貫性和上下文理解。"}
-        ]
-        
-        if conversation_history:
-            for msg in conversation_history[-6:]:
-                if msg.get('role') in ['user', 'assistant']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-        
-        messages.append({"role": "user", "content": prompt})
-            
-        try:
-            with requests.post(
-                f"{model_config['api_base_url']}/chat/completions",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}"
-                },
-                json={
-                    "model": model_config['model_id'],
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "stream": True
-                },
-                stream=True,
-                timeout=300
-            ) as response:
-                response.raise_for_status()
-                
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data:'):
-                            json_data = decoded_line[len('data:'):].strip()
-                            if json_data == '[DONE]':
-                                break
-                            try:
-                                chunk = json.loads(json_data)
-                                content = chunk["choices"][0]["delta"].get("content", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                logger.warning(f"無法解析 JSON 數據塊: {json_data}")
-                                continue
-        except requests.exceptions.RequestException as e:
-            logger.error(f"{model_config['provider']} API 調用失敗: {e}")
-            yield f"API 調用失敗: {str(e)}"
-    
     def delete_user_document(self, user_id: int, filename: str) -> bool:
         """刪除用戶文檔"""
         user_docs_folder = self.get_user_docs_folder(user_id)
@@ -586,8 +1472,8 @@ class UserKnowledgeBaseSystem:
             try:
                 file_path.unlink()
                 logger.info(f"刪除用戶 {user_id} 文檔: {filename}")
-                # 重新建立索引
-                self.build_user_index(user_id)
+                # 從索引中移除該文檔的向量
+                self.remove_document_from_index(user_id, filename)
                 return True
             except Exception as e:
                 logger.error(f"刪除用戶 {user_id} 文檔失敗: {e}")
@@ -610,15 +1496,32 @@ class UserKnowledgeBaseSystem:
         
         return documents
     
-    def clear_user_data(self, user_id: int):
-        """清除用戶所有數據（用於用戶刪除賬號）"""
-        import shutil
-        
+    def clear_user_data(self, user_id: int, keep_files: Iterable[str] = ()):
+        """
+        清除用戶所有數據（用於刪除全部文檔或用戶刪除賬號）
+
+        Args:
+            user_id: 用戶 ID
+            keep_files: 保留的文檔路徑（清除請求之後新上傳、尚未索引的文檔）
+        """
         user_docs_folder = self.get_user_docs_folder(user_id)
         user_index_path = self.get_user_index_path(user_id)
-        
+        self.index_cache.invalidate(user_id)
+        self.answer_cache.invalidate(user_id)
+
         try:
-            if user_docs_folder.exists():
+            if self.storage_mode == "shared":
+                self._replace_user_vectors(user_id, [], [], np.zeros((0, self.dimension), dtype='float32'))
+            else:
+                with self._get_index_lock(user_id):
+                    self._remove_index(user_id)
+            keep = {str(Path(file_path)) for file_path in keep_files}
+            if user_docs_folder.exists() and keep:
+                for path in user_docs_folder.iterdir():
+                    # .part 為正在寫入的上傳
+                    if path.is_file() and str(path) not in keep and path.suffix != ".part":
+                        path.unlink(missing_ok=True)
+            elif user_docs_folder.exists():
                 shutil.rmtree(user_docs_folder)
             if user_index_path.exists():
                 shutil.rmtree(user_index_path)
@@ -0,0 +1,271 @@
+"""
+向量索引分級
+按用戶語料規模自動選擇 FAISS 索引類型：小語料使用精確的 Flat 索引，大語料使用 IVF 或 HNSW 近似索引；
+向量可選 float16 / int8 標量量化或 PQ 乘積量化存儲，並提供以 Flat 精確搜索為基準的召回率與延遲報告
+"""
+
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ['auto', 'flat', 'ivf', 'hnsw']
+
+QUANTIZATIONS = ['none', 'fp16', 'int8', 'pq']
+
+# 向量太少時 IVF 聚類沒有意義，改用 Flat
+IVF_MIN_VECTORS = 1000
+
+# PQ 碼本每個子量化器有 256 個中心，向量太少時訓練不充分，不使用 PQ
+PQ_MIN_VECTORS = 10000
+
+_SQ_ENCODINGS = {'fp16': 'SQfp16', 'int8': 'SQ8'}
+
+
+class VectorIndexBuilder:
+    """根據向量數量創建、訓練和調參 FAISS 索引，所有索引都以 IndexIDMap2 包裝以支持按 ID 增刪"""
+
+    def __init__(self, dimension: int, index_type: str = 'auto', flat_max_vectors: int = 20000,
+                 ivf_nlist: int = 0, quantization: str = 'none', pq_m: int = 0, hnsw_m: int = 32,
+                 nprobe: int = 16, ef_search: int = 64):
+        """
+        初始化索引構建器
+
+        Args:
+            dimension: 向量維度
+            index_type: auto / flat / ivf / hnsw；auto 在 flat_max_vectors 以下用 Flat，以上用 IVF
+            flat_max_vectors: auto 模式下使用 Flat 索引的最大向量數
+            ivf_nlist: IVF 聚類中心數，0 表示按 4 * sqrt(n) 自動計算
+            quantization: 向量存儲方式 none (float32) / fp16 / int8 / pq，分別約為原大小的 1、1/2、1/4、1/32
+            pq_m: PQ 子量化器數（每個向量佔 pq_m 字節），0 表示維度 / 8；需整除向量維度
+            hnsw_m: HNSW 每個節點的鄰居數
+            nprobe: IVF 搜索時訪問的聚類數
+            ef_search: HNSW 搜索時的候選隊列長度
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支持的索引類型: {index_type}，可選 {', '.join(INDEX_TYPES)}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"不支持的量化方式: {quantization}，可選 {', '.join(QUANTIZATIONS)}")
+        pq_m = pq_m or max(1, dimension // 8)
+        if quantization == 'pq' and dimension % pq_m:
+            logger.warning(f"PQ 子量化器數 {pq_m} 不能整除向量維度 {dimension}，改用 int8 量化")
+            quantization = 'int8'
+
+        self.dimension = dimension
+        self.index_type = index_type
+        self.flat_max_vectors = flat_max_vectors
+        self.ivf_nlist = ivf_nlist
+        self.quantization = quantization
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+
+    def kind_for(self, n_vectors: int) -> str:
+        """返回指定向量數量應使用的索引類型 (flat / ivf / hnsw)"""
+        if self.index_type == 'ivf' and n_vectors < IVF_MIN_VECTORS:
+            return 'flat'
+        if self.index_type != 'auto':
+            return self.index_type
+        return 'flat' if n_vectors < max(self.flat_max_vectors, IVF_MIN_VECTORS) else 'ivf'
+
+    def encoding_for(self, n_vectors: int) -> str:
+        """返回指定向量數量應使用的量化方式 (none / fp16 / int8 / pq)"""
+        if self.quantization == 'pq' and n_vectors < PQ_MIN_VECTORS:
+            return 'none'
+        return self.quantization
+
+    def factory_string(self, n_vectors: int) -> str:
+        """生成 faiss.index_factory 描述字符串"""
+        kind = self.kind_for(n_vectors)
+        quantization = self.encoding_for(n_vectors)
+        if quantization == 'pq':
+            encoding = f"PQ{self.pq_m}"
+        else:
+            encoding = _SQ_ENCODINGS.get(quantization, "Flat")
+
+        if kind == 'hnsw':
+            return f"IDMap2,HNSW{self.hnsw_m}" + ("" if encoding == "Flat" else f",{encoding}")
+        if kind == 'ivf':
+            return f"IDMap2,IVF{self._nlist_for(n_vectors)},{encoding}"
+        return f"IDMap2,{encoding}"
+
+    def _nlist_for(self, n_vectors: int) -> int:
+        nlist = self.ivf_nlist or int(4 * math.sqrt(max(n_vectors, 1)))
+        # 每個聚類中心至少需要約 39 個訓練樣本
+        return max(1, min(nlist, n_vectors // 39))
+
+    def build(self, embeddings: np.ndarray, vector_ids: np.ndarray):
+        """創建索引，需要訓練的索引類型以全部向量的樣本在構建時完成訓練"""
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        vector_ids = np.asarray(vector_ids, dtype='int64')
+        description = self.factory_string(len(embeddings))
+
+        started = time.perf_counter()
+        faiss_index = faiss.index_factory(self.dimension, description, faiss.METRIC_INNER_PRODUCT)
+        if not faiss_index.is_trained:
+            # IVF 訓練樣本數控制在每個聚類中心 256 個以內，量化器訓練最多使用 65536 個樣本
+            ivf = faiss.try_extract_index_ivf(faiss_index)
+            max_train = ivf.nlist * 256 if ivf is not None else 65536
+            train_set = embeddings
+            if len(embeddings) > max_train:
+                sample = np.random.default_rng(0).choice(len(embeddings), max_train, replace=False)
+                train_set = embeddings[sample]
+            faiss_index.train(train_set)
+        faiss_index.add_with_ids(embeddings, vector_ids)
+        self.apply_search_params(faiss_index)
+
+        logger.info(f"建立 {description} 索引: {len(embeddings)} 個向量，耗時 {time.perf_counter() - started:.2f}s")
+        return faiss_index
+
+    def apply_search_params(self, faiss_index):
+        """設置 IVF 的 nprobe 和 HNSW 的 efSearch，從磁盤載入的索引以當前配置為準"""
+        kind = self.kind_of(faiss_index)
+        if kind == 'ivf':
+            faiss.ParameterSpace().set_index_parameter(faiss_index, "nprobe", self.nprobe)
+        elif kind == 'hnsw':
+            faiss.ParameterSpace().set_index_parameter(faiss_index, "efSearch", self.ef_search)
+
+    def search_params(self, faiss_index, selector):
+        """構建帶 ID 過濾器的搜索參數，同時保留當前的 nprobe / efSearch 設置"""
+        kind = self.kind_of(faiss_index)
+        if kind == 'ivf':
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        if kind == 'hnsw':
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+        return faiss.SearchParameters(sel=selector)
+
+    @staticmethod
+    def kind_of(faiss_index) -> str:
+        """識別已有索引的類型 (flat / ivf / hnsw)"""
+        inner = faiss_index.index if isinstance(faiss_index, faiss.IndexIDMap) else faiss_index
+        inner = faiss.downcast_index(inner)
+        if isinstance(inner, faiss.IndexIVF):
+            return 'ivf'
+        if isinstance(inner, faiss.IndexHNSW):
+            return 'hnsw'
+        return 'flat'
+
+    @staticmethod
+    def supports_remove(faiss_index) -> bool:
+        """HNSW 圖不支持刪除節點，需要以剩餘向量重建"""
+        return VectorIndexBuilder.kind_of(faiss_index) != 'hnsw'
+
+    @staticmethod
+    def encoding_of(faiss_index) -> str:
+        """識別已有索引的量化方式 (none / fp16 / int8 / pq)"""
+        inner = faiss_index.index if isinstance(faiss_index, faiss.IndexIDMap) else faiss_index
+        inner = faiss.downcast_index(inner)
+        if isinstance(inner, faiss.IndexHNSW):
+            inner = faiss.downcast_index(inner.storage)
+
+        if isinstance(inner, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+            return 'pq'
+        if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+            return {
+                faiss.ScalarQuantizer.QT_fp16: 'fp16',
+                faiss.ScalarQuantizer.QT_8bit: 'int8'
+            }.get(inner.sq.qtype, 'int8')
+        return 'none'
+
+    def needs_rebuild(self, faiss_index, n_vectors: Optional[int] = None) -> bool:
+        """語料規模或量化配置變化後，當前索引類型與應使用的類型不一致時需要重建"""
+        if n_vectors is None:
+            n_vectors = faiss_index.ntotal
+        return (
+            self.kind_of(faiss_index) != self.kind_for(n_vectors)
+            or self.encoding_of(faiss_index) != self.encoding_for(n_vectors)
+        )
+
+    @staticmethod
+    def rerank_exact(query: np.ndarray, candidate_ids: List[int], candidate_vectors: np.ndarray) -> List[tuple]:
+        """
+        以全精度向量重新計算候選結果的內積並排序
+
+        Returns:
+            按分數從高到低排列的 [(分數, 向量 ID)]
+        """
+        scores = np.asarray(candidate_vectors, dtype='float32') @ np.asarray(query, dtype='float32').reshape(-1)
+        order = np.argsort(-scores, kind='stable')
+        return [(float(scores[i]), candidate_ids[i]) for i in order]
+
+    def evaluate(self, faiss_index, embeddings: np.ndarray, vector_ids: np.ndarray, n_queries: int = 100,
+                 top_k: int = 10, sweep: Optional[List[int]] = None) -> Dict:
+        """
+        以 Flat 精確搜索為基準，報告當前索引在不同搜索參數下的召回率和延遲
+
+        Args:
+            faiss_index: 待評估的索引
+            embeddings: 索引中全部向量的全精度版本，用於構建精確基準和抽樣查詢
+            vector_ids: 與 embeddings 對應的向量 ID
+            n_queries: 從語料中抽樣的查詢數
+            top_k: 計算 recall@k 的 k
+            sweep: IVF 的 nprobe 或 HNSW 的 efSearch 取值列表，默認自動選取
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        rng = np.random.default_rng(0)
+        queries = embeddings[rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)]
+        top_k = min(top_k, len(embeddings))
+
+        baseline = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+        baseline.add_with_ids(embeddings, np.asarray(vector_ids, dtype='int64'))
+        exact_ids, flat_latency = self._time_search(baseline, queries, top_k)
+
+        kind = self.kind_of(faiss_index)
+        report = {
+            'index_type': kind,
+            'quantization': self.encoding_of(faiss_index),
+            'vectors': int(faiss_index.ntotal),
+            'queries': len(queries),
+            'top_k': top_k,
+            'flat_latency_ms': flat_latency,
+            'results': []
+        }
+
+        param_name = {'ivf': 'nprobe', 'hnsw': 'efSearch'}.get(kind)
+        if param_name is None:
+            sweep = [None]
+        elif sweep is None:
+            if kind == 'ivf':
+                nlist = faiss.extract_index_ivf(faiss_index).nlist
+                sweep = sorted({v for v in [1, 4, 16, 64, 256, self.nprobe] if v <= nlist})
+            else:
+                sweep = sorted({16, 32, 64, 128, 256, self.ef_search})
+
+        try:
+            for value in sweep:
+                if param_name is not None:
+                    faiss.ParameterSpace().set_index_parameter(faiss_index, param_name, value)
+                ids, latency = self._time_search(faiss_index, queries, top_k)
+                report['results'].append({
+                    'param': param_name,
+                    'value': value,
+                    'recall': self._recall(ids, exact_ids),
+                    'latency_ms': latency
+                })
+        finally:
+            self.apply_search_params(faiss_index)
+
+        return report
+
+    @staticmethod
+    def _time_search(faiss_index, queries: np.ndarray, top_k: int) -> tuple:
+        """逐條查詢計時，返回 (結果 ID 矩陣, 平均每次查詢毫秒數)"""
+        all_ids = []
+        started = time.perf_counter()
+        for query in queries:
+            _, ids = faiss_index.search(query.reshape(1, -1), top_k)
+            all_ids.append(ids[0])
+        elapsed = time.perf_counter() - started
+        return np.stack(all_ids), elapsed / len(queries) * 1000
+
+    @staticmethod
+    def _recall(ids: np.ndarray, exact_ids: np.ndarray) -> float:
+        """recall@k：近似結果與精確結果的 top-k 交集佔比"""
+        hits = [len(set(row) & set(exact_row)) for row, exact_row in zip(ids.tolist(), exact_ids.tolist())]
+        return float(np.mean(hits) / exact_ids.shape[1])
@@ -0,0 +1,32 @@
+"""LexicalIndex BM25 檢索的測試"""
+
+from lexical_index import LexicalIndex, Tokenizer
+
+TENANT_A = (1 << 32, 2 << 32)
+
+
+def _index(documents):
+    index = LexicalIndex(Tokenizer("bigram"))
+    index.sync(documents)
+    return index
+
+
+def test_id_range_scores_ignore_other_tenants():
+    tenant_a = {
+        TENANT_A[0]: "合約編號 AB-1234 付款條件三十天",
+        TENANT_A[0] + 1: "交貨期限六十天",
+    }
+    # 另一個租戶的大量文本塊都包含「付款」
+    tenant_b = {(2 << 32) + i: f"付款通知第 {i} 號" for i in range(50)}
+
+    alone = _index(tenant_a).search("付款條件", 5, TENANT_A)
+    shared = _index({**tenant_a, **tenant_b}).search("付款條件", 5, TENANT_A)
+
+    assert shared == alone
+    assert [vector_id for _, vector_id, _ in shared] == [TENANT_A[0]]
+
+
+def test_empty_id_range_returns_nothing():
+    index = _index({(2 << 32): "付款通知"})
+
+    assert index.search("付款", 5, TENANT_A) == []
@@ -0,0 +1,131 @@
+"""llm_providers 對本地 LLM 模擬服務（llm_stub_server）的流式調用測試"""
+
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+
+import llm_providers
+import llm_stub_server
+from llm_providers import LLMError, LLMProviderRegistry
+
+STUB_TEXT = "這是來自本地模擬服務的回答。問題："
+
+
+@pytest.fixture(scope="module")
+def stub_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(llm_stub_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            pytest.fail("LLM 模擬服務未能啟動")
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(5)
+
+
+@pytest.fixture(autouse=True)
+def no_chunk_delay(monkeypatch):
+    monkeypatch.setattr(llm_stub_server, "CHUNK_DELAY", 0)
+
+
+def _model_config(provider, stub_url):
+    return {'provider': provider, 'model_id': "stub", 'api_key': "test-key", 'api_base_url': stub_url}
+
+
+async def _ask(registry, provider, stub_url, prompt="付款條件是什麼？"):
+    usage = {}
+    pieces = [
+        piece async for piece in registry.get(provider).stream_chat(
+            1, prompt, _model_config(provider, stub_url), usage=usage
+        )
+    ]
+    return pieces, usage
+
+
+def _run(coroutine_function):
+    async def run():
+        registry = LLMProviderRegistry()
+        try:
+            return await coroutine_function(registry)
+        finally:
+            await registry.aclose()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("provider", ["openai", "deepseek", "custom"])
+def test_openai_compatible_stream_and_usage(stub_url, provider):
+    pieces, usage = _run(lambda registry: _ask(registry, provider, stub_url))
+
+    assert len(pieces) > 1
+    assert "".join(pieces).startswith(STUB_TEXT)
+    assert "付款條件是什麼？" in "".join(pieces)
+    if provider == "custom":
+        # 未知提供商按 OpenAI 兼容接口調用，不請求用量
+        assert usage == {}
+    else:
+        assert usage['completion_tokens'] == len(pieces)
+        assert usage['prompt_tokens'] > 0
+
+
+def test_anthropic_stream_and_usage(stub_url):
+    pieces, usage = _run(lambda registry: _ask(registry, "anthropic", stub_url))
+
+    assert "".join(pieces).startswith(STUB_TEXT)
+    assert usage['completion_tokens'] == len(pieces)
+    assert usage['prompt_tokens'] > 0
+
+
+def test_requests_reuse_the_pooled_connection(stub_url):
+    async def ask_twice(registry):
+        await _ask(registry, "openai", stub_url)
+        client = registry.get_client("openai")
+        await _ask(registry, "openai", stub_url)
+        return client, registry.get_client("openai"), registry.get_client("anthropic")
+
+    async def run():
+        registry = LLMProviderRegistry()
+        try:
+            client, again, other = await ask_twice(registry)
+            return client is again, client is other, len(client._transport._pool.connections)
+        finally:
+            await registry.aclose()
+
+    same_client, shared_across_providers, connections = asyncio.run(run())
+
+    assert same_client
+    assert not shared_across_providers
+    assert connections == 1
+
+
+def test_read_timeout_is_per_provider(stub_url, monkeypatch):
+    monkeypatch.setattr(llm_stub_server, "CHUNK_DELAY", 0.5)
+    monkeypatch.setenv("LLM_READ_TIMEOUT_OPENAI", "0.1")
+
+    with pytest.raises(LLMError):
+        _run(lambda registry: _ask(registry, "openai", stub_url))
+
+    registry = LLMProviderRegistry()
+    assert registry.get_client("openai").timeout.read == 0.1
+    assert registry.get_client("anthropic").timeout.read == 300
+    asyncio.run(registry.aclose())
+
+
+def test_missing_api_key_raises_llm_error(stub_url, monkeypatch):
+    monkeypatch.delenv("DEEPSEEK_API_KEY", raising=False)
+    config = {**_model_config("deepseek", stub_url), 'api_key': None}
+
+    async def ask(registry):
+        return [piece async for piece in registry.get("deepseek").stream_chat(1, "問題", config)]
+
+    with pytest.raises(LLMError, match="API 密鑰"):
+        _run(ask)
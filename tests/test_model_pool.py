@@ -0,0 +1,48 @@
+"""模型池本地優先載入的測試，以假模型類代替 sentence-transformers"""
+
+import pytest
+
+import model_pool
+
+
+class LegacyModel:
+    """sentence-transformers 2.2.2 風格的構造函數，不接受 local_files_only"""
+
+    def __init__(self, model_name, device=None):
+        self.model_name = model_name
+        self.device = device
+
+
+class CachedOnlyRemotelyModel:
+    """本地緩存中沒有模型：local_files_only=True 時拋出 OSError"""
+
+    calls = []
+
+    def __init__(self, model_name, device=None, local_files_only=False):
+        type(self).calls.append(local_files_only)
+        if local_files_only:
+            raise OSError("模型不在本地緩存中")
+
+
+class BrokenModel:
+    def __init__(self, model_name, local_files_only=False):
+        raise RuntimeError("權重文件損壞")
+
+
+def test_legacy_model_class_loads_without_local_files_only():
+    model = model_pool._load_local_first(LegacyModel, "m", device="cpu")
+
+    assert (model.model_name, model.device) == ("m", "cpu")
+
+
+def test_cache_miss_falls_back_to_download():
+    CachedOnlyRemotelyModel.calls = []
+
+    model_pool._load_local_first(CachedOnlyRemotelyModel, "m")
+
+    assert CachedOnlyRemotelyModel.calls == [True, False]
+
+
+def test_load_errors_are_not_treated_as_cache_miss():
+    with pytest.raises(RuntimeError):
+        model_pool._load_local_first(BrokenModel, "m")
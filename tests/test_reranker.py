@@ -0,0 +1,77 @@
+"""CrossEncoderReranker 的測試，以按文本長度評分的假模型代替交叉編碼器"""
+
+import uuid
+
+import pytest
+
+import reranker
+from model_pool import model_pool
+
+
+class FakeCrossEncoder:
+    """以文本長度為相關性分數的交叉編碼器"""
+
+    def predict(self, pairs, **kwargs):
+        return [float(len(content)) for _, content in pairs]
+
+
+@pytest.fixture
+def make_reranker(monkeypatch):
+    monkeypatch.setattr(reranker, "load_cross_encoder", lambda name, **kwargs: FakeCrossEncoder())
+
+    def make(**kwargs):
+        # 模型池在進程內共享，每個測試使用不同的模型名稱
+        instance = reranker.CrossEncoderReranker(f"fake-{uuid.uuid4().hex}", **kwargs)
+        model_pool.get(instance._model_key, instance._load_model)
+        return instance
+    return make
+
+
+def _results(*contents):
+    return [{'content': content, 'rank': rank} for rank, content in enumerate(contents, 1)]
+
+
+def test_rerank_orders_by_cross_encoder_score(make_reranker):
+    instance = make_reranker(budget_ms=0)
+
+    reranked = instance.rerank("問題", _results("a", "ccc", "bb"), top_k=2)
+
+    assert [result['content'] for result in reranked] == ["ccc", "bb"]
+    assert [result['rank'] for result in reranked] == [1, 2]
+
+
+def test_budget_trim_backfills_in_retrieval_order(make_reranker):
+    instance = make_reranker(budget_ms=30)
+    # 預算內只能評分 3 條候選
+    instance._ms_per_pair = 10.0
+
+    results = _results("a", "ccc", "bb", "dddd", "eeeee")
+    reranked = instance.rerank("問題", results, top_k=5)
+
+    assert len(reranked) == 5
+    assert [result['content'] for result in reranked] == ["ccc", "bb", "a", "dddd", "eeeee"]
+    assert [result['rank'] for result in reranked] == [1, 2, 3, 4, 5]
+    assert 'rerank_score' not in reranked[3]
+    assert instance.stats()['trimmed'] == 1
+    # 補位的結果是副本，不修改調用方的檢索結果
+    assert results[3]['rank'] == 4
+
+
+def test_budget_trim_does_not_backfill_after_min_score_filter(make_reranker):
+    instance = make_reranker(budget_ms=30, min_score=2.0)
+    instance._ms_per_pair = 10.0
+
+    reranked = instance.rerank("問題", _results("a", "ccc", "bb", "dddd", "eeeee"), top_k=5)
+
+    # "a" 被 min_score 過濾，未評分的 "dddd"、"eeeee" 不補位
+    assert [result['content'] for result in reranked] == ["ccc", "bb"]
+    assert all('rerank_score' in result for result in reranked)
+
+
+def test_budget_trim_backfills_when_min_score_keeps_all(make_reranker):
+    instance = make_reranker(budget_ms=30, min_score=1.0)
+    instance._ms_per_pair = 10.0
+
+    reranked = instance.rerank("問題", _results("a", "ccc", "bb", "dddd"), top_k=4)
+
+    assert [result['content'] for result in reranked] == ["ccc", "bb", "a", "dddd"]
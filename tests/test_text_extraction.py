@@ -0,0 +1,53 @@
+"""TextExtractor 進程池的測試"""
+
+import os
+import signal
+import threading
+
+import pytest
+
+from text_extraction import TextExtractor
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="進程池只在支持 fork 的平台使用")
+
+
+def _write(tmp_path, name, text):
+    file_path = tmp_path / name
+    file_path.write_text(text, encoding='utf-8')
+    return file_path
+
+
+def test_does_not_fork_once_other_threads_are_running(tmp_path):
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, daemon=True)
+    thread.start()
+    try:
+        extractor = TextExtractor(max_workers=2)
+        extractor.start()
+    finally:
+        stop.set()
+        thread.join()
+
+    assert extractor._executor is None
+    assert extractor.max_workers == 1
+    file_path = _write(tmp_path, "a.doc", "")
+    assert extractor.extract_many([file_path]) == {file_path: ""}
+
+
+def test_broken_pool_falls_back_to_in_process_extraction(tmp_path):
+    if threading.active_count() > 1:
+        pytest.skip("其他測試遺留的後台線程仍在運行，不能 fork 工作進程")
+    extractor = TextExtractor(max_workers=2)
+    extractor.start()
+    try:
+        for pid in list(extractor._executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        file_path = _write(tmp_path, "notes.md", "內容")
+        broken = _write(tmp_path, "broken.docx", "不是 docx")
+
+        results = extractor.extract_many([file_path, broken])
+    finally:
+        extractor.shutdown()
+
+    assert results == {file_path: "內容", broken: ""}
+    assert extractor.max_workers == 1
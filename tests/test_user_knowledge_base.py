@@ -0,0 +1,174 @@
+"""UserKnowledgeBaseSystem 索引寫入路徑的測試，以字符二元組哈希代替嵌入模型，不需要下載模型"""
+
+import hashlib
+import pickle
+import uuid
+
+import faiss
+import numpy as np
+import pytest
+
+import user_knowledge_base
+
+
+class FakeEmbeddingModel:
+    """以字符二元組哈希生成確定性向量的嵌入模型"""
+
+    dimension = 64
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for i in range(len(text) - 1):
+                vectors[row, int(hashlib.md5(text[i:i + 2].encode()).hexdigest()[:8], 16) % self.dimension] += 1
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return vectors
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.setattr(user_knowledge_base, "load_sentence_transformer", lambda name, **kwargs: FakeEmbeddingModel())
+    monkeypatch.setenv("INDEX_STORAGE_MODE", "per_user")
+    monkeypatch.setenv("EXTRACTION_WORKERS", "1")
+    # 模型池在進程內共享，每個測試使用不同的模型名稱
+    return user_knowledge_base.UserKnowledgeBaseSystem(
+        base_docs_folder=str(tmp_path / "docs"),
+        base_index_path=str(tmp_path / "indexes"),
+        embed_model_name=f"fake-{uuid.uuid4().hex}"
+    )
+
+
+def _save_document(kb, user_id, filename, text):
+    file_path = kb.get_new_document_path(user_id, filename)
+    file_path.write_text(text, encoding='utf-8')
+    return file_path
+
+
+def _indexed_metadata(kb, user_id):
+    _, metadata = kb.load_user_index(user_id)[1].to_dicts()
+    return list(metadata.values())
+
+
+def test_first_upload_into_empty_index_records_document_id(kb):
+    file_path = _save_document(kb, 1, "contract.txt", "合約編號 AB-1234 的付款條件為三十天。" * 20)
+
+    assert kb.add_document_to_index(1, str(file_path), document_id=42)
+
+    metadata = _indexed_metadata(kb, 1)
+    assert metadata
+    assert all(meta['document_id'] == 42 for meta in metadata)
+
+    results = kb.search_user_documents(1, "AB-1234 付款條件", top_k=1)
+    assert results[0]['metadata']['document_id'] == 42
+
+
+def test_rebuild_keeps_document_ids(kb):
+    first = _save_document(kb, 1, "a.txt", "第一份文件的內容說明。" * 20)
+    second = _save_document(kb, 1, "b.txt", "第二份文件的內容說明。" * 20)
+    kb.update_user_index(1, added=[(str(first), 1), (str(second), 2)])
+
+    # 未提供文檔 ID 的完整重建沿用索引中已記錄的文檔 ID
+    assert kb.build_user_index(1)
+
+    ids = {meta['filename']: meta['document_id'] for meta in _indexed_metadata(kb, 1)}
+    assert ids == {first.name: 1, second.name: 2}
+
+
+def test_clear_user_data_keeps_later_uploads(kb):
+    old_path = _save_document(kb, 1, "old.txt", "舊文檔的內容。" * 20)
+    assert kb.add_document_to_index(1, str(old_path), document_id=1)
+    new_path = _save_document(kb, 1, "new.txt", "清除之後上傳的文檔。" * 20)
+
+    assert kb.clear_user_data(1, keep_files=[str(new_path)])
+
+    assert not old_path.exists()
+    assert new_path.exists()
+    assert not kb.load_user_index(1)[0]
+
+
+def _write_unchunked_index(kb, user_id, texts):
+    """寫入分塊之前格式的索引：每篇文檔一條記錄，元數據沒有文本塊位置"""
+    vector_ids = list(range(len(texts)))
+    faiss_index = kb.index_builder.build(kb._encode_documents(texts), np.array(vector_ids, dtype='int64'))
+    kb._write_user_index(
+        user_id, faiss_index,
+        dict(zip(vector_ids, texts)),
+        {vid: {'filename': f"doc{vid}.txt"} for vid in vector_ids}
+    )
+
+
+def test_search_caps_unchunked_documents(kb):
+    _write_unchunked_index(kb, 1, ["付款條件為三十天。" * 2000])
+
+    results = kb.search_user_documents(1, "付款條件", top_k=1)
+
+    assert results
+    assert len(results[0]['content']) <= kb.UNCHUNKED_CONTENT_CHARS + len("...")
+
+
+def _write_legacy_pickle_index(kb, user_id, texts):
+    """寫入最早版本的索引：FAISS 索引加 documents.pkl / metadata.pkl，每篇文檔一條記錄"""
+    index_path = kb.get_user_index_path(user_id)
+    faiss_index = faiss.IndexFlatL2(kb.dimension)
+    faiss_index.add(kb._encode_documents(texts))
+    faiss.write_index(faiss_index, str(index_path / "faiss.index"))
+    with open(index_path / "documents.pkl", 'wb') as f:
+        pickle.dump(list(texts), f)
+    with open(index_path / "metadata.pkl", 'wb') as f:
+        pickle.dump([{'filename': f"doc{i}.txt"} for i in range(len(texts))], f)
+
+
+def test_legacy_pickle_index_is_marked_for_rechunk(kb):
+    _write_legacy_pickle_index(kb, 1, ["付款條件為三十天。" * 200])
+
+    assert kb._migrate_legacy_index(1)
+
+    assert kb._needs_rechunk(1)
+    assert kb.load_user_index(1)[0] is not None
+
+
+def test_migration_rechunks_legacy_index_from_document_files(kb):
+    text = "付款條件為三十天，逾期按日計息。" * 1200
+    file_path = _save_document(kb, 1, "contract.txt", text)
+    _write_legacy_pickle_index(kb, 1, [text])
+
+    assert kb.migrate_outdated_indexes() == 1
+
+    assert not kb._needs_rechunk(1)
+    metadata = _indexed_metadata(kb, 1)
+    assert len(metadata) > 1
+    assert all('chunk_start' in meta and meta['filename'] == file_path.name for meta in metadata)
+    results = kb.search_user_documents(1, "付款條件", top_k=3)
+    assert results and all(len(result['content']) <= kb.text_splitter.chunk_size for result in results)
+
+
+def test_upload_into_legacy_index_rechunks_existing_documents(kb):
+    old_text = "舊合約的交貨期限為六十天。" * 1000
+    old_path = _save_document(kb, 1, "old.txt", old_text)
+    _write_legacy_pickle_index(kb, 1, [old_text])
+    kb._migrate_legacy_index(1)
+
+    new_path = _save_document(kb, 1, "new.txt", "新合約的付款條件為三十天。" * 20)
+    assert kb.add_document_to_index(1, str(new_path), document_id=7)
+
+    metadata = _indexed_metadata(kb, 1)
+    assert {meta['filename'] for meta in metadata} == {old_path.name, new_path.name}
+    assert all('chunk_start' in meta for meta in metadata)
+
+
+def test_shared_mode_answer_cache_generation_is_per_user(kb, monkeypatch):
+    monkeypatch.setattr(kb, "storage_mode", "shared")
+    user_a, user_b = 1, 1 + kb.index_shards
+    assert kb._index_key(user_a) == kb._index_key(user_b)
+
+    kb.add_document_to_index(user_a, str(_save_document(kb, user_a, "a.txt", "用戶甲的合約。" * 20)))
+    generation_a = kb._user_generation(user_a)
+    kb.add_document_to_index(user_b, str(_save_document(kb, user_b, "b.txt", "用戶乙的合約。" * 20)))
+
+    assert kb._user_generation(user_a) == generation_a
+    assert kb._user_generation(user_b) > generation_a